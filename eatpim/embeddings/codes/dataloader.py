@@ -25,16 +25,101 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import copy
+
 import numpy as np
 import torch
 import random
 from frozendict import frozendict
 
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, get_worker_info
+
+
+class NegativeSampler(object):
+    '''
+    Draws filtered negative entities for a whole batch of queries in one vectorized call.
+
+    The true answers of every query (the true tails of a (head, relation) pair, the true heads
+    of a (relation, tail) pair or the true tails of a graph) are stored as sorted int arrays in
+    a CSR layout. Candidates are drawn uniformly for the whole batch. Only the candidates that
+    are a true answer of some query in the batch are checked with a searchsorted of their
+    query * nentity + entity keys against the answers, which are sorted by the same key, and
+    the rejected positions are drawn again until none are left.
+
+    Candidates can be restricted to a subset of the entities, which is how corrupted leaves are
+    drawn from the ingredients while rejecting the leaves of their own graph.
+    '''
+    def __init__(self, true_answers, nentity, candidates=None, seed=None):
+        answers = [np.unique(np.asarray(a, dtype=np.int64)) for a in true_answers]
+        self.nentity = nentity
+        self.offsets = np.cumsum([0] + [a.size for a in answers])
+        self.answers = np.concatenate(answers + [np.zeros(0, dtype=np.int64)])
+        answer_queries = np.repeat(np.arange(len(answers)), np.diff(self.offsets))
+        self.keys = answer_queries * nentity + self.answers
+        if candidates is None:
+            self.candidates = None
+            self.free = nentity - np.diff(self.offsets)
+        else:
+            self.candidates = np.unique(np.asarray(candidates, dtype=np.int64))
+            true_candidates = answer_queries[np.isin(self.answers, self.candidates)]
+            self.free = self.candidates.size - np.bincount(true_candidates, minlength=len(answers))
+        self.rng = np.random.default_rng(seed)
+
+    def is_true(self, queries, candidates):
+        '''
+        Element-wise check of whether candidates[i] is a true answer of queries[i]
+        '''
+        batch_queries = np.unique(queries)
+        counts = np.diff(self.offsets)[batch_queries]
+        # the answers of all queries in the batch, gathered from their CSR slices
+        answer_index = np.arange(counts.sum()) + np.repeat(self.offsets[batch_queries] - np.cumsum(counts) + counts,
+                                                          counts)
+        in_batch = np.zeros(self.nentity, dtype=bool)
+        in_batch[self.answers[answer_index]] = True
+        # most candidates are no true answer of any query in the batch and need no search
+        maybe = np.flatnonzero(in_batch[candidates])
+        keys = queries[maybe] * self.nentity + candidates[maybe]
+        found = np.minimum(np.searchsorted(self.keys, keys), self.keys.size - 1)
+        is_true = np.zeros(candidates.size, dtype=bool)
+        is_true[maybe] = self.keys[found] == keys
+        return is_true
+
+    def reseed(self, worker_id):
+        '''
+        Give this copy of the sampler its own random stream. Every DataLoader worker gets a copy
+        of the same sampler and would otherwise draw the same negatives as the other workers.
+        '''
+        self.rng = np.random.default_rng([worker_id] + self.rng.integers(2 ** 32, size=4).tolist())
+
+    def uniform(self, size):
+        if self.candidates is None:
+            return self.rng.integers(self.nentity, size=size)
+        return self.candidates[self.rng.integers(self.candidates.size, size=size)]
+
+    def draw(self, queries):
+        '''
+        Return one candidate for every entry of queries that is not a true answer of it
+        '''
+        queries = np.asarray(queries, dtype=np.int64)
+        if np.any(self.free[queries] <= 0):
+            raise ValueError('every candidate is a true answer of the query, there are no negatives')
+        negative_sample = self.uniform(queries.size)
+        rejected = np.flatnonzero(self.is_true(queries, negative_sample))
+        while rejected.size:
+            negative_sample[rejected] = self.uniform(rejected.size)
+            rejected = rejected[self.is_true(queries[rejected], negative_sample[rejected])]
+        return negative_sample
+
+    def sample(self, queries, size):
+        '''
+        Return a (len(queries), size) array of candidates that are not true answers of each query
+        '''
+        queries = np.asarray(queries, dtype=np.int64)
+        return self.draw(np.repeat(queries, size)).reshape(queries.size, size)
 
 
 class TrainDataset(Dataset):
-    def __init__(self, triples, nentity, nrelation, negative_sample_size, mode):
+    def __init__(self, triples, nentity, nrelation, negative_sample_size, mode, seed=None):
         self.len = len(triples)
         self.triples = triples
         self.triple_set = set(triples)
@@ -44,7 +129,17 @@ class TrainDataset(Dataset):
         self.mode = mode
         self.count = self.count_frequency(triples)
         self.true_head, self.true_tail = self.get_true_head_and_tail(self.triples)
-        self.device = 'cuda' if torch.cuda.is_available() else 'cpu'
+        if self.mode == 'head-batch':
+            true_answers = self.true_head
+            query_keys = [(relation, tail) for _, relation, tail in triples]
+        elif self.mode == 'tail-batch':
+            true_answers = self.true_tail
+            query_keys = [(head, relation) for head, relation, _ in triples]
+        else:
+            raise ValueError('Training batch mode %s not supported' % self.mode)
+        query_ids = {key: i for i, key in enumerate(true_answers)}
+        self.queries = np.array([query_ids[key] for key in query_keys], dtype=np.int64)
+        self.negative_sampler = NegativeSampler(list(true_answers.values()), nentity, seed=seed)
 
     def __len__(self):
         return self.len
@@ -55,49 +150,17 @@ class TrainDataset(Dataset):
         head, relation, tail = positive_sample
 
         subsampling_weight = self.count[(head, relation)] + self.count[(tail, -relation - 1)]
-        subsampling_weight = torch.sqrt(1 /
-                                        torch.cuda.FloatTensor([subsampling_weight], device=self.device)
-                                        if self.device == 'cuda'
-                                        else torch.FloatTensor([subsampling_weight], device=self.device)
-                                        )
-
-        negative_sample_list = []
-        negative_sample_size = 0
+        subsampling_weight = torch.sqrt(1 / torch.FloatTensor([subsampling_weight]))
 
-        while negative_sample_size < self.negative_sample_size:
-            negative_sample = np.random.randint(self.nentity, size=self.negative_sample_size * 2)
-            if self.mode == 'head-batch':
-                mask = np.in1d(
-                    negative_sample,
-                    self.true_head[(relation, tail)],
-                    assume_unique=True,
-                    invert=True
-                )
-            elif self.mode == 'tail-batch':
-                mask = np.in1d(
-                    negative_sample,
-                    self.true_tail[(head, relation)],
-                    assume_unique=True,
-                    invert=True
-                )
-            else:
-                raise ValueError('Training batch mode %s not supported' % self.mode)
-            negative_sample = negative_sample[mask]
-            negative_sample_list.append(negative_sample)
-            negative_sample_size += negative_sample.size
-
-        negative_sample = np.concatenate(negative_sample_list)[:self.negative_sample_size]
-
-        negative_sample = torch.cuda.LongTensor(negative_sample, device=self.device) if self.device == 'cuda' else torch.LongTensor(negative_sample, device=self.device)
+        positive_sample = torch.LongTensor(positive_sample)
 
-        positive_sample = torch.cuda.LongTensor(positive_sample, device=self.device) if self.device == 'cuda' else torch.LongTensor(positive_sample, device=self.device)
+        # negatives are drawn for the whole batch in collate_fn
+        return positive_sample, self.queries[idx], subsampling_weight, self.mode
 
-        return positive_sample, negative_sample, subsampling_weight, self.mode
-
-    @staticmethod
-    def collate_fn(data):
+    def collate_fn(self, data):
         positive_sample = torch.stack([_[0] for _ in data], dim=0)
-        negative_sample = torch.stack([_[1] for _ in data], dim=0)
+        negative_sample = self.negative_sampler.sample([_[1] for _ in data], self.negative_sample_size)
+        negative_sample = torch.as_tensor(negative_sample)
         subsample_weight = torch.cat([_[2] for _ in data], dim=0)
         mode = data[0][3]
         return positive_sample, negative_sample, subsample_weight, mode
@@ -155,7 +218,6 @@ class TestDataset(Dataset):
         self.nentity = nentity
         self.nrelation = nrelation
         self.mode = mode
-        self.device = 'cuda' if torch.cuda.is_available() else 'cpu'
 
     def __len__(self):
         return self.len
@@ -174,11 +236,11 @@ class TestDataset(Dataset):
         else:
             raise ValueError('negative batch mode %s not supported' % self.mode)
 
-        tmp = torch.cuda.LongTensor(tmp, device=self.device) if self.device == 'cuda' else torch.LongTensor(tmp, device=self.device)
+        tmp = torch.LongTensor(tmp)
         filter_bias = tmp[:, 0].float()
         negative_sample = tmp[:, 1]
 
-        positive_sample = torch.cuda.LongTensor((head, relation, tail), device=self.device) if self.device == 'cuda' else torch.LongTensor((head, relation, tail), device=self.device)
+        positive_sample = torch.LongTensor((head, relation, tail))
 
         return positive_sample, negative_sample, filter_bias, self.mode
 
@@ -203,55 +265,199 @@ def count_leaves(input_dict, leafs):
                 leafs.add(v)
     return lcount, leafs
 
+def encode_op_tree(input_dict):
+    '''
+    Flatten an operation tree into post-order arrays of relation ids (-1 for leaves),
+    parent positions (-1 for the root) and node heights, plus the entity ids of the leaves
+    in the same order. Children always come before their parent, so the root is the last node
+    and the post-order is a valid schedule for evaluating the tree.
+    '''
+    relations = []
+    leaves = []
+    parents = []
+    heights = []
+
+    def visit(node):
+        if isinstance(node, dict) or isinstance(node, frozendict):
+            # we expect only 1 key/val pair in this dict, like GOpTranseCalcOperation
+            relation_id, v_list = list(node.items())[-1]
+            children = [visit(v) for v in v_list]
+            relations.append(relation_id)
+            heights.append(1 + max(heights[c] for c in children))
+        else:
+            children = []
+            relations.append(-1)
+            leaves.append(node)
+            heights.append(0)
+        parents.append(-1)
+        position = len(parents) - 1
+        for c in children:
+            parents[c] = position
+        return position
+
+    visit(input_dict)
+    return (np.array(relations, dtype=np.int32), np.array(parents, dtype=np.int32),
+            np.array(heights, dtype=np.int32), np.array(leaves, dtype=np.int32))
+
+
+class GraphSplit(object):
+    '''
+    The flow graphs of a split. Indexing it gives the (operation dict, tail) pairs, which
+    are still used as keys for subsampling weights and true tails. The operation trees are
+    also compiled once into flat int32 arrays stored contiguously for the whole split (see
+    encode_op_tree), so datasets only have to slice views of them for every sample.
+    '''
+    def __init__(self, graphs):
+        self.graphs = graphs
+        encoded = [encode_op_tree(graph_ops) for graph_ops, _ in graphs]
+        self.node_offsets = np.cumsum([0] + [e[0].size for e in encoded])
+        self.leaf_offsets = np.cumsum([0] + [e[3].size for e in encoded])
+        self.relations = np.concatenate([e[0] for e in encoded]).astype(np.int32)
+        self.parents = np.concatenate([e[1] for e in encoded]).astype(np.int32)
+        self.heights = np.concatenate([e[2] for e in encoded]).astype(np.int32)
+        self.leaves = np.concatenate([e[3] for e in encoded]).astype(np.int32)
+        self.tails = np.array([tail for _, tail in graphs], dtype=np.int32)
+
+    def __len__(self):
+        return len(self.graphs)
+
+    def __getitem__(self, idx):
+        return self.graphs[idx]
+
+    def __iter__(self):
+        return iter(self.graphs)
+
+    def leaf_count(self, idx):
+        return self.leaf_offsets[idx + 1] - self.leaf_offsets[idx]
+
+    def op_tree(self, idx):
+        '''
+        Views of the (relations, parents, heights) arrays of a graph's operation tree, and of
+        its leaf entity ids
+        '''
+        start, end = self.node_offsets[idx], self.node_offsets[idx + 1]
+        leaf_start, leaf_end = self.leaf_offsets[idx], self.leaf_offsets[idx + 1]
+        return (self.relations[start:end], self.parents[start:end], self.heights[start:end]), \
+            self.leaves[leaf_start:leaf_end]
+
+
+class GraphProgram(object):
+    '''
+    A batch of operation trees compiled into one level-ordered program.
+
+    Every tree is evaluated on several rows of leaf entities: row 0 holds the true leaves
+    and the other rows the corrupted ones, as built by TrainGraphDataset. Node values are laid out level by level, leaves
+    first, so every level of the program only has to gather the values of its children,
+    average them per operation with a segment mean and apply the operation's relation.
+
+    Programs are compiled on the CPU, possibly in a DataLoader worker, and moved to the
+    model's device with to().
+    '''
+    def __init__(self, trees, leaf_rows, tails):
+        relations, entities, parents, heights, graph_rows = [], [], [], [], []
+        base = 0
+        for (t_relations, t_parents, t_heights), rows in zip(trees, leaf_rows):
+            n_nodes = t_relations.size
+            n_rows = rows.shape[1]
+            row_offsets = base + n_nodes * np.arange(n_rows)
+            row_entities = np.full((n_rows, n_nodes), -1, dtype=np.int64)
+            row_entities[:, t_relations < 0] = rows.T
+            relations.append(np.tile(t_relations, n_rows))
+            entities.append(row_entities.reshape(-1))
+            parents.append(np.where(t_parents >= 0, t_parents + row_offsets[:, None], -1).reshape(-1))
+            heights.append(np.tile(t_heights, n_rows))
+            graph_rows.append(n_rows)
+            base += n_nodes * n_rows
+        relations = np.concatenate(relations)
+        entities = np.concatenate(entities)
+        parents = np.concatenate(parents)
+        heights = np.concatenate(heights)
+        graph_rows = np.array(graph_rows)
+
+        # position of every node in the level-ordered value table
+        order = np.argsort(heights, kind='stable')
+        position = np.empty_like(order)
+        position[order] = np.arange(order.size)
+        level_sizes = np.bincount(heights)
+        level_starts = np.concatenate([[0], np.cumsum(level_sizes)])
+
+        def to_tensor(array, dtype=torch.long):
+            return torch.as_tensor(array, dtype=dtype)
+
+        self.leaf_entities = to_tensor(entities[order[:level_sizes[0]]])
+
+        # every edge belongs to the level of its parent
+        children = np.flatnonzero(parents >= 0)
+        edge_levels = heights[parents[children]]
+        edge_order = np.argsort(edge_levels, kind='stable')
+        edge_starts = np.searchsorted(edge_levels[edge_order], np.arange(level_sizes.size + 1))
+        self.levels = []
+        for h in range(1, level_sizes.size):
+            edges = children[edge_order[edge_starts[h]:edge_starts[h + 1]]]
+            segments = position[parents[edges]] - level_starts[h]
+            self.levels.append((
+                to_tensor(relations[order[level_starts[h]:level_starts[h + 1]]]),
+                to_tensor(position[edges]),
+                to_tensor(segments),
+                to_tensor(np.bincount(segments, minlength=level_sizes[h]), dtype=torch.float)
+            ))
+
+        # roots in ascending node order are grouped by graph, with the true row first
+        self.roots = to_tensor(position[parents < 0])
+        first_rows = np.concatenate([[0], np.cumsum(graph_rows)[:-1]])
+        corrupted = np.ones(graph_rows.sum(), dtype=bool)
+        corrupted[first_rows] = False
+        self.first_rows = to_tensor(first_rows)
+        self.corrupted_rows = to_tensor(np.flatnonzero(corrupted))
+        self.corrupted_graphs = to_tensor(np.repeat(np.arange(graph_rows.size), graph_rows)[corrupted])
+        self.corrupted_counts = to_tensor(graph_rows - 1, dtype=torch.float)
+        self.tails = to_tensor(tails)
+        self.size = graph_rows.size
+
+    def _apply(self, fn):
+        program = copy.copy(self)
+        for name, value in vars(self).items():
+            if isinstance(value, torch.Tensor):
+                setattr(program, name, fn(value))
+        program.levels = [tuple(fn(tensor) for tensor in level) for level in self.levels]
+        return program
+
+    def to(self, device, non_blocking=False):
+        return self._apply(lambda tensor: tensor.to(device, non_blocking=non_blocking))
+
+    def pin_memory(self):
+        return self._apply(lambda tensor: tensor.pin_memory())
+
+
 class TrainGraphDataset(Dataset):
-    def __init__(self, graphs, nentity, nrelation, negative_sample_size, mode, ingredient_ids):
+    def __init__(self, graphs, nentity, nrelation, negative_sample_size, mode, ingredient_ids, seed=None):
+        if not isinstance(graphs, GraphSplit):
+            graphs = GraphSplit(graphs)
         self.len = len(graphs)
         self.graphs = graphs
         self.leaf_counts = {}
-        self.leaf_nodes = {}
-        for (gops, _) in graphs:
-            leafs = set()
-            leaf_count, leafs = count_leaves(gops, leafs)
-            self.leaf_counts[gops] = leaf_count
-            self.leaf_nodes[gops] = leafs
+        for idx, (gops, _) in enumerate(graphs):
+            self.leaf_counts[gops] = graphs.leaf_count(idx)
         # self.triple_set = set(triples)
         self.nentity = nentity
-        self.entity_ids = {i for i in range(nentity)}
         self.nrelation = nrelation
         self.negative_sample_size = negative_sample_size
         self.mode = mode
         self.count = self.count_frequency(self.graphs)
         self.true_head, self.true_tail = self.get_true_head_and_tail(self.graphs)
-        self.device = 'cuda' if torch.cuda.is_available() else 'cpu'
-        self.ingredient_ids = set(ingredient_ids)
+        if self.mode != 'tail-batch' and self.mode != 'graph-tail-batch':
+            raise ValueError('Training batch mode %s not supported' % self.mode)
+        query_ids = {graph_ops: i for i, graph_ops in enumerate(self.true_tail)}
+        self.queries = np.array([query_ids[graph_ops] for graph_ops, _ in graphs], dtype=np.int64)
+        negative_seed, leaf_seed = np.random.SeedSequence(seed).spawn(2)
+        self.negative_sampler = NegativeSampler(list(self.true_tail.values()), nentity, seed=negative_seed)
+        # corrupted leaves are ingredients that are not leaves of the graph itself
+        self.leaf_sampler = NegativeSampler(np.split(graphs.leaves, graphs.leaf_offsets[1:-1]), nentity,
+                                            candidates=ingredient_ids, seed=leaf_seed)
 
     def get_leaf_counts(self, gops):
         return self.leaf_counts[gops]
 
-    def get_leaf_nodes(self, gops):
-        return self.leaf_nodes[gops]
-
-    def convert_to_tensors(self, op_leaf_count, rand_options, input_dict):
-        output_dict = dict()
-        for k, v_list in input_dict.items():
-            id_content = []
-            for v in v_list:
-                if isinstance(v, dict) or isinstance(v, frozendict):
-                    inner_dict = self.convert_to_tensors(op_leaf_count, rand_options, v)
-                    id_content.append(inner_dict)
-                else:
-                    v_list = np.random.choice(rand_options, size=op_leaf_count+1)
-                    v_list[0] = v
-                    v_tensor = torch.cuda.LongTensor(v_list,
-                                                     device=self.device) if self.device == 'cuda' else torch.LongTensor(
-                        v_list, device=self.device)
-                    id_content.append(v_tensor)
-            k_list = [k for _ in range(op_leaf_count + 1)]
-            k_tensor = torch.cuda.LongTensor(k_list, device=self.device) if self.device == 'cuda' else torch.LongTensor(
-                k_list, device=self.device)
-            output_dict[k_tensor] = frozenset(id_content)
-        return frozendict(output_dict)
-
     def __len__(self):
         return self.len
 
@@ -262,67 +468,31 @@ class TrainGraphDataset(Dataset):
 
         # removed inverse relations
         subsampling_weight = self.count[graph_ops]
-        subsampling_weight = torch.sqrt(1 /
-                                        torch.cuda.FloatTensor([subsampling_weight], device=self.device)
-                                        if self.device == 'cuda'
-                                        else torch.FloatTensor([subsampling_weight], device=self.device)
-                                        )
-        negative_sample_list = []
-        negative_sample_size = 0
-
-        while negative_sample_size < self.negative_sample_size:
-            negative_sample = np.random.randint(self.nentity, size=self.negative_sample_size * 2)
-            if self.mode == 'head-batch':
-                mask = np.in1d(
-                    negative_sample,
-                    self.true_head[tail],
-                    assume_unique=True,
-                    invert=True
-                )
-            elif self.mode == 'tail-batch' or self.mode == 'graph-tail-batch':
-                mask = np.in1d(
-                    negative_sample,
-                    self.true_tail[graph_ops],
-                    assume_unique=True,
-                    invert=True
-                )
-            else:
-                raise ValueError('Training batch mode %s not supported' % self.mode)
-            negative_sample = negative_sample[mask]
-            negative_sample_list.append(negative_sample)
-            negative_sample_size += negative_sample.size
-
-        negative_sample_t = np.concatenate(negative_sample_list)[:self.negative_sample_size]
-        negative_sample_t = torch.cuda.LongTensor(negative_sample_t, device=self.device) if self.device == 'cuda'\
-            else torch.LongTensor(negative_sample_t, device=self.device)
-
-        op_leaf_count = self.get_leaf_counts(graph_ops)
-        op_leafs = self.get_leaf_nodes(graph_ops)
-        rand_options = list(self.ingredient_ids-op_leafs)
-        positive_sample_ops = self.convert_to_tensors(op_leaf_count, rand_options, graph_ops)
-        tail_list = [tail for _ in range(op_leaf_count+1)]
-        positive_sample_t = torch.cuda.LongTensor(tail_list, device=self.device) \
-            if self.device == 'cuda' else torch.LongTensor(tail_list, device=self.device)
-
-        return (positive_sample_ops, positive_sample_t), negative_sample_t, \
+        subsampling_weight = torch.sqrt(1 / torch.FloatTensor([subsampling_weight]))
+        # the corrupted leaves, the negatives and the operation trees are all built for the
+        # whole batch in collate_fn
+        op_tree, leaves = self.graphs.op_tree(idx)
+        return (op_tree, leaves, tail), idx, self.queries[idx], \
                subsampling_weight, self.mode
 
-    @staticmethod
-    def collate_fn(data):
-        # positive_sample_ops = data[0][0]
-        # positive_sample_t = torch.stack([_[2] for _ in data], dim=0)
-        # negative_sample_h = torch.stack([_[3] for _ in data], dim=0)
-        # negative_sample_r = torch.stack([_[4] for _ in data], dim=0)
-        # negative_sample_t = torch.stack([_[5] for _ in data], dim=0)
-        # subsample_weight = torch.cat([_[6] for _ in data], dim=0)
-        # mode = data[0][7]
-        # return
-        positive_sample = data[0][0]
-        negative_sample_t = torch.stack([_[1] for _ in data], dim=0)
-        filter_bias = torch.cat([_[2] for _ in data], dim=0)
-        mode = data[0][3]
-        return positive_sample, negative_sample_t, \
-               filter_bias, mode
+    def collate_fn(self, data):
+        '''
+        Collate a batch of graph samples into a single GraphProgram
+        '''
+        leaves = [_[0][1] for _ in data]
+        leaf_counts = np.array([l.size for l in leaves])
+        # column 0 holds the true leaves, every other column one random corruption of all of them
+        corrupted = self.leaf_sampler.draw(np.repeat([_[1] for _ in data], leaf_counts ** 2))
+        corrupted = np.split(corrupted, np.cumsum(leaf_counts ** 2)[:-1])
+        leaf_rows = [np.column_stack([l, c.reshape(l.size, l.size)]) for l, c in zip(leaves, corrupted)]
+        positive_sample = GraphProgram([_[0][0] for _ in data],
+                                       leaf_rows,
+                                       [_[0][2] for _ in data])
+        negative_sample_t = self.negative_sampler.sample([_[2] for _ in data], self.negative_sample_size)
+        negative_sample_t = torch.as_tensor(negative_sample_t)
+        subsample_weight = torch.cat([_[3] for _ in data], dim=0)
+        mode = data[0][4]
+        return positive_sample, negative_sample_t, subsample_weight, mode
 
     @staticmethod
     def count_frequency(graphs, start=4):
@@ -371,6 +541,8 @@ class TrainGraphDataset(Dataset):
 
 class TestGraphDataset(Dataset):
     def __init__(self, graphs, all_true_graphs, nentity, nrelation, mode):
+        if not isinstance(graphs, GraphSplit):
+            graphs = GraphSplit(graphs)
         self.len = len(graphs)
         self.graphs = graphs
         self.all_graphs = set(all_true_graphs)
@@ -378,7 +550,6 @@ class TestGraphDataset(Dataset):
         self.nentity = nentity
         self.nrelation = nrelation
         self.mode = mode
-        self.device = 'cuda' if torch.cuda.is_available() else 'cpu'
 
 
     def __len__(self):
@@ -404,42 +575,68 @@ class TestGraphDataset(Dataset):
         else:
             raise ValueError('negative batch mode %s not supported' % self.mode)
 
-        tmp = torch.cuda.LongTensor(tmp, device=self.device) if self.device == 'cuda' else torch.LongTensor(tmp, device=self.device)
+        tmp = torch.LongTensor(tmp)
         filter_bias = tmp[:, 0].float()
 
         negative_sample = tmp[:, 1]
 
         negative_sample_t = negative_sample
 
-        def convert_to_tensors(input_dict):
-            output_dict = dict()
-            for k, v_list in input_dict.items():
-                id_content = []
-                for v in v_list:
-                    if isinstance(v, dict) or isinstance(v, frozendict):
-                        id_content.append(convert_to_tensors(v))
-                    else:
-                        v_tensor = torch.cuda.LongTensor([v], device=self.device) if self.device == 'cuda' else torch.LongTensor([v], device=self.device)
-                        id_content.append(v_tensor)
-                k_tensor = torch.cuda.LongTensor([k], device=self.device) if self.device == 'cuda' else torch.LongTensor([k], device=self.device)
-                output_dict[k_tensor] = frozenset(id_content)
-            return frozendict(output_dict)
-
-        positive_sample_ops = convert_to_tensors(graph_ops)
-        positive_sample_t = torch.cuda.LongTensor([tail], device=self.device) if self.device == 'cuda' else torch.LongTensor([tail], device=self.device)
-
-        return (positive_sample_ops, positive_sample_t), negative_sample_t, \
+        # only the true leaves are evaluated
+        op_tree, leaves = self.graphs.op_tree(idx)
+
+        return (op_tree, leaves[:, None], tail), negative_sample_t, \
                filter_bias, self.mode
 
     @staticmethod
     def collate_fn(data):
-        positive_sample = data[0][0]
+        positive_sample = GraphProgram([_[0][0] for _ in data],
+                                       [_[0][1] for _ in data],
+                                       [_[0][2] for _ in data])
         negative_sample_t = torch.stack([_[1] for _ in data], dim=0)
-        filter_bias = torch.cat([_[2] for _ in data], dim=0)
+        filter_bias = torch.stack([_[2] for _ in data], dim=0)
         mode = data[0][3]
         return positive_sample, negative_sample_t, \
                filter_bias, mode
 
+def seed_worker(worker_id):
+    '''
+    DataLoader worker_init_fn that reseeds the samplers of the worker's copy of the dataset
+    '''
+    dataset = get_worker_info().dataset
+    for sampler in ('negative_sampler', 'leaf_sampler'):
+        if hasattr(dataset, sampler):
+            getattr(dataset, sampler).reseed(worker_id)
+
+
+def worker_options(num_workers, prefetch, persistent=True):
+    '''
+    DataLoader arguments to build batches in num_workers worker processes, each of which keeps
+    prefetch batches ready ahead of the training loop. Batches are collated into CPU tensors
+    (and pinned if a GPU is used) and moved to the device with batch_to_device.
+    '''
+    if num_workers == 0:
+        return {'num_workers': 0}
+    return {
+        'num_workers': num_workers,
+        'prefetch_factor': prefetch,
+        'persistent_workers': persistent,
+        'worker_init_fn': seed_worker,
+        'pin_memory': torch.cuda.is_available()
+    }
+
+
+def batch_to_device(data, device):
+    '''
+    Move the tensors and GraphPrograms of a collated batch to the device
+    '''
+    if isinstance(data, (torch.Tensor, GraphProgram)):
+        return data.to(device, non_blocking=True)
+    if isinstance(data, (tuple, list)):
+        return type(data)(batch_to_device(d, device) for d in data)
+    return data
+
+
 class PathlengthDictIterator(object):
     def __init__(self, dict_data):
         self.step = 0
@@ -475,7 +672,7 @@ class PathlengthDictIterator(object):
 
     
 class PathTrainGraphDataset(Dataset):
-    def __init__(self, graphs, nentity, nrelation, negative_sample_size, mode, ingredient_ids):
+    def __init__(self, graphs, nentity, nrelation, negative_sample_size, mode, ingredient_ids, seed=None):
         self.len = len(graphs)
         self.graphs = graphs
         self.leaf_counts = {}
@@ -487,14 +684,20 @@ class PathTrainGraphDataset(Dataset):
             self.leaf_nodes[gops] = leafs
         # self.triple_set = set(triples)
         self.nentity = nentity
-        self.entity_ids = {i for i in range(nentity)}
         self.nrelation = nrelation
         self.negative_sample_size = negative_sample_size
         self.mode = mode
         self.count = self.count_frequency(self.graphs)
         self.true_head, self.true_tail = self.get_true_head_and_tail(self.graphs)
-        self.device = 'cuda' if torch.cuda.is_available() else 'cpu'
-        self.ingredient_ids = set(ingredient_ids)
+        if self.mode != 'tail-batch' and self.mode != 'graph-tail-batch':
+            raise ValueError('Training batch mode %s not supported' % self.mode)
+        query_ids = {graph_ops: i for i, graph_ops in enumerate(self.true_tail)}
+        self.queries = np.array([query_ids[graph_ops] for graph_ops, _ in graphs], dtype=np.int64)
+        negative_seed, leaf_seed = np.random.SeedSequence(seed).spawn(2)
+        self.negative_sampler = NegativeSampler(list(self.true_tail.values()), nentity, seed=negative_seed)
+        # corrupted leaves are ingredients that are not leaves of the graph itself
+        self.leaf_sampler = NegativeSampler([list(self.leaf_nodes[gops]) for gops, _ in graphs], nentity,
+                                            candidates=ingredient_ids, seed=leaf_seed)
         self.fg_head_rels = dict()
 
     def get_leaf_counts(self, gops):
@@ -529,47 +732,8 @@ class PathTrainGraphDataset(Dataset):
 
         # removed inverse relations
         subsampling_weight = self.count[graph_ops]
-        subsampling_weight = torch.sqrt(1 /
-                                        torch.cuda.FloatTensor([subsampling_weight], device=self.device)
-                                        if self.device == 'cuda'
-                                        else torch.FloatTensor([subsampling_weight], device=self.device)
-                                        )
-        negative_sample_list = []
-        negative_sample_size = 0
-
-        while negative_sample_size < self.negative_sample_size:
-            negative_sample = np.random.randint(self.nentity, size=self.negative_sample_size * 2)
-            if self.mode == 'head-batch':
-                mask = np.in1d(
-                    negative_sample,
-                    self.true_head[tail],
-                    assume_unique=True,
-                    invert=True
-                )
-            elif self.mode == 'tail-batch' or self.mode == 'graph-tail-batch':
-                mask = np.in1d(
-                    negative_sample,
-                    self.true_tail[graph_ops],
-                    assume_unique=True,
-                    invert=True
-                )
-            else:
-                raise ValueError('Training batch mode %s not supported' % self.mode)
-            negative_sample = negative_sample[mask]
-            negative_sample_list.append(negative_sample)
-            negative_sample_size += negative_sample.size
-
-        negative_sample_t = np.concatenate(negative_sample_list)[:self.negative_sample_size]
-        negative_sample_t = torch.cuda.LongTensor(negative_sample_t, device=self.device) if self.device == 'cuda'\
-            else torch.LongTensor(negative_sample_t, device=self.device)
-
+        subsampling_weight = torch.sqrt(1 / torch.FloatTensor([subsampling_weight]))
         op_leaf_count = self.get_leaf_counts(graph_ops)
-        op_leafs = self.get_leaf_nodes(graph_ops)
-        rand_options = list(self.ingredient_ids-op_leafs)
-        negative_sample_h = np.random.choice(rand_options, size=op_leaf_count)
-        negative_sample_h = torch.cuda.LongTensor(negative_sample_h,
-                                         device=self.device) if self.device == 'cuda' else torch.LongTensor(
-            negative_sample_h, device=self.device)
 
         if graph_ops in self.fg_head_rels.keys():
             head_rels = self.fg_head_rels[graph_ops]
@@ -577,21 +741,16 @@ class PathTrainGraphDataset(Dataset):
             head_rels = self.get_head_paths(graph_ops)
             self.fg_head_rels[graph_ops] = head_rels
 
-        positive_sample_h = torch.cuda.LongTensor([hr[0] for hr in head_rels],
-                                         device=self.device) if self.device == 'cuda' else torch.LongTensor(
-            [hr[0] for hr in head_rels], device=self.device)
-        positive_sample_r = tuple(torch.cuda.LongTensor(hr[1:],
-                                         device=self.device) if self.device == 'cuda' else torch.LongTensor(
-            [hr[0] for hr in head_rels], device=self.device) for hr in head_rels)
+        positive_sample_h = torch.LongTensor([hr[0] for hr in head_rels])
+        positive_sample_r = tuple(torch.LongTensor(hr[1:]) for hr in head_rels)
 
         tail_list = [tail for _ in range(op_leaf_count)]
-        positive_sample_t = torch.cuda.LongTensor(tail_list, device=self.device) \
-            if self.device == 'cuda' else torch.LongTensor(tail_list, device=self.device)
-        return ((positive_sample_h, negative_sample_h), positive_sample_r, positive_sample_t), negative_sample_t, \
+        positive_sample_t = torch.LongTensor(tail_list)
+        # corrupted heads and negatives are drawn for the whole batch in collate_fn
+        return (positive_sample_h, positive_sample_r, positive_sample_t), idx, self.queries[idx], \
                subsampling_weight, self.mode
 
-    @staticmethod
-    def collate_fn(data):
+    def collate_fn(self, data):
         # positive_sample_ops = data[0][0]
         # positive_sample_t = torch.stack([_[2] for _ in data], dim=0)
         # negative_sample_h = torch.stack([_[3] for _ in data], dim=0)
@@ -600,10 +759,14 @@ class PathTrainGraphDataset(Dataset):
         # subsample_weight = torch.cat([_[6] for _ in data], dim=0)
         # mode = data[0][7]
         # return
-        positive_sample = data[0][0]
-        negative_sample_t = torch.stack([_[1] for _ in data], dim=0)
-        filter_bias = torch.cat([_[2] for _ in data], dim=0)
-        mode = data[0][3]
+        positive_sample_h, positive_sample_r, positive_sample_t = data[0][0]
+        negative_sample_h = self.leaf_sampler.draw(np.repeat(data[0][1], positive_sample_t.size(0)))
+        negative_sample_h = torch.as_tensor(negative_sample_h)
+        positive_sample = ((positive_sample_h, negative_sample_h), positive_sample_r, positive_sample_t)
+        negative_sample_t = self.negative_sampler.sample([_[2] for _ in data], self.negative_sample_size)
+        negative_sample_t = torch.as_tensor(negative_sample_t)
+        filter_bias = torch.cat([_[3] for _ in data], dim=0)
+        mode = data[0][4]
         return positive_sample, negative_sample_t, \
                filter_bias, mode
 
@@ -40,7 +40,8 @@ from frozendict import frozendict
 from torch.utils.data import DataLoader
 
 from dataloader import TestDataset, PathlengthDictIterator
-from dataloader import TestGraphDataset, OneShotIterator
+from dataloader import TestGraphDataset, OneShotIterator, GraphProgram
+from dataloader import worker_options, batch_to_device
 import time
 
 class KGEModel(nn.Module):
@@ -212,15 +213,15 @@ class KGEModel(nn.Module):
                 )
                 #.view(head_tens.size(0), negative_sample_size, -1)
             else:
-                (sample_h, sample_t), neg_sample_t = sample
-                batch_size, negative_sample_size = 1, neg_sample_t.size(1)
+                program, neg_sample_t = sample
+                batch_size, negative_sample_size = neg_sample_t.size(0), neg_sample_t.size(1)
 
-                head = sample_h
+                head = self.GOpBatchCalcOperation(program).unsqueeze(1)
 
                 true_tail = torch.index_select(
                     self.entity_embedding,
                     dim=0,
-                    index=sample_t.view(-1)
+                    index=program.tails
                 ).unsqueeze(1)
 
                 neg_tail = torch.index_select(
@@ -261,17 +262,10 @@ class KGEModel(nn.Module):
             'PathTransE': self.PathTransE,
         }
 
-        graph_tail_model_func = {
-            'TransE': self.GOpTranseScores,
-            'DistMult': self.GOpDistMultScores,
-            'RotatE': self.GOpRotateScores,
-            #'PathRotatE': self.PathRotatEScores,
-            'PathTransE': self.PathTransEScores,
-        }
-
         if mode == 'graph-tail-batch':
-            pos_score, neg_tail_score, neg_head_score = graph_tail_model_func[self.model_name](head, true_tail, neg_tail)
-            return pos_score, neg_tail_score, neg_head_score
+            if self.model_name == 'PathTransE':
+                return self.PathTransEScores(head, true_tail, neg_tail)
+            return self.GOpBatchScores(program, head, true_tail, neg_tail)
         elif mode == 'graph-single':
             score = graph_model_func[self.model_name](head, tail)
         elif self.model_name in model_func:
@@ -284,6 +278,101 @@ class KGEModel(nn.Module):
     def do_agg(self, heads):
         return self.agg_w(heads)
 
+    def GOpBatchCalcOperation(self, program):
+        '''
+        Evaluate a GraphProgram level by level. This computes the same values as the
+        recursive GOp*CalcOperation functions, for all rows of all graphs in the batch at once.
+        Returns the values of the root operations, one row per (graph, leaf row).
+        '''
+        graph_op_func = {
+            'TransE': self.GOpTransEBatchOperation,
+            'DistMult': self.GOpDistMultBatchOperation,
+            'RotatE': self.GOpRotatEBatchOperation,
+        }
+        if self.model_name not in graph_op_func:
+            raise ValueError('model %s not supported in graph-tail-batch mode' % self.model_name)
+
+        values = torch.index_select(
+            self.entity_embedding,
+            dim=0,
+            index=program.leaf_entities
+        )
+        for relation_ids, child_index, segments, counts in program.levels:
+            children = torch.index_select(values, dim=0, index=child_index)
+            # aggregate the children of every operation using mean
+            head_content = torch.zeros(
+                counts.size(0), values.size(1), dtype=values.dtype, device=values.device
+            ).index_add_(0, segments, children) / counts.unsqueeze(1)
+            relation = torch.index_select(
+                self.relation_embedding,
+                dim=0,
+                index=relation_ids
+            )
+            values = torch.cat([values, graph_op_func[self.model_name](head_content, relation)], dim=0)
+
+        return torch.index_select(values, dim=0, index=program.roots)
+
+    def GOpTransEBatchOperation(self, head, relation):
+        return head + relation
+
+    def GOpDistMultBatchOperation(self, head, relation):
+        return head * relation
+
+    def GOpRotatEBatchOperation(self, head, relation):
+        pi = 3.14159265358979323846
+
+        phase_relation = relation/(self.embedding_range.detach()/pi)
+
+        re_head, im_head = torch.chunk(head, 2, dim=-1)
+        re_relation = torch.cos(phase_relation)
+        im_relation = torch.sin(phase_relation)
+
+        re_score = re_head * re_relation - im_head * im_relation
+        im_score = re_head * im_relation + im_head * re_relation
+
+        return torch.cat([re_score, im_score], dim=-1)
+
+    def GOpBatchScores(self, program, head, true_tail, neg_tail):
+        '''
+        Scores of a GraphProgram batch: the true graphs against their tails (batch_size, 1),
+        the graphs with corrupted leaves against the true tails (corrupted rows, 1) and the
+        true graphs against the negative tails (batch_size, negative_sample_size).
+        '''
+        score_func = {
+            'TransE': self.GOpTransEBatchScore,
+            'DistMult': self.GOpDistMultBatchScore,
+            'RotatE': self.GOpRotatEBatchScore,
+        }[self.model_name]
+
+        true_head = torch.index_select(head, dim=0, index=program.first_rows)
+        corrupted_head = torch.index_select(head, dim=0, index=program.corrupted_rows)
+
+        pos_score = score_func(true_head, true_tail)
+        neg_head_score = score_func(
+            corrupted_head, torch.index_select(true_tail, dim=0, index=program.corrupted_graphs)
+        )
+        neg_tail_score = score_func(true_head, neg_tail)
+
+        return pos_score, neg_head_score, neg_tail_score
+
+    def GOpTransEBatchScore(self, head, tail):
+        score = head - tail
+        return self.gamma.detach() - torch.norm(score, p=1, dim=2)
+
+    def GOpDistMultBatchScore(self, head, tail):
+        score = head * tail
+        return score.sum(dim = 2)
+
+    def GOpRotatEBatchScore(self, head, tail):
+        re_head, im_head = torch.chunk(head, 2, dim=2)
+        re_tail, im_tail = torch.chunk(tail, 2, dim=2)
+
+        # the modulus over a contiguous last dim is much faster than over dim 0
+        score = torch.stack([re_head - re_tail, im_head - im_tail], dim = -1)
+        score = score.norm(dim = -1)
+
+        return self.gamma.detach() - score.sum(dim = 2)
+
     def GOpRotateCalcOperation(self, ops):
         if isinstance(ops, frozendict):
             # we expect only 1 key/val pair in this dict. the key is the relation type, the val is
@@ -384,78 +473,6 @@ class KGEModel(nn.Module):
 
         return score
 
-    def GOpTranseScores(self, head, true_tail, neg_tail):
-        head_calc = self.GOpTranseCalcOperation(head)
-
-        pos_score = head_calc[0].view(1,1,-1)-true_tail[0].view(1,1,-1)
-        pos_score = self.gamma.detach() - torch.norm(pos_score, p=1, dim=2)
-
-        neg_head_score = head_calc[1:]-true_tail[1:]
-        neg_head_score = self.gamma.detach() - torch.norm(neg_head_score, p=1, dim=2)
-
-        neg_tail_score = head_calc[0]-neg_tail
-        neg_tail_score = self.gamma.detach() - torch.norm(neg_tail_score, p=1, dim=2)
-
-        return pos_score, neg_head_score, neg_tail_score
-
-    def GOpDistMultScores(self, head, true_tail, neg_tail):
-        head_calc = self.GOpDistMultCalcOperation(head)
-
-        pos_score = head_calc[0].view(1,1,-1)*true_tail[0].view(1,1,-1)
-        pos_score = pos_score.sum(dim = 2)
-
-        neg_head_score = head_calc[1:]*true_tail[1:]
-        neg_head_score = neg_head_score.sum(dim=2)
-
-        neg_tail_score = head_calc[0]*neg_tail
-        neg_tail_score = neg_tail_score.sum(dim=2)
-
-        return pos_score, neg_head_score, neg_tail_score
-
-    def GOpRotateScores(self, head, true_tail, neg_tail):
-        pi = 3.14159265358979323846
-        head_calc = self.GOpRotateCalcOperation(head)
-
-        #####################################
-        #####################################
-        re_trueh_tail, im_trueh_tail = torch.chunk(true_tail[0].view(1,1,-1), 2, dim=2)
-        re_pos_score, im_pos_score = torch.chunk(head_calc[0].view(1,1,-1), 2, dim=2)
-
-        re_pos_score = re_pos_score - re_trueh_tail
-        im_pos_score = im_pos_score - im_trueh_tail
-
-        pos_score = torch.stack([re_pos_score, im_pos_score], dim = 0)
-        pos_score = pos_score.norm(dim = 0)
-
-        pos_score = self.gamma.detach() - pos_score.sum(dim = 2)
-
-        #####################################
-        re_truen_tail, im_truen_tail = torch.chunk(true_tail[1:], 2, dim=2)
-        re_negh_score, im_negh_score = torch.chunk(head_calc[1:], 2, dim=2)
-
-        re_negh_score = re_negh_score - re_truen_tail
-        im_negh_score = im_negh_score - im_truen_tail
-
-        negh_score = torch.stack([re_negh_score, im_negh_score], dim = 0)
-        negh_score = negh_score.norm(dim = 0)
-
-        negh_score = self.gamma.detach() - negh_score.sum(dim = 2)
-
-        #####################################
-        re_truet_tail, im_truet_tail = torch.chunk(neg_tail, 2, dim=2)
-        re_negt_score, im_negt_score = torch.chunk(head_calc[0].view(1,1,-1), 2, dim=2)
-
-        re_negt_score = re_negt_score - re_truet_tail
-        im_negt_score = im_negt_score - im_truet_tail
-
-        negt_score = torch.stack([re_negt_score, im_negt_score], dim = 0)
-        negt_score = negt_score.norm(dim = 0)
-
-        negt_score = self.gamma.detach() - negt_score.sum(dim = 2)
-        #####################################
-
-        return pos_score, negh_score, negt_score
-
     def PathTransEScores(self, head_relation, true_tail, neg_tail):
 
         head, relations = head_relation
@@ -622,14 +639,18 @@ class KGEModel(nn.Module):
     @staticmethod
     def train_step(model, optimizer, train_iterator, args):
         '''
-        A single train step. Apply back-propation and return the loss
+        A single train step. Apply back-propation and return the loss, along with the time spent
+        waiting for the batch and the time spent on the step itself
         '''
 
         model.train()
 
         optimizer.zero_grad()
 
-        positive_sample, negative_sample, subsampling_weight, mode = next(train_iterator)
+        start = time.time()
+        data = next(train_iterator)
+        data_time = time.time() - start
+        positive_sample, negative_sample, subsampling_weight, mode = batch_to_device(data, model.device)
 
         if mode == 'tail-batch' or mode == 'head-batch':
             positive_score = model(positive_sample, mode='single')
@@ -652,6 +673,12 @@ class KGEModel(nn.Module):
             else:
                 negative_head_score = F.logsigmoid(-negative_head_score).mean(dim = 1)
                 negative_tail_score = F.logsigmoid(-negative_tail_score).mean(dim = 1)
+            if isinstance(positive_sample, GraphProgram):
+                # one loss term per graph: the sum over its corrupted-leaf graphs, or their mean with uni_weight
+                negative_head_score = torch.zeros_like(negative_tail_score).index_add_(
+                    0, positive_sample.corrupted_graphs, negative_head_score)
+                if args.uni_weight:
+                    negative_head_score = negative_head_score / positive_sample.corrupted_counts
 
 
         positive_score = F.logsigmoid(positive_score).squeeze(dim = 1)
@@ -691,7 +718,9 @@ class KGEModel(nn.Module):
             **regularization_log,
             'positive_sample_loss': positive_sample_loss.detach(),
             'negative_sample_loss': negative_sample_loss.detach(),
-            'loss': loss.detach()
+            'loss': loss.detach(),
+            'data_time': data_time,
+            'compute_time': time.time() - start - data_time
         }
 
         return log
@@ -736,8 +765,8 @@ class KGEModel(nn.Module):
                 'head-batch'
             ),
             batch_size=args.test_batch_size,
-            num_workers=0,#max(1, args.cpu_num//2),
-            collate_fn=TestDataset.collate_fn
+            collate_fn=TestDataset.collate_fn,
+            **worker_options(args.num_workers, args.prefetch, persistent=False)
         )
 
         triple_test_dataloader_tail = DataLoader(
@@ -749,8 +778,8 @@ class KGEModel(nn.Module):
                 'tail-batch'
             ),
             batch_size=args.test_batch_size,
-            num_workers=0,#max(1, args.cpu_num//2),
-            collate_fn=TestDataset.collate_fn
+            collate_fn=TestDataset.collate_fn,
+            **worker_options(args.num_workers, args.prefetch, persistent=False)
         )
 
         graph_test_dataloader_tail = DataLoader(
@@ -761,8 +790,8 @@ class KGEModel(nn.Module):
                         'graph-tail-batch'),
             batch_size=1,#args.batch_size,
             shuffle=True,
-            num_workers=0,#max(1, args.cpu_num//2),
-            collate_fn=TestGraphDataset.collate_fn)
+            collate_fn=TestGraphDataset.collate_fn,
+            **worker_options(args.num_workers, args.prefetch, persistent=False))
 
         # TODO BIG TODO
         triple_test_dataset_list = [triple_test_dataloader_head, triple_test_dataloader_tail]
@@ -776,9 +805,8 @@ class KGEModel(nn.Module):
         with torch.no_grad():
             for datasets in [graph_test_dataset_list]:#[triple_test_dataset_list]:#, triple_test_dataset_list]:
                 for test_dataset in datasets:
-                    for positive_sample,\
-                        negative_sample,\
-                        filter_bias, mode in test_dataset:
+                    for data in test_dataset:
+                        positive_sample, negative_sample, filter_bias, mode = batch_to_device(data, model.device)
 
                         batch_size = 1
 
@@ -796,7 +824,7 @@ class KGEModel(nn.Module):
                         elif mode == 'tail-batch':
                             positive_arg = positive_sample[:, 2]
                         elif mode == 'graph-tail-batch':
-                            positive_arg = positive_sample[1]
+                            positive_arg = positive_sample.tails
                         else:
                             raise ValueError('mode %s not supported' % mode)
 
@@ -26,9 +26,11 @@ from __future__ import division
 from __future__ import print_function
 
 import argparse
+import copy
 import json
 import logging
 import os
+import time
 
 import numpy as np
 import torch
@@ -38,7 +40,8 @@ from torch.utils.data import DataLoader
 from model import KGEModel
 
 from dataloader import TrainDataset, TrainGraphDataset, PathTrainGraphDataset
-from dataloader import OneShotIterator, BidirectionalOneShotIterator
+from dataloader import OneShotIterator, BidirectionalOneShotIterator, GraphSplit
+from dataloader import worker_options
 from eatpim.utils import path
 from frozendict import frozendict
 
@@ -77,12 +80,27 @@ def parse_args(args=None):
     parser.add_argument("-dr", "--double_relation_embedding", action="store_true")
 
     parser.add_argument("-n", "--negative_sample_size", default=2048, type=int)
+    parser.add_argument(
+        "--seed", default=None, type=int, help="seed of the negative samplers"
+    )
     parser.add_argument("-d", "--hidden_dim", default=200, type=int)
     parser.add_argument("-g", "--gamma", default=24.0, type=float)
     parser.add_argument("-adv", "--negative_adversarial_sampling", action="store_true")
     parser.add_argument("-a", "--adversarial_temperature", default=1.0, type=float)
     parser.add_argument("-b", "--batch_size", default=1024, type=int)
     parser.add_argument("--train_triples_every_n", default=100, type=int)
+    parser.add_argument(
+        "--graph_batch_size",
+        default=1,
+        type=int,
+        help="graphs per graph training step",
+    )
+    parser.add_argument(
+        "--benchmark_graph_steps",
+        default=0,
+        type=int,
+        help="before training, log the graphs/sec of this many graph training steps",
+    )
     parser.add_argument("-r", "--regularization", default=0.0, type=float)
     parser.add_argument(
         "--test_batch_size", default=4, type=int, help="valid/test batch size"
@@ -95,6 +113,18 @@ def parse_args(args=None):
 
     parser.add_argument("-lr", "--learning_rate", default=0.0001, type=float)
     parser.add_argument("-cpu", "--cpu_num", default=1, type=int)
+    parser.add_argument(
+        "--num_workers",
+        default=0,
+        type=int,
+        help="DataLoader worker processes building batches, 0 builds them in the training process",
+    )
+    parser.add_argument(
+        "--prefetch",
+        default=2,
+        type=int,
+        help="batches every DataLoader worker prepares ahead of the training loop",
+    )
     parser.add_argument("-init", "--init_checkpoint", default=None, type=str)
     parser.add_argument("-save", "--save_path", default=None, type=str)
     parser.add_argument("--max_steps", default=100000, type=int)
@@ -175,7 +205,8 @@ def read_triple(file_path, entity2id, relation2id):
 
 def read_graphs(file_path, entity2id, relation2id):
     """
-    Read graphs and map them into ids.
+    Read graphs and map them into ids. The operation trees are compiled once into the flat
+    arrays of a GraphSplit.
     """
 
     def content_to_ids(input_dict):
@@ -198,7 +229,7 @@ def read_graphs(file_path, entity2id, relation2id):
             # the key is the output recipe node, the value is the dictionary representation of the flowgraph
             for k, v in graph_dict.items():
                 graphs.append((content_to_ids(v), entity2id[str(k)]))
-    return graphs
+    return GraphSplit(graphs)
 
 
 def read_triple_pathlengths(file_path, entity2id, relation2id):
@@ -224,6 +255,33 @@ def read_triple_pathlengths(file_path, entity2id, relation2id):
     return triples
 
 
+def benchmark_graph_training(kge_model, graph_dataloaders, args):
+    """
+    Time graph training steps of every graph data loader on a copy of the model and log
+    the graphs/sec of each, keyed by graphs per step.
+    """
+    for batch_size, dataloader in graph_dataloaders.items():
+        model = copy.deepcopy(kge_model)
+        optimizer = torch.optim.Adam(
+            filter(lambda p: p.requires_grad, model.parameters()),
+            lr=args.learning_rate,
+        )
+        iterator = OneShotIterator(dataloader)
+        data_time = 0.0
+        start = time.time()
+        for _ in range(args.benchmark_graph_steps):
+            data_time += model.train_step(model, optimizer, iterator, args)["data_time"]
+        elapsed = time.time() - start
+        logging.info(
+            "%d graphs per step: %.1f graphs/sec, %.0f%% of the time waiting for data"
+            % (
+                batch_size,
+                args.benchmark_graph_steps * batch_size / elapsed,
+                100 * data_time / elapsed,
+            )
+        )
+
+
 def set_logger(args):
     """
     Write logs to checkpoint and console
@@ -353,7 +411,7 @@ def main(args):
     #         # curr_content.extend(v)
     #         # all_true_triples[k] = curr_content
     #         all_true_triples.extend(v)
-    all_true_graphs = train_graphs + valid_graphs + test_graphs
+    all_true_graphs = train_graphs.graphs + valid_graphs.graphs + test_graphs.graphs
     all_true_triples = train_triples + valid_triples + test_triples
 
     kge_model = KGEModel(
@@ -380,62 +438,79 @@ def main(args):
 
     if args.do_train:
         # Set training dataloader iterator
+        # every dataset draws its negatives from its own stream of the seed
+        triple_train_dataset_head = TrainDataset(
+            train_triples,
+            nentity,
+            nrelation,
+            args.negative_sample_size,
+            "head-batch",
+            seed=None if args.seed is None else [args.seed, 0],
+        )
         triple_train_dataloader_head = DataLoader(
-            TrainDataset(
-                train_triples,
-                nentity,
-                nrelation,
-                args.negative_sample_size,
-                "head-batch",
-            ),
+            triple_train_dataset_head,
             batch_size=args.batch_size,
             shuffle=True,
-            num_workers=0,  # max(1, args.cpu_num//2),
-            collate_fn=TrainDataset.collate_fn,
+            collate_fn=triple_train_dataset_head.collate_fn,
+            **worker_options(args.num_workers, args.prefetch),
+        )
+        triple_train_dataset_tail = TrainDataset(
+            train_triples,
+            nentity,
+            nrelation,
+            args.negative_sample_size,
+            "tail-batch",
+            seed=None if args.seed is None else [args.seed, 1],
         )
         triple_train_dataloader_tail = DataLoader(
-            TrainDataset(
-                train_triples,
-                nentity,
-                nrelation,
-                args.negative_sample_size,
-                "tail-batch",
-            ),
+            triple_train_dataset_tail,
             batch_size=args.batch_size,
             shuffle=True,
-            num_workers=0,  # max(1, args.cpu_num//2),
-            collate_fn=TrainDataset.collate_fn,
+            collate_fn=triple_train_dataset_tail.collate_fn,
+            **worker_options(args.num_workers, args.prefetch),
         )
 
-        graph_train_dataloader_tail = DataLoader(
-            TrainGraphDataset(
-                train_graphs,
-                nentity,
-                nrelation,
-                args.negative_sample_size * 8,
-                "graph-tail-batch",
-                ingredient_ids=ingredient_ids,
-            ),  # tail-batch
-            batch_size=1,  # args.batch_size,
-            shuffle=True,
-            num_workers=0,  # max(1, args.cpu_num//2),
-            collate_fn=TrainGraphDataset.collate_fn,
-        )
+        graph_train_dataset = TrainGraphDataset(
+            train_graphs,
+            nentity,
+            nrelation,
+            args.negative_sample_size * 8,
+            "graph-tail-batch",
+            ingredient_ids=ingredient_ids,
+            seed=None if args.seed is None else [args.seed, 2],
+        )  # tail-batch
+        # graph batches are compiled into a single GraphProgram, keyed by graphs per step
+        graph_train_dataloaders = {
+            batch_size: DataLoader(
+                graph_train_dataset,
+                batch_size=batch_size,
+                shuffle=True,
+                collate_fn=graph_train_dataset.collate_fn,
+                **worker_options(args.num_workers, args.prefetch),
+            )
+            for batch_size in sorted(
+                {args.graph_batch_size, 1}
+                if args.benchmark_graph_steps
+                else {args.graph_batch_size}
+            )
+        }
 
         # logging.info("Training path-based TransE experiment...")
-        # graph_train_dataloader_tail = DataLoader(
-        #     PathTrainGraphDataset(train_graphs, nentity, nrelation,
+        # path_train_dataset = PathTrainGraphDataset(train_graphs, nentity, nrelation,
         #                       args.negative_sample_size*8,
         #                       'graph-tail-batch',
-        #                       ingredient_ids=ingredient_ids), # tail-batch
+        #                       ingredient_ids=ingredient_ids) # tail-batch
+        # graph_train_dataloader_tail = DataLoader(
+        #     path_train_dataset,
         #     batch_size=1,#args.batch_size,
         #     shuffle=True,
-        #     num_workers=0,#max(1, args.cpu_num//2),
-        #     collate_fn=PathTrainGraphDataset.collate_fn
+        #     **worker_options(args.num_workers, args.prefetch),
+        #     collate_fn=path_train_dataset.collate_fn
         # )
 
-        # TODO BIG TODO
-        graph_train_iterator = OneShotIterator(graph_train_dataloader_tail)
+        graph_train_iterator = OneShotIterator(
+            graph_train_dataloaders[args.graph_batch_size]
+        )
         triple_train_iterator = BidirectionalOneShotIterator(
             triple_train_dataloader_head, triple_train_dataloader_tail
         )
@@ -468,9 +543,13 @@ def main(args):
 
     step = init_step
 
+    if args.do_train and args.benchmark_graph_steps:
+        benchmark_graph_training(kge_model, graph_train_dataloaders, args)
+
     logging.info("Start Training...")
     logging.info("init_step = %d" % init_step)
     logging.info("batch_size = %d" % args.batch_size)
+    logging.info("graph_batch_size = %d" % args.graph_batch_size)
     logging.info(
         "negative_adversarial_sampling = %d" % args.negative_adversarial_sampling
     )
@@ -495,7 +574,7 @@ def main(args):
                 # every 100 steps, train the triples in the graph
                 # triples give data about relations among entities, as well as recipes and their
                 # nodes (recipe, hasNode, ingredient-or-equipment)
-                # the triple training also can actually use batches, while the graph training only does 1 graph at a time
+                # the triple training also uses batches, the graph training uses --graph_batch_size graphs
                 log = kge_model.train_step(
                     kge_model, optimizer, triple_train_iterator, args
                 )
@@ -0,0 +1,242 @@
+# Copyright (c) 2022 Robert Bosch GmbH
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import argparse
+import json
+import multiprocessing
+import time
+
+import numpy as np
+
+from eatpim.utils import path
+from eatpim.rank_subs_in_recipe import load_embedding_data, load_ing_cooc_matrix
+from eatpim.ranking import EmbeddingIndex, lookup_ids, masked_cosine_similarities
+from eatpim.ranking.embedding_index import top_k_rows
+from eatpim.ranking.recipe_store import RecipeStore, open_recipe_store
+from eatpim.ranking.substitution_store import SUBSTITUTION_STORE_FILE, SubstitutionStore
+
+METRICS = [
+    "calculated_output",
+    "recipe_output",
+    "ingredient_embedding",
+    "cooccurrence",
+    "recipe_cooccurrence",
+]
+WRITE_BATCH_SIZE = 64
+
+
+class SubstitutionJob:
+    """
+    Computes the top-k substitutes of every leaf ingredient of a recipe for all metrics.
+
+    Each recipe tree is compiled once and all of its leaves are scored together. The
+    recipe-independent metrics (embedding and plain co-occurrence similarity) only depend
+    on the ingredient, so they are cached per ingredient across recipes.
+    """
+
+    def __init__(self, *, calc, recipe_store, cooc_data, k):
+        self.calc = calc
+        self.recipe_store = recipe_store
+        self.ing_to_index, _, cooc_matrix, occurrences = cooc_data
+        self.cooc_matrix = cooc_matrix.tocsr().astype(np.float64)
+        self.occurrences = np.asarray(occurrences).reshape(-1)
+        self.k = k
+        # candidates in the co-occurrence matrix order, so every metric shares one axis.
+        # ingredients without an embedding can be neither scored nor recommended
+        self.candidates = [
+            ing
+            for ing in sorted(self.ing_to_index, key=self.ing_to_index.get)
+            if ing in calc.entity2id
+        ]
+        self.candidate_rows = np.array(
+            [self.ing_to_index[ing] for ing in self.candidates], dtype=np.int64
+        )
+        self.candidate_embs = calc.ent_embs[
+            lookup_ids(calc.entity2id, self.candidates)
+        ].astype(np.float64)
+        self.embedding_index = EmbeddingIndex(self.candidate_embs, self.candidates)
+        self.cooc_norms = np.sqrt(
+            np.asarray(self.cooc_matrix.multiply(self.cooc_matrix).sum(axis=1)).reshape(
+                -1
+            )
+        )
+        self.candidate_cooc_matrix = self.cooc_matrix[self.candidate_rows]
+        self.ingredient_cache = dict()
+
+    def _top_k(self, scores):
+        rows = top_k_rows(scores, self.k)
+        return [
+            [(self.candidates[i], float(s[i])) for i in row]
+            for row, s in zip(rows, np.atleast_2d(scores))
+        ]
+
+    def _ingredient_results(self, ingredient):
+        if ingredient not in self.ingredient_cache:
+            target_idx = self.ing_to_index[ingredient]
+            cooc_sims = np.zeros(len(self.candidates))
+            denom = self.cooc_norms[self.candidate_rows] * self.cooc_norms[target_idx]
+            np.divide(
+                (self.candidate_cooc_matrix @ self.cooc_matrix[target_idx].T)
+                .toarray()
+                .reshape(-1),
+                denom,
+                out=cooc_sims,
+                where=denom > 0,
+            )
+            embedding_sims = self.embedding_index.similarities(
+                self.calc.ent_embs[self.calc.entity2id[ingredient]]
+            )
+            embedding_top, cooc_top = self._top_k(np.stack([embedding_sims, cooc_sims]))
+            self.ingredient_cache[ingredient] = {
+                "ingredient_embedding": embedding_top,
+                "cooccurrence": cooc_top,
+            }
+        return self.ingredient_cache[ingredient]
+
+    def run_recipe(self, output_node):
+        recipe = self.recipe_store.get(output_node)
+        leaves = sorted(
+            ing
+            for ing in recipe.leaves
+            if ing in self.ing_to_index and ing in self.calc.entity2id
+        )
+        results = dict()
+        if not leaves or recipe.ops is None:
+            return output_node, results
+
+        operation_sims = self.calc.leaf_operation_sims(
+            target_recipe=output_node,
+            recipe_ops=recipe.ops,
+            replace_ings=leaves,
+            candidate_embs=self.candidate_embs,
+        )
+        recipe_cooc_sims = masked_cosine_similarities(
+            self.cooc_matrix,
+            self.occurrences,
+            [
+                self.ing_to_index[ing]
+                for ing in recipe.leaves
+                if ing in self.ing_to_index
+            ],
+            [self.ing_to_index[ing] for ing in leaves],
+            row_indices=self.candidate_rows,
+        )
+        calculated_top = self._top_k(operation_sims[:, 0])
+        recipe_top = self._top_k(operation_sims[:, 1])
+        recipe_cooc_top = self._top_k(recipe_cooc_sims)
+        for i, ing in enumerate(leaves):
+            results[(ing, "calculated_output")] = calculated_top[i]
+            results[(ing, "recipe_output")] = recipe_top[i]
+            results[(ing, "recipe_cooccurrence")] = recipe_cooc_top[i]
+            for metric, top in self._ingredient_results(ing).items():
+                results[(ing, metric)] = top
+        return output_node, results
+
+
+# set in every worker process by _init_worker; forked workers inherit the embeddings and
+# co-occurrence data from the parent instead of loading them again
+_worker_job = None
+
+
+def _init_worker(job):
+    global _worker_job
+    # SQLite connections must not be shared across a fork
+    job.recipe_store = RecipeStore(job.recipe_store.db_file)
+    _worker_job = job
+
+
+def _run_recipe(output_node):
+    return _worker_job.run_recipe(output_node)
+
+
+def main(*, main_dir, model_dir, k, processes, limit=None):
+    with open((main_dir / "ingredient_list.json").resolve(), "r") as f:
+        ingredient_list = json.load(f)
+
+    calc = load_embedding_data(main_dir, model_dir)
+    recipe_store = open_recipe_store(main_dir, ingredient_list)
+    ingredients = sorted(recipe_store.leaf_occurrences())
+    cooc_data = load_ing_cooc_matrix(main_dir, ingredients, recipe_store)
+
+    output_store = SubstitutionStore(main_dir / model_dir / SUBSTITUTION_STORE_FILE)
+    output_store.check_settings({"k": k, "metrics": METRICS})
+    completed = output_store.completed_recipes()
+    pending = [r for r in recipe_store.output_nodes() if r not in completed]
+    if limit is not None:
+        pending = pending[:limit]
+    print(f"{len(completed)} recipes already computed, {len(pending)} to go")
+
+    job = SubstitutionJob(
+        calc=calc,
+        recipe_store=recipe_store,
+        cooc_data=cooc_data,
+        k=k,
+    )
+    start = time.time()
+    if processes > 1:
+        pool = multiprocessing.get_context("fork").Pool(
+            processes, initializer=_init_worker, initargs=(job,)
+        )
+        results = pool.imap_unordered(_run_recipe, pending, chunksize=16)
+    else:
+        pool = None
+        results = map(job.run_recipe, pending)
+
+    # the parent is the only writer, which keeps SQLite free of lock contention. results
+    # are committed in batches, each recipe atomically with its completion marker
+    batch = []
+    try:
+        for progress, recipe_results in enumerate(results, start=1):
+            batch.append(recipe_results)
+            if len(batch) == WRITE_BATCH_SIZE:
+                output_store.write_recipes(batch)
+                batch = []
+            if progress % 1000 == 0:
+                elapsed = time.time() - start
+                print(
+                    f"progress: {progress}/{len(pending)}, "
+                    f"{progress / elapsed:.1f} recipes/s"
+                )
+    finally:
+        output_store.write_recipes(batch)
+        if pool is not None:
+            pool.terminate()
+        output_store.close()
+    print(f"finished in {time.time() - start:.1f}s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Precompute the top-k substitutes of every ingredient in every recipe"
+    )
+    parser.add_argument("--data_dir", type=str, required=True)
+    parser.add_argument("--model_dir", type=str, required=True)
+    parser.add_argument("--k", type=int, default=20)
+    parser.add_argument("--n_cpu", type=int, default=1)
+    parser.add_argument(
+        "--limit",
+        type=int,
+        default=None,
+        help="only compute this many of the remaining recipes",
+    )
+    args = parser.parse_args()
+
+    main(
+        main_dir=(path.DATA_DIR / args.data_dir).resolve(),
+        model_dir=args.model_dir,
+        k=args.k,
+        processes=args.n_cpu,
+        limit=args.limit,
+    )
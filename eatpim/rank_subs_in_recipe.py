@@ -25,27 +25,69 @@ from collections import defaultdict
 import networkx as nx
 from sklearn.model_selection import train_test_split
 import rdflib
-from scipy.sparse import dok_matrix
 import numpy as np
 import time
 import random
 import matplotlib.pyplot as plt
 from sklearn.metrics.pairwise import cosine_similarity
 from frozendict import frozendict
+from eatpim.ranking import (
+    TransESubstitution,
+    CandidateAxisEvaluator,
+    batch_cosine_similarities,
+    joint_substitution_search,
+    build_cooccurrence_matrix,
+    masked_cosine_similarities,
+    EmbeddingIndex,
+    Vocabulary,
+    load_embeddings,
+    load_model_config,
+    load_vocabulary,
+    lookup_ids,
+)
+from eatpim.ranking.recipe_store import RecipeStore, open_recipe_store
+
+# graph operators without a TransE closed form, evaluated with a candidate axis instead
+CANDIDATE_AXIS_MODELS = {"DistMult", "RotatE"}
+
+
+def inverse_mapping(name2id):
+    if isinstance(name2id, Vocabulary):
+        return name2id.inverse()
+    return {v: k for k, v in name2id.items()}
 
 
 class FGCalculator:
-    def __init__(self, ent_embs, entity2id, rel_embs, relation2id):
+    def __init__(
+        self,
+        ent_embs,
+        entity2id,
+        rel_embs,
+        relation2id,
+        model_name="TransE",
+        embedding_range=None,
+    ):
         self.ent_embs = ent_embs
         self.entity2id = entity2id
-        self.id2entity = dict()
-        for k, v in self.entity2id.items():
-            self.id2entity[v] = k
+        self.id2entity = inverse_mapping(entity2id)
         self.rel_embs = rel_embs
         self.relation2id = relation2id
-        self.id2relation = dict()
-        for k, v in self.relation2id.items():
-            self.id2relation[v] = k
+        self.id2relation = inverse_mapping(relation2id)
+        if model_name not in CANDIDATE_AXIS_MODELS:
+            # every other model, PathTransE included, is scored with the TransE closed form
+            model_name = "TransE"
+        self.model_name = model_name
+        self.ingredient_indexes = dict()
+        self.evaluator = None
+        if model_name in CANDIDATE_AXIS_MODELS:
+            self.evaluator = CandidateAxisEvaluator(
+                ent_embs=ent_embs,
+                entity2id=entity2id,
+                rel_embs=rel_embs,
+                relation2id=relation2id,
+                model_name=model_name,
+                embedding_range=embedding_range,
+            )
 
     def GOpTranseCalcOperation(self, *, ops, rem_ing, rep_ing=None):
         if isinstance(ops, frozendict) or isinstance(ops, dict):
@@ -77,45 +119,154 @@ class FGCalculator:
 
         return stacked_score
 
+    def compile_substitution(self, *, recipe_ops, replace_ing):
+        return TransESubstitution.compile(
+            ops=recipe_ops,
+            rem_ing=replace_ing,
+            ent_embs=self.ent_embs,
+            entity2id=self.entity2id,
+            rel_embs=self.rel_embs,
+            relation2id=self.relation2id,
+        )
+
     def ingredient_operation_sim(
         self, *, target_recipe, recipe_ops, replace_ing, ing_list
     ):
-        original_calc_vec = self.GOpTranseCalcOperation(
-            ops=recipe_ops, rem_ing=replace_ing
-        )
+        ing_list = list(ing_list)
+        candidate_embs = self.ent_embs[lookup_ids(self.entity2id, ing_list)]
+        # TransE trees are compiled once into their closed form and every candidate is
+        # scored in a single matrix operation; non-affine operators carry a candidate axis
+        # through one bottom-up pass
+        calculated_sim, original_sim = self.leaf_operation_sims(
+            target_recipe=target_recipe,
+            recipe_ops=recipe_ops,
+            replace_ings=[replace_ing],
+            candidate_embs=candidate_embs,
+        )[0]
+
+        sorted_sim_to_calc = [
+            (ing_list[i], calculated_sim[i])
+            for i in np.argsort(-calculated_sim, kind="stable")
+        ]
+        sorted_sim_to_og = [
+            (ing_list[i], original_sim[i])
+            for i in np.argsort(-original_sim, kind="stable")
+        ]
+        return sorted_sim_to_calc, sorted_sim_to_og
+
+    def leaf_operation_sims(
+        self, *, target_recipe, recipe_ops, replace_ings, candidate_embs
+    ):
+        """
+        Similarity of every candidate's calculated output to the original calculated output
+        and to the recipe's learned embedding, for each ingredient in `replace_ings`.
+        Returns an array of shape (len(replace_ings), 2, n_candidates).
+        """
         original_recipe_vec = self.ent_embs[self.entity2id[target_recipe]]
-        calculated_sim = dict()
-        original_sim = dict()
-        for ing in ing_list:
-            calc_recipe_vec = self.GOpTranseCalcOperation(
-                ops=recipe_ops, rem_ing=replace_ing, rep_ing=ing
+        if self.model_name == "TransE":
+            substitutions = TransESubstitution.compile_leaves(
+                ops=recipe_ops,
+                ent_embs=self.ent_embs,
+                entity2id=self.entity2id,
+                rel_embs=self.rel_embs,
+                relation2id=self.relation2id,
+            )
+            base = next(iter(substitutions.values())).base
+            selected = TransESubstitution.for_ingredients(
+                substitutions, replace_ings, self.ent_embs, self.entity2id
+            )
+            return batch_cosine_similarities(
+                selected, candidate_embs, [base, original_recipe_vec]
             )
 
-            calculated_sim[ing] = cosine_similarity(
-                original_calc_vec.reshape(1, -1), calc_recipe_vec.reshape(1, -1)
-            )[0][0]
-            original_sim[ing] = cosine_similarity(
-                original_recipe_vec.reshape(1, -1), calc_recipe_vec.reshape(1, -1)
-            )[0][0]
+        original_calc_vec = self.evaluator.calculate(ops=recipe_ops)
+        return np.stack(
+            [
+                self.evaluator.cosine_similarities(
+                    ops=recipe_ops,
+                    rem_ing=ing,
+                    candidate_embs=candidate_embs,
+                    targets=[original_calc_vec, original_recipe_vec],
+                )
+                for ing in replace_ings
+            ]
+        )
 
-        sorted_sim_to_calc = sorted(
-            calculated_sim.items(), key=lambda x: x[1], reverse=True
+    def joint_substitutions(
+        self,
+        *,
+        target_recipe,
+        recipe_ops,
+        replace_ings,
+        ing_list,
+        k=10,
+        beam_width=64,
+        candidates_per_leaf=None,
+        use_recipe_embedding=False,
+    ):
+        """
+        Top-k joint replacements of all ingredients in `replace_ings`, ranked by the
+        similarity of the calculated output to the original calculated output (or to the
+        recipe's learned embedding with `use_recipe_embedding`). Returns a best-first list
+        of (replacements, score), where replacements is a tuple aligned with `replace_ings`,
+        and the number of partial replacements that were evaluated.
+        """
+        if self.model_name != "TransE":
+            raise ValueError(
+                "joint substitution relies on the TransE closed form, not %s"
+                % self.model_name
+            )
+        ing_list = list(ing_list)
+        candidate_embs = self.ent_embs[lookup_ids(self.entity2id, ing_list)]
+        substitutions = TransESubstitution.compile_leaves(
+            ops=recipe_ops,
+            ent_embs=self.ent_embs,
+            entity2id=self.entity2id,
+            rel_embs=self.rel_embs,
+            relation2id=self.relation2id,
         )
-        sorted_sim_to_og = sorted(
-            original_sim.items(), key=lambda x: x[1], reverse=True
+        base = next(iter(substitutions.values())).base
+        selected = TransESubstitution.for_ingredients(
+            substitutions, replace_ings, self.ent_embs, self.entity2id
         )
-        return sorted_sim_to_calc, sorted_sim_to_og
+        if use_recipe_embedding:
+            target = self.ent_embs[self.entity2id[target_recipe]]
+        else:
+            target = base
+        ing_positions = {ing: i for i, ing in enumerate(ing_list)}
+        result = joint_substitution_search(
+            selected,
+            candidate_embs,
+            target,
+            k=k,
+            beam_width=beam_width,
+            candidates_per_leaf=candidates_per_leaf,
+            # replacing an ingredient with itself or another replaced ingredient is no swap
+            excluded=[
+                ing_positions[ing] for ing in replace_ings if ing in ing_positions
+            ],
+        )
+        joint = [
+            (tuple(ing_list[i] for i in row), float(score))
+            for row, score in zip(result.candidates, result.scores)
+        ]
+        return joint, result.evaluated
+
+    def ingredient_index(self, ing_set):
+        # restricting the index to the ingredients keeps FoodOn classes and recipe outputs
+        # out of every similarity query
+        key = frozenset(ing_set)
+        if key not in self.ingredient_indexes:
+            self.ingredient_indexes[key] = EmbeddingIndex.from_entities(
+                self.ent_embs, self.entity2id, sorted(key, key=self.entity2id.get)
+            )
+        return self.ingredient_indexes[key]
 
-    def ingredient_sim(self, *, target_ing, ing_set):
+    def ingredient_sim(self, *, target_ing, ing_set, k=None):
+        index = self.ingredient_index(ing_set)
         target_ing_emb = self.ent_embs[self.entity2id[target_ing]]
-        sims = cosine_similarity(target_ing_emb.reshape(1, -1), self.ent_embs)[0]
-        print(sims.shape)
-        sim_dict = dict()
-        for i in range(sims.shape[0]):
-            if self.id2entity[i] in ing_set:
-                sim_dict[self.id2entity[i]] = sims[i]
-        sorted_sim = sorted(sim_dict.items(), key=lambda x: x[1], reverse=True)
-        return sorted_sim
+        rows, sims = index.top_k(target_ing_emb, k or len(index))
+        return [(index.names[r], s) for r, s in zip(rows[0], sims[0])]
 
 
 def get_ing_cooc_cosine_sims(target_ing, ing_to_index, cooc_matrix):
@@ -127,18 +278,12 @@ def get_ing_cooc_cosine_sims(target_ing, ing_to_index, cooc_matrix):
 def get_prob_ing_exists_with_recipe(
     *, target_ing, ing_to_index, cooc_matrix, recipe_ingredients, ing_total_occ_arr
 ):
-    prob_matrix = (cooc_matrix / ing_total_occ_arr).toarray()
-    total_ings = prob_matrix.shape[0]
-
-    indices = np.zeros(total_ings)
-    for ing in recipe_ingredients:
-        indices[ing_to_index[ing]] = 1
-    prob_matrix *= indices
-
-    prob_sim = cosine_similarity(
-        prob_matrix[ing_to_index[target_ing]].reshape(1, -1), prob_matrix
-    )[0]
-    return prob_sim
+    return masked_cosine_similarities(
+        cooc_matrix,
+        ing_total_occ_arr,
+        [ing_to_index[ing] for ing in recipe_ingredients],
+        ing_to_index[target_ing],
+    )
 
 
 def simple_visualize(G):
@@ -158,97 +303,55 @@ def simple_visualize(G):
 
 def main(
     *,
-    input_file: Path,
     main_dir: Path,
-    valid_ingredient_list: List,
+    recipe_store: RecipeStore,
     kge_calc: FGCalculator,
-    recipe_operations,
     target_recipe: str,
     target_ing: str,
 ):
-    valid_ingredient_set = set(valid_ingredient_list)
-    all_ingredients = set()
-    leaf_ocurrence_count = defaultdict(lambda: 0)
-    recipe_leafs = {}
-    with open(input_file, "r") as f:
-        recipe_data = json.load(f)
-    graphs = {}
-    start = time.time()
-
-    recipe_intermediatenode_count = {}
-    for recipe, data in recipe_data.items():
-        nodecount = 0
-        G = nx.DiGraph()
-        for e in data["edges"]:
-            G.add_edge(e[0], e[1])
-        graphs[data["output_node"]] = G
-        recipe_leafs[data["output_node"]] = set()
-        for node in G.nodes():
-            if node in valid_ingredient_set:
-                all_ingredients.add(node)
-                recipe_leafs[data["output_node"]].add(node)
-                leaf_ocurrence_count[node] += 1
-            elif node != data["output_node"]:
-                nodecount += 1
-        recipe_intermediatenode_count[data["output_node"]] = nodecount
-
-    print(f"{len(graphs)} graphs loaded")
+    # only the target recipe is read from the store; corpus-wide counts were precomputed
+    # when the store was built
+    leaf_ocurrence_count = recipe_store.leaf_occurrences()
+    all_ingredients = set(leaf_ocurrence_count.keys())
+
+    print(f"{len(recipe_store)} graphs loaded")
     print(f"{len(all_ingredients)} distinct leaf nodes")
     print("")
-    all_ingredients_list = list(all_ingredients)
+    all_ingredients_list = sorted(all_ingredients)
 
-    occ_matrix_files = (main_dir / "ing_occ_data.pkl").resolve()
-    if occ_matrix_files.is_file():
-        print("loading co-occ counts")
-        with open(occ_matrix_files, "rb") as f:
-            matrix_data = pickle.load(f)
-        ing_to_index = matrix_data["ing_to_index"]
-        index_to_ing = matrix_data["index_to_ing"]
-        ing_cooc_matrix = matrix_data["ing_cooc_matrix"]
-        ing_total_occ_count_arr = matrix_data["ing_total_occ_count_arr"]
-    else:
-        (
-            ing_to_index,
-            index_to_ing,
-            ing_cooc_matrix,
-            ing_total_occ_count_arr,
-        ) = compute_ing_cooc_matrix(
-            all_ingredients_list, recipe_leafs, leaf_ocurrence_count
-        )
-        matrix_data = {
-            "ing_to_index": ing_to_index,
-            "index_to_ing": index_to_ing,
-            "ing_cooc_matrix": ing_cooc_matrix,
-            "ing_total_occ_count_arr": ing_total_occ_count_arr,
-        }
-        with open(occ_matrix_files, "wb") as f:
-            pickle.dump(matrix_data, f)
+    (
+        ing_to_index,
+        index_to_ing,
+        ing_cooc_matrix,
+        ing_total_occ_count_arr,
+    ) = load_ing_cooc_matrix(main_dir, all_ingredients_list, recipe_store)
 
     if target_recipe == "":
-        target_recipe_output = random.choice(list(graphs.keys()))
+        target_recipe_output = recipe_store.output_node_at(
+            random.randrange(len(recipe_store))
+        )
     else:
         target_recipe = f"RECIPE_OUTPUT_{target_recipe}"
-        if target_recipe in graphs.keys():
+        if target_recipe in recipe_store:
             target_recipe_output = target_recipe
         else:
             print("The recipe you specified is not contained in the data.")
             return
-        if target_ing != "":
-            if target_ing in recipe_leafs[target_recipe_output]:
-                target_replace_ing = target_ing
-            else:
-                print(
-                    "The replacement ingredient you specified is not contained in the recipe"
-                )
-                return
-    if target_ing == "":
-        target_replace_ing = random.choice(list(recipe_leafs[target_recipe_output]))
+    recipe = recipe_store.get(target_recipe_output)
+    if target_ing != "":
+        if target_ing in recipe.leaves:
+            target_replace_ing = target_ing
+        else:
+            print(
+                "The replacement ingredient you specified is not contained in the recipe"
+            )
+            return
+    else:
+        target_replace_ing = random.choice(sorted(recipe.leaves))
 
     print(f"recipe choice: {target_recipe_output}, replacing {target_replace_ing}")
-    print(
-        f"number of intermediate nodes: {recipe_intermediatenode_count[target_recipe_output]}"
-    )
-    target_recipe_graph = graphs[target_recipe_output]
+    print(f"number of intermediate nodes: {recipe.intermediate_node_count}")
+    target_recipe_graph = recipe.graph()
     simple_visualize(target_recipe_graph)
 
     t1sim = get_ing_cooc_cosine_sims(
@@ -267,7 +370,7 @@ def main(
         ing_to_index=ing_to_index,
         cooc_matrix=ing_cooc_matrix,
         ing_total_occ_arr=ing_total_occ_count_arr,
-        recipe_ingredients=recipe_leafs[target_recipe_output],
+        recipe_ingredients=recipe.leaves,
     )
     top_sims2 = np.argsort(t2sim)[::-1]
     print("")
@@ -277,14 +380,10 @@ def main(
     for i in top_sims2[:10]:
         print(index_to_ing[i], t2sim[i])
 
-    target_actions_in_recipe = set()
-    for n in nx.dfs_successors(target_recipe_graph, target_replace_ing):
-        if n == target_replace_ing:
-            continue
-        action_name = n.split("_")[1]
-        target_actions_in_recipe.add(action_name)
+    # precomputed when the recipe store was built
+    target_actions_in_recipe = recipe.leaf_actions[target_replace_ing]
 
-    recipe_ops = recipe_operations[target_recipe_output]
+    recipe_ops = recipe.ops
     calc_sim, og_sim = kge_calc.ingredient_operation_sim(
         target_recipe=target_recipe_output,
         recipe_ops=recipe_ops,
@@ -292,7 +391,7 @@ def main(
         ing_list=all_ingredients_list,
     )
     ing_sim = kge_calc.ingredient_sim(
-        target_ing=target_replace_ing, ing_set=all_ingredients
+        target_ing=target_replace_ing, ing_set=all_ingredients, k=20
     )
     print("")
     print(
@@ -342,28 +441,23 @@ def main(
 
 
 def load_embedding_data(main_dir, model_dir) -> FGCalculator:
-    ent_embs = np.load((main_dir / model_dir / "entity_embedding.npy").resolve())
-    rel_embs = np.load((main_dir / model_dir / "relation_embedding.npy").resolve())
-
-    with open((main_dir / "triple_data/entities.dict").resolve()) as fin:
-        id2entity = dict()
-        entity2id = dict()
-        for line in fin:
-            eid, entity = line.strip().split("\t")
-            entity2id[entity] = int(eid)
-            id2entity[int(eid)] = entity
-
-    with open((main_dir / "triple_data/relations.dict").resolve()) as fin:
-        relation2id = dict()
-        for line in fin:
-            rid, relation = line.strip().split("\t")
-            relation2id[relation] = int(rid)
+    # embeddings are memory-mapped and the vocabularies kept as compact sorted arrays, so a
+    # single query only reads the embedding rows and vocabulary entries it actually uses
+    ent_embs, rel_embs = load_embeddings(main_dir / model_dir)
+    entity2id = load_vocabulary((main_dir / "triple_data/entities.dict").resolve())
+    relation2id = load_vocabulary((main_dir / "triple_data/relations.dict").resolve())
+
+    # models saved by run.py keep their training arguments next to the embeddings.
+    # the graph operator and RotatE's phase scaling both depend on them
+    model_name, embedding_range = load_model_config(main_dir / model_dir)
 
     calc = FGCalculator(
         ent_embs=ent_embs,
         rel_embs=rel_embs,
         entity2id=entity2id,
         relation2id=relation2id,
+        model_name=model_name,
+        embedding_range=embedding_range,
     )
     return calc
 
@@ -381,25 +475,46 @@ def content_to_ids(input_dict):
     return frozendict(output_dict)
 
 
-def compute_ing_cooc_matrix(all_ingredients_list, recipe_leafs, leaf_ocurrence_count):
+def load_ing_cooc_matrix(main_dir, all_ingredients_list, recipe_store):
+    """
+    Ingredient co-occurrence data of the corpus, cached in ing_occ_data.pkl.
+    """
+    occ_matrix_files = (main_dir / "ing_occ_data.pkl").resolve()
+    if occ_matrix_files.is_file():
+        print("loading co-occ counts")
+        with open(occ_matrix_files, "rb") as f:
+            matrix_data = pickle.load(f)
+        ing_to_index = matrix_data["ing_to_index"]
+        index_to_ing = matrix_data["index_to_ing"]
+        ing_cooc_matrix = matrix_data["ing_cooc_matrix"]
+        ing_total_occ_count_arr = matrix_data["ing_total_occ_count_arr"]
+    else:
+        (
+            ing_to_index,
+            index_to_ing,
+            ing_cooc_matrix,
+            ing_total_occ_count_arr,
+        ) = compute_ing_cooc_matrix(all_ingredients_list, recipe_store.leaf_sets())
+        matrix_data = {
+            "ing_to_index": ing_to_index,
+            "index_to_ing": index_to_ing,
+            "ing_cooc_matrix": ing_cooc_matrix,
+            "ing_total_occ_count_arr": ing_total_occ_count_arr,
+        }
+        with open(occ_matrix_files, "wb") as f:
+            pickle.dump(matrix_data, f)
+
+    return ing_to_index, index_to_ing, ing_cooc_matrix, ing_total_occ_count_arr
+
+
+def compute_ing_cooc_matrix(all_ingredients_list, recipe_leaf_sets):
     print("processing to compute ingredient co-occurence counts")
-    ing_to_index = {}
-    index_to_total_occ_count = []
-    for ing in all_ingredients_list:
-        ing_to_index[ing] = len(ing_to_index.keys())
-        index_to_total_occ_count.append(leaf_ocurrence_count[ing])
+    ing_to_index = {ing: i for i, ing in enumerate(all_ingredients_list)}
     index_to_ing = {v: k for k, v in ing_to_index.items()}
-    ing_cooc_matrix = dok_matrix(
-        (len(index_to_ing), len(index_to_ing)), dtype=np.float16
+    ing_cooc_matrix, ing_total_occ_count_arr = build_cooccurrence_matrix(
+        recipe_leaf_sets, ing_to_index
     )
-    ing_total_occ_count_arr = np.array(index_to_total_occ_count).reshape(-1, 1)
-    for recipe, ing_set in recipe_leafs.items():
-        ing_index_list = [ing_to_index[ing] for ing in ing_set]
-        for i, ing1 in enumerate(ing_index_list):
-            for ing2 in ing_index_list[i + 1 :]:
-                ing_cooc_matrix[ing1, ing2] += 1
-                ing_cooc_matrix[ing2, ing1] += 1
-    ing_cooc_matrix = ing_cooc_matrix.tocsr()
+    ing_total_occ_count_arr = ing_total_occ_count_arr.reshape(-1, 1)
 
     return ing_to_index, index_to_ing, ing_cooc_matrix, ing_total_occ_count_arr
 
@@ -415,31 +530,16 @@ if __name__ == "__main__":
     args = parser.parse_args()
 
     main_dir = (path.DATA_DIR / args.data_dir).resolve()
-    input_file = (main_dir / "recipe_tree_data.json").resolve()
-    relation_input_file = (main_dir / "entity_relations.json").resolve()
     with open((main_dir / "ingredient_list.json").resolve(), "r") as f:
         ingredient_list = json.load(f)
 
     calc = load_embedding_data(main_dir, args.model_dir)
-
-    recipe_operations = {}
-    import random
-
-    for dset in ["train.txt", "valid.txt", "test.txt"]:
-        with open((main_dir / f"triple_data/{dset}").resolve()) as fin:
-            for line in fin:
-                graph_dict = json.loads(line)
-                # there should only be one item in the first depth of this dict
-                # the key is the output recipe node, the value is the dictionary representation of the flowgraph
-                for k, v in graph_dict.items():
-                    recipe_operations[str(k)] = v  # content_to_ids(v)
+    recipe_store = open_recipe_store(main_dir, ingredient_list)
 
     main(
-        input_file=input_file,
         main_dir=main_dir,
-        valid_ingredient_list=ingredient_list,
+        recipe_store=recipe_store,
         kge_calc=calc,
-        recipe_operations=recipe_operations,
         target_recipe=args.target_recipe,
         target_ing=args.target_ingredient,
     )
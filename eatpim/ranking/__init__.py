@@ -0,0 +1,20 @@
+from .substitution import (
+    TransESubstitution,
+    CandidateAxisEvaluator,
+    batch_cosine_similarities,
+)
+from .cooccurrence import (
+    CooccurrenceBuilder,
+    build_cooccurrence_matrix,
+    masked_cosine_similarities,
+)
+from .joint import JointSearchResult, joint_substitution_search
+from .embedding_index import EmbeddingIndex
+from .ann import IVFIndex
+from .vocabulary import (
+    Vocabulary,
+    load_vocabulary,
+    lookup_ids,
+    load_embeddings,
+    load_model_config,
+)
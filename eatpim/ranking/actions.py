@@ -0,0 +1,71 @@
+# Copyright (c) 2022 Robert Bosch GmbH
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+from collections import defaultdict
+
+ACTION_PREFIX = "pred_"
+
+
+def action_name(node):
+    # action nodes are named pred_<action>_<step>_<index>
+    return node.split("_")[1]
+
+
+def leaf_downstream_actions(edges, leaves):
+    """
+    Names of the actions every leaf in `leaves` flows through on its way to the recipe
+    output, from a single pass over the flow graph `edges` in reverse topological order.
+
+    The actions below each node are kept as an integer bitset, so a node's set is the
+    union of its successors' sets and their own actions.
+
+    This intentionally differs from the keys of `nx.dfs_successors(graph, leaf)` used
+    before, which named every DFS tree node with children. Every pred_ node reachable from
+    the leaf is counted here, also when the DFS reached it through another branch of a
+    diamond first, and non-action nodes such as intermediate ingredient nodes no longer
+    contribute the second field of their name (often a step number).
+    """
+    successors = defaultdict(list)
+    in_degree = defaultdict(lambda: 0)
+    for u, v in edges:
+        successors[u].append(v)
+        in_degree[v] += 1
+        in_degree[u] += 0
+
+    order = [node for node, degree in in_degree.items() if degree == 0]
+    for node in order:
+        for succ in successors[node]:
+            in_degree[succ] -= 1
+            if in_degree[succ] == 0:
+                order.append(succ)
+    if len(order) != len(in_degree):
+        raise ValueError("the recipe flow graph contains a cycle")
+
+    action_bits = dict()
+    downstream = dict()
+    for node in reversed(order):
+        bits = 0
+        for succ in successors[node]:
+            bits |= downstream[succ]
+            if succ.startswith(ACTION_PREFIX):
+                name = action_name(succ)
+                bits |= 1 << action_bits.setdefault(name, len(action_bits))
+        downstream[node] = bits
+
+    names = list(action_bits)
+    return {
+        leaf: {names[i] for i in range(len(names)) if downstream.get(leaf, 0) >> i & 1}
+        for leaf in leaves
+    }
@@ -0,0 +1,361 @@
+# Copyright (c) 2022 Robert Bosch GmbH
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import argparse
+import time
+import warnings
+from pathlib import Path
+
+import numpy as np
+from scipy.sparse import csr_matrix
+
+from eatpim.ranking.embedding_index import normalize_rows, top_k_rows
+
+ANN_INDEX_FILE = "entity_ann_index.npz"
+ENTITY_EMBEDDING_FILE = "entity_embedding.npy"
+
+
+def _assign(data, centroids, spherical, chunk_size=65536):
+    # cosine assignment for normalized data, otherwise the euclidean argmin expressed as
+    # argmax(x.c - |c|^2 / 2) so that it stays a matrix product
+    offset = 0 if spherical else 0.5 * np.einsum("ij,ij->i", centroids, centroids)
+    assignment = np.empty(data.shape[0], dtype=np.int64)
+    for start in range(0, data.shape[0], chunk_size):
+        scores = data[start : start + chunk_size] @ centroids.T - offset
+        assignment[start : start + chunk_size] = np.argmax(scores, axis=1)
+    return assignment
+
+
+def kmeans(data, n_clusters, *, n_iter=20, spherical=False, sample_size=None, seed=0):
+    """
+    Lloyd's k-means over (a sample of) the rows of `data`. Spherical k-means keeps the
+    centroids on the unit sphere, which matches cosine similarity search.
+    """
+    rng = np.random.default_rng(seed)
+    data = np.asarray(data, dtype=np.float32)
+    if sample_size is not None and data.shape[0] > sample_size:
+        data = data[rng.choice(data.shape[0], sample_size, replace=False)]
+    n_clusters = min(n_clusters, data.shape[0])
+
+    centroids = data[rng.choice(data.shape[0], n_clusters, replace=False)].copy()
+    for _ in range(n_iter):
+        assignment = _assign(data, centroids, spherical)
+        members = csr_matrix(
+            (
+                np.ones(data.shape[0], dtype=np.float32),
+                (assignment, np.arange(data.shape[0])),
+            ),
+            shape=(n_clusters, data.shape[0]),
+        )
+        sums = np.asarray(members @ data)
+        counts = np.bincount(assignment, minlength=n_clusters)
+
+        empty = counts == 0
+        sums[empty] = data[rng.choice(data.shape[0], int(empty.sum()))]
+        counts[empty] = 1
+        if spherical:
+            centroids = normalize_rows(sums)
+        else:
+            centroids = sums / counts[:, None]
+    return centroids.astype(np.float32)
+
+
+class IVFIndex:
+    """
+    Inverted-file approximate nearest neighbour index for cosine similarity.
+
+    Normalized embeddings are partitioned by spherical k-means into `n_lists` inverted
+    lists, stored contiguously in list order. A query only scores the members of its
+    `n_probe` closest lists. With product quantization the residuals from each list's
+    centroid are replaced by one byte per subspace and scored with per-query lookup
+    tables, which shrinks the index roughly dim * 4 / n_subspaces times at some cost in
+    recall.
+    """
+
+    def __init__(
+        self,
+        centroids,
+        list_offsets,
+        ids,
+        vectors=None,
+        codebooks=None,
+        codes=None,
+        signature=None,
+    ):
+        if vectors is None and codes is None:
+            raise ValueError(
+                "Either vectors or product quantization codes are required"
+            )
+        self.centroids = centroids
+        self.list_offsets = list_offsets
+        self.ids = ids
+        self.vectors = vectors
+        self.codebooks = codebooks
+        self.codes = codes
+        # embedding_signature of the embeddings the index was built from, if known
+        self.signature = signature
+
+    @classmethod
+    def build(
+        cls,
+        embeddings,
+        ids=None,
+        *,
+        n_lists=256,
+        n_subspaces=None,
+        n_iter=20,
+        sample_size=65536,
+        seed=0,
+        signature=None,
+    ):
+        vectors = normalize_rows(embeddings)
+        ids = np.arange(vectors.shape[0]) if ids is None else np.asarray(ids)
+
+        centroids = kmeans(
+            vectors,
+            n_lists,
+            n_iter=n_iter,
+            spherical=True,
+            sample_size=sample_size,
+            seed=seed,
+        )
+        assignment = _assign(vectors, centroids, spherical=True)
+        order = np.argsort(assignment, kind="stable")
+        list_offsets = np.zeros(centroids.shape[0] + 1, dtype=np.int64)
+        np.cumsum(
+            np.bincount(assignment, minlength=centroids.shape[0]), out=list_offsets[1:]
+        )
+        vectors = np.ascontiguousarray(vectors[order])
+        ids = ids[order].astype(np.int64)
+
+        if not n_subspaces:
+            return cls(
+                centroids, list_offsets, ids, vectors=vectors, signature=signature
+            )
+
+        if vectors.shape[1] % n_subspaces != 0:
+            raise ValueError("n_subspaces must divide the embedding dimension")
+        residuals = vectors - centroids[assignment[order]]
+        sub_vectors = [
+            np.ascontiguousarray(sub)
+            for sub in np.split(residuals, n_subspaces, axis=1)
+        ]
+        # 256 codewords per subspace are well trained from a few dozen points each
+        codebook_sample_size = min(sample_size, 256 * 64)
+        codebooks = np.stack(
+            [
+                kmeans(
+                    sub,
+                    256,
+                    n_iter=n_iter,
+                    sample_size=codebook_sample_size,
+                    seed=seed + i,
+                )
+                for i, sub in enumerate(sub_vectors)
+            ]
+        )
+        codes = np.stack(
+            [
+                _assign(sub, codebook, spherical=False).astype(np.uint8)
+                for sub, codebook in zip(sub_vectors, codebooks)
+            ],
+            axis=1,
+        )
+        return cls(
+            centroids,
+            list_offsets,
+            ids,
+            codebooks=codebooks,
+            codes=codes,
+            signature=signature,
+        )
+
+    def __len__(self):
+        return self.ids.shape[0]
+
+    def _score_lists(self, query, lists, centroid_scores):
+        rows = [
+            np.arange(self.list_offsets[i], self.list_offsets[i + 1]) for i in lists
+        ]
+        rows = np.concatenate(rows)
+        if self.vectors is not None:
+            return rows, self.vectors[rows] @ query
+
+        # asymmetric distance computation: the query's score against a list centroid plus
+        # its inner products with the quantized residuals, read from one lookup table per
+        # subspace
+        tables = np.einsum(
+            "mkd,md->mk", self.codebooks, query.reshape(len(self.codebooks), -1)
+        )
+        sizes = self.list_offsets[lists + 1] - self.list_offsets[lists]
+        scores = np.repeat(centroid_scores[lists], sizes)
+        scores += tables[np.arange(tables.shape[0]), self.codes[rows]].sum(axis=1)
+        return rows, scores
+
+    def search(self, queries, k=10, n_probe=8):
+        """
+        Entity ids and approximate cosine similarities of the k best matches for each query,
+        shaped (n_queries, k). Rows are padded with -1 ids if the probed lists hold fewer
+        than k entries.
+        """
+        queries = normalize_rows(np.atleast_2d(queries))
+        centroid_scores = queries @ self.centroids.T
+        probed = top_k_rows(centroid_scores, n_probe)
+
+        result_ids = np.full((queries.shape[0], k), -1, dtype=np.int64)
+        result_scores = np.full((queries.shape[0], k), -np.inf, dtype=np.float32)
+        for i, (query, lists) in enumerate(zip(queries, probed)):
+            rows, scores = self._score_lists(query, lists, centroid_scores[i])
+            if rows.size == 0:
+                continue
+            best = top_k_rows(scores, k)[0]
+            result_ids[i, : best.size] = self.ids[rows[best]]
+            result_scores[i, : best.size] = scores[best]
+        return result_ids, result_scores
+
+    def save(self, file_path):
+        arrays = {
+            "centroids": self.centroids,
+            "list_offsets": self.list_offsets,
+            "ids": self.ids,
+        }
+        if self.vectors is not None:
+            arrays["vectors"] = self.vectors
+        else:
+            arrays["codebooks"] = self.codebooks
+            arrays["codes"] = self.codes
+        if self.signature is not None:
+            arrays["signature"] = self.signature
+        np.savez(file_path, **arrays)
+
+    @classmethod
+    def load(cls, file_path):
+        with np.load(file_path) as data:
+            return cls(
+                data["centroids"],
+                data["list_offsets"],
+                data["ids"],
+                vectors=data["vectors"] if "vectors" in data else None,
+                codebooks=data["codebooks"] if "codebooks" in data else None,
+                codes=data["codes"] if "codes" in data else None,
+                signature=data["signature"] if "signature" in data else None,
+            )
+
+
+def embedding_signature(embeddings_file):
+    """
+    Shape and modification time of a saved embedding matrix. An index stores the signature
+    of the embeddings it was built from, so it is not used with retrained ones.
+    """
+    embeddings_file = Path(embeddings_file)
+    shape = np.load(embeddings_file, mmap_mode="r").shape
+    return np.array([*shape, embeddings_file.stat().st_mtime_ns], dtype=np.int64)
+
+
+def load_model_ann_index(model_dir):
+    """
+    The entity index persisted next to a model's embeddings, or None if it was never built
+    or was built from other embeddings than the current entity_embedding.npy.
+    """
+    file_path = Path(model_dir) / ANN_INDEX_FILE
+    if not file_path.is_file():
+        return None
+    with np.load(file_path) as data:
+        signature = data["signature"] if "signature" in data else None
+    current = embedding_signature(Path(model_dir) / ENTITY_EMBEDDING_FILE)
+    if signature is None or not np.array_equal(signature, current):
+        warnings.warn(
+            f"ignoring {file_path}, it was not built from the current embeddings. "
+            "Rebuild it with python -m eatpim.ranking.ann"
+        )
+        return None
+    return IVFIndex.load(file_path)
+
+
+def benchmark(
+    index, embeddings, *, n_queries=1000, k=10, n_probes=(1, 2, 4, 8, 16, 32), seed=0
+):
+    """
+    Recall@k and per-query latency of the index against an exact scan over the same
+    embeddings, for each n_probe setting.
+    """
+    rng = np.random.default_rng(seed)
+    vectors = normalize_rows(embeddings)
+    queries = vectors[
+        rng.choice(vectors.shape[0], min(n_queries, vectors.shape[0]), replace=False)
+    ]
+
+    start = time.perf_counter()
+    exact = np.concatenate(
+        [
+            top_k_rows(queries[i : i + 100] @ vectors.T, k)
+            for i in range(0, queries.shape[0], 100)
+        ]
+    )
+    exact_ms = (time.perf_counter() - start) * 1000 / queries.shape[0]
+
+    results = [{"n_probe": "exact", "recall": 1.0, "ms_per_query": exact_ms}]
+    for n_probe in n_probes:
+        start = time.perf_counter()
+        found, _ = index.search(queries, k=k, n_probe=n_probe)
+        elapsed_ms = (time.perf_counter() - start) * 1000 / queries.shape[0]
+        hits = sum(len(set(f) & set(e)) for f, e in zip(found, exact))
+        results.append(
+            {
+                "n_probe": n_probe,
+                "recall": hits / exact.size,
+                "ms_per_query": elapsed_ms,
+            }
+        )
+    return results
+
+
+if __name__ == "__main__":
+    from eatpim.utils import path
+
+    parser = argparse.ArgumentParser(
+        description="Build the approximate nearest neighbour index for a model's entity "
+        "embeddings and benchmark it against an exact scan"
+    )
+    parser.add_argument("--data_dir", type=str, required=True)
+    parser.add_argument("--model_dir", type=str, required=True)
+    parser.add_argument("--n_lists", type=int, default=256)
+    parser.add_argument("--n_subspaces", type=int, default=0)
+    parser.add_argument("--n_queries", type=int, default=1000)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--n_probes", type=int, nargs="+", default=[1, 2, 4, 8, 16, 32])
+    args = parser.parse_args()
+
+    model_dir = (path.DATA_DIR / args.data_dir / args.model_dir).resolve()
+    ent_embs = np.load((model_dir / ENTITY_EMBEDDING_FILE).resolve())
+
+    start = time.perf_counter()
+    index = IVFIndex.build(
+        ent_embs,
+        n_lists=args.n_lists,
+        n_subspaces=args.n_subspaces,
+        signature=embedding_signature(model_dir / ENTITY_EMBEDDING_FILE),
+    )
+    print(
+        f"built index over {len(index)} entities in {time.perf_counter() - start:.1f}s"
+    )
+    index.save(model_dir / ANN_INDEX_FILE)
+    print(f"saved to {model_dir / ANN_INDEX_FILE}")
+
+    print("n_probe\trecall@%d\tms/query" % args.k)
+    for row in benchmark(
+        index, ent_embs, n_queries=args.n_queries, k=args.k, n_probes=args.n_probes
+    ):
+        print(f"{row['n_probe']}\t{row['recall']:.3f}\t{row['ms_per_query']:.3f}")
@@ -0,0 +1,122 @@
+# Copyright (c) 2022 Robert Bosch GmbH
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import itertools
+
+import numpy as np
+from scipy.sparse import csr_matrix, diags
+
+
+def incidence_matrix(ingredient_sets, ing_to_index, dtype=np.int32):
+    """
+    Sparse recipe x ingredient matrix with a 1 wherever the recipe uses the ingredient.
+    """
+    indptr = [0]
+    indices = []
+    for ing_set in ingredient_sets:
+        indices.extend(ing_to_index[ing] for ing in ing_set)
+        indptr.append(len(indices))
+    data = np.ones(len(indices), dtype=dtype)
+    return csr_matrix(
+        (data, np.array(indices, dtype=np.int64), np.array(indptr, dtype=np.int64)),
+        shape=(len(indptr) - 1, len(ing_to_index)),
+    )
+
+
+class CooccurrenceBuilder:
+    """
+    Accumulates ingredient co-occurrence counts as X.T @ X over chunks of recipes, where X
+    is the recipe x ingredient incidence matrix of each chunk. Recipes can therefore be
+    streamed without ever holding the whole corpus, or a dense n x n matrix, in memory.
+    """
+
+    def __init__(self, ing_to_index, dtype=np.int32):
+        self.ing_to_index = ing_to_index
+        self.dtype = dtype
+        n_ings = len(ing_to_index)
+        self.counts = csr_matrix((n_ings, n_ings), dtype=dtype)
+        self.n_recipes = 0
+
+    def update(self, ingredient_sets):
+        incidence = incidence_matrix(ingredient_sets, self.ing_to_index, self.dtype)
+        self.counts = self.counts + (incidence.T @ incidence).tocsr()
+        self.n_recipes += incidence.shape[0]
+        return self
+
+    def result(self):
+        """
+        Returns the co-occurrence matrix in CSR form, with a zero diagonal, and the vector
+        of how many recipes each ingredient occurs in.
+        """
+        occurrences = np.asarray(self.counts.diagonal(), dtype=self.dtype)
+        cooc_matrix = (
+            self.counts - diags(occurrences, format="csr", dtype=self.dtype)
+        ).tocsr()
+        cooc_matrix.eliminate_zeros()
+        return cooc_matrix, occurrences
+
+
+def build_cooccurrence_matrix(
+    ingredient_sets, ing_to_index, chunk_size=10000, dtype=np.int32
+):
+    """
+    Co-occurrence counts and per-ingredient occurrence counts for an iterable of recipe
+    ingredient sets, consumed `chunk_size` recipes at a time.
+    """
+    builder = CooccurrenceBuilder(ing_to_index, dtype=dtype)
+    ingredient_sets = iter(ingredient_sets)
+    while True:
+        chunk = list(itertools.islice(ingredient_sets, chunk_size))
+        if not chunk:
+            break
+        builder.update(chunk)
+    return builder.result()
+
+
+def masked_cosine_similarities(
+    cooc_matrix, occurrences, column_indices, target_idx, row_indices=None
+):
+    """
+    Cosine similarity of every ingredient's co-occurrence probability row to the target's,
+    only considering the columns in `column_indices` (usually the target recipe's
+    ingredients).
+
+    Rows are normalized by the ingredient occurrence counts after slicing the CSR matrix to
+    the selected columns, so memory per query is O(nnz) instead of O(n^2). `target_idx` may
+    also be a sequence of indices sharing the same columns, in which case an array of shape
+    (n_targets, n_ingredients) is returned. With `row_indices`, only those ingredients are
+    scored and the last axis follows their order.
+    """
+    cooc_matrix = csr_matrix(cooc_matrix)
+    occurrences = np.asarray(occurrences, dtype=np.float64).reshape(-1)
+    column_indices = np.unique(np.asarray(column_indices, dtype=np.int64))
+
+    inv_occurrences = np.zeros_like(occurrences)
+    np.divide(1.0, occurrences, out=inv_occurrences, where=occurrences > 0)
+    prob_matrix = diags(inv_occurrences) @ cooc_matrix[:, column_indices].astype(
+        np.float64
+    )
+    prob_matrix = prob_matrix.tocsr()
+
+    target_rows = prob_matrix[np.atleast_1d(target_idx)].toarray()
+    if row_indices is not None:
+        prob_matrix = prob_matrix[np.asarray(row_indices, dtype=np.int64)]
+    numerators = (prob_matrix @ target_rows.T).T
+    row_norms = np.sqrt(np.asarray(prob_matrix.multiply(prob_matrix).sum(axis=1)))
+    denom = np.linalg.norm(target_rows, axis=1)[:, None] * row_norms.reshape(1, -1)
+
+    sims = np.zeros(numerators.shape)
+    np.divide(numerators, denom, out=sims, where=denom > 0)
+    return sims if np.ndim(target_idx) else sims[0]
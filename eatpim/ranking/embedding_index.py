@@ -0,0 +1,97 @@
+# Copyright (c) 2022 Robert Bosch GmbH
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import numpy as np
+
+from .vocabulary import lookup_ids
+
+
+def normalize_rows(matrix):
+    matrix = np.array(matrix, dtype=np.float32, order="C")
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    np.divide(matrix, norms, out=matrix, where=norms > 0)
+    return matrix
+
+
+def top_k_rows(scores, k):
+    """
+    Column indices of the k largest values in every row of `scores`, best first.
+    """
+    scores = np.atleast_2d(scores)
+    k = min(k, scores.shape[1])
+    if k < scores.shape[1]:
+        part = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    else:
+        part = np.tile(np.arange(scores.shape[1]), (scores.shape[0], 1))
+    part_scores = np.take_along_axis(scores, part, axis=1)
+    order = np.argsort(-part_scores, axis=1, kind="stable")
+    return np.take_along_axis(part, order, axis=1)
+
+
+class EmbeddingIndex:
+    """
+    Exact cosine similarity index over a fixed set of named embeddings.
+
+    The embeddings are stored as one contiguous, pre-normalized float32 matrix, so scoring a
+    query is a single matrix-vector product and a batch of queries a single matrix product.
+    """
+
+    def __init__(self, embeddings, names):
+        self.names = list(names)
+        self.name_to_row = {name: i for i, name in enumerate(self.names)}
+        self.matrix = normalize_rows(embeddings)
+        if self.matrix.shape[0] != len(self.names):
+            raise ValueError("Expected one embedding per name")
+
+    @classmethod
+    def from_entities(cls, ent_embs, entity2id, names):
+        names = list(names)
+        return cls(ent_embs[lookup_ids(entity2id, names)], names)
+
+    def __len__(self):
+        return len(self.names)
+
+    def similarities(self, queries, rows=None):
+        """
+        Cosine similarity of every query vector to every indexed embedding, shaped
+        (n_items,) for a single query and (n_queries, n_items) for a batch. With `rows`,
+        only those indexed embeddings are scored.
+        """
+        queries = np.asarray(queries, dtype=np.float32)
+        single = queries.ndim == 1
+        matrix = self.matrix if rows is None else self.matrix[rows]
+        sims = normalize_rows(np.atleast_2d(queries)) @ matrix.T
+        return sims[0] if single else sims
+
+    def top_k(self, queries, k):
+        """
+        Row indices and similarities of the k most similar indexed embeddings for each
+        query, best first. Both arrays are shaped (n_queries, k).
+        """
+        sims = np.atleast_2d(self.similarities(queries))
+        rows = top_k_rows(sims, k)
+        return rows, np.take_along_axis(sims, rows, axis=1)
+
+    def most_similar(self, names, k):
+        """
+        Top k (name, similarity) pairs for each indexed name in `names`, scored together as
+        one batch.
+        """
+        queries = self.matrix[[self.name_to_row[name] for name in names]]
+        rows, sims = self.top_k(queries, k)
+        return [
+            [(self.names[r], s) for r, s in zip(row, sim)]
+            for row, sim in zip(rows, sims)
+        ]
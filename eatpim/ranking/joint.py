@@ -0,0 +1,125 @@
+# Copyright (c) 2022 Robert Bosch GmbH
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+from dataclasses import dataclass
+
+import numpy as np
+
+from eatpim.ranking.embedding_index import top_k_rows
+from eatpim.ranking.substitution import batch_cosine_similarities
+
+
+@dataclass
+class JointSearchResult:
+    # (k, n_leaves) candidate indices, columns in the order the leaves were given
+    candidates: np.ndarray
+    scores: np.ndarray
+    # number of (partial) joint replacements whose similarity was computed
+    evaluated: int
+
+
+def joint_substitution_search(
+    substitutions,
+    candidate_embs,
+    target,
+    *,
+    k=10,
+    beam_width=64,
+    candidates_per_leaf=None,
+    excluded=(),
+):
+    """
+    Beam search for the joint replacements of several leaves of one TransE recipe tree
+    whose calculated output is most similar to `target`.
+
+    The substitutions come from TransESubstitution.compile_leaves and share a base, so
+    replacing leaves l_1..l_m with candidates c_1..c_m gives
+        calc = base + sum_i coeff_i * (e_c_i - e_l_i)
+    Leaves are assigned in order of decreasing |coeff|, and each step extends every beam
+    state with every remaining candidate of the next leaf in one matrix product, keeping
+    the `beam_width` best partial replacements. With `candidates_per_leaf` set, each leaf
+    only considers its best candidates when replaced on its own, which prunes the search
+    from beam_width * n_candidates to beam_width * candidates_per_leaf evaluations per
+    leaf. Candidate indices in `excluded` and candidates already used by a beam state are
+    never chosen.
+    """
+    candidate_embs = np.asarray(candidate_embs, dtype=np.float64)
+    target = np.asarray(target, dtype=np.float64)
+    target_norm = np.linalg.norm(target)
+    n_candidates = candidate_embs.shape[0]
+    n_leaves = len(substitutions)
+    if n_leaves == 0:
+        raise ValueError("at least one substitution is required")
+    if beam_width < k:
+        raise ValueError("beam_width (%d) must be at least k (%d)" % (beam_width, k))
+
+    allowed = np.ones(n_candidates, dtype=bool)
+    allowed[list(excluded)] = False
+    if candidates_per_leaf is None:
+        leaf_candidates = [np.flatnonzero(allowed)] * n_leaves
+    else:
+        single_sims = batch_cosine_similarities(
+            substitutions, candidate_embs, [target]
+        )[:, 0]
+        single_sims[:, ~allowed] = -np.inf
+        leaf_candidates = [
+            np.sort(row[np.isfinite(single_sims[i, row])])
+            for i, row in enumerate(
+                top_k_rows(single_sims, min(candidates_per_leaf, n_candidates))
+            )
+        ]
+
+    cand_target_products = candidate_embs @ target
+    cand_sq_norms = np.einsum("ij,ij->i", candidate_embs, candidate_embs)
+
+    base = substitutions[0].base
+    states = base[None, :]
+    choices = np.empty((1, 0), dtype=np.int64)
+    scores = np.empty(1)
+    evaluated = 0
+    order = sorted(range(n_leaves), key=lambda i: -abs(substitutions[i].coeff))
+    for leaf in order:
+        coeff = substitutions[leaf].coeff
+        cands = leaf_candidates[leaf]
+        # a state w extended with candidate c has output (w - coeff * e_l) + coeff * e_c
+        shifts = states - coeff * substitutions[leaf].original
+        numerators = (shifts @ target)[:, None] + coeff * cand_target_products[cands]
+        sq_norms = (
+            np.einsum("ij,ij->i", shifts, shifts)[:, None]
+            + 2 * coeff * (shifts @ candidate_embs[cands].T)
+            + coeff**2 * cand_sq_norms[cands]
+        )
+        denom = np.sqrt(np.maximum(sq_norms, 0)) * target_norm
+        step_scores = np.full(numerators.shape, -np.inf)
+        np.divide(numerators, denom, out=step_scores, where=denom > 0)
+        # a candidate replaces at most one leaf
+        step_scores[(choices[:, :, None] == cands[None, None, :]).any(axis=1)] = -np.inf
+        evaluated += step_scores.size
+
+        flat = top_k_rows(step_scores.reshape(-1), min(beam_width, step_scores.size))[0]
+        flat = flat[np.isfinite(step_scores.reshape(-1)[flat])]
+        state_rows, cand_cols = np.divmod(flat, len(cands))
+        states = shifts[state_rows] + coeff * candidate_embs[cands[cand_cols]]
+        choices = np.hstack([choices[state_rows], cands[cand_cols][:, None]])
+        scores = step_scores[state_rows, cand_cols]
+
+    # beam states are sorted best-first by top_k_rows
+    columns = np.empty(n_leaves, dtype=np.int64)
+    columns[order] = np.arange(n_leaves)
+    return JointSearchResult(
+        candidates=choices[:k, columns],
+        scores=scores[:k],
+        evaluated=evaluated,
+    )
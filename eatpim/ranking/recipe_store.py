@@ -0,0 +1,278 @@
+# Copyright (c) 2022 Robert Bosch GmbH
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import hashlib
+import json
+import os
+import sqlite3
+from collections import defaultdict
+from dataclasses import dataclass
+from pathlib import Path
+
+import networkx as nx
+
+from eatpim.ranking.actions import leaf_downstream_actions
+
+RECIPE_STORE_FILE = "recipe_store.sqlite"
+# bumped whenever the schema changes, so stores written by older code are rebuilt
+RECIPE_STORE_VERSION = 2
+OPERATION_FILES = ["train.txt", "valid.txt", "test.txt"]
+
+
+@dataclass
+class StoredRecipe:
+    output_node: str
+    edges: list
+    leaves: set
+    ops: dict
+    intermediate_node_count: int
+    # names of the actions each leaf flows through
+    leaf_actions: dict
+
+    def graph(self):
+        G = nx.DiGraph()
+        G.add_edges_from(self.edges)
+        return G
+
+
+def _source_signature(source_files, valid_ingredients):
+    # size and modification time of every input plus the ingredient list that decides
+    # which nodes are leaves, so a change to any of them rebuilds the store
+    return json.dumps(
+        {
+            "version": RECIPE_STORE_VERSION,
+            "files": {
+                str(f): [os.stat(f).st_size, os.stat(f).st_mtime_ns]
+                for f in sorted(source_files)
+            },
+            "ingredients": hashlib.sha1(
+                json.dumps(sorted(valid_ingredients)).encode()
+            ).hexdigest(),
+        }
+    )
+
+
+class RecipeStore:
+    """
+    SQLite store of every recipe's flow graph edges, leaf ingredients and operation tree,
+    keyed by its RECIPE_OUTPUT_<id> node. Looking up one recipe reads only that recipe's
+    row, instead of parsing recipe_tree_data.json and all triple_data splits.
+
+    Corpus-wide aggregates (the distinct leaf ingredients and how many recipes each occurs
+    in) are computed once when the store is built, as are the downstream actions of every
+    leaf, which are also indexed by action.
+    """
+
+    def __init__(self, db_file):
+        self.db_file = Path(db_file)
+        self.connection = sqlite3.connect(
+            f"file:{self.db_file}?mode=ro", uri=True, check_same_thread=False
+        )
+
+    @classmethod
+    def build(cls, db_file, *, recipe_tree_file, operation_files, valid_ingredients):
+        db_file = Path(db_file)
+        tmp_file = db_file.with_name(db_file.name + ".tmp")
+        if tmp_file.exists():
+            tmp_file.unlink()
+
+        recipe_operations = {}
+        for operation_file in operation_files:
+            with open(operation_file) as fin:
+                for line in fin:
+                    # one item per line, keyed by the recipe output node
+                    for k, v in json.loads(line).items():
+                        recipe_operations[str(k)] = v
+
+        with open(recipe_tree_file, "r") as f:
+            recipe_data = json.load(f)
+
+        valid_ingredients = set(valid_ingredients)
+        leaf_occurrence_count = defaultdict(lambda: 0)
+        connection = sqlite3.connect(tmp_file)
+        with connection:
+            connection.executescript("""
+                CREATE TABLE recipes (
+                    output_node TEXT PRIMARY KEY,
+                    edges TEXT NOT NULL,
+                    leaves TEXT NOT NULL,
+                    ops TEXT,
+                    intermediate_node_count INTEGER NOT NULL
+                );
+                CREATE TABLE leaf_occurrences (
+                    ingredient TEXT PRIMARY KEY,
+                    count INTEGER NOT NULL
+                );
+                CREATE TABLE leaf_actions (
+                    action TEXT NOT NULL,
+                    output_node TEXT NOT NULL,
+                    ingredient TEXT NOT NULL,
+                    PRIMARY KEY (action, output_node, ingredient)
+                ) WITHOUT ROWID;
+                CREATE INDEX leaf_actions_by_recipe ON leaf_actions (output_node);
+                CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+                """)
+            rows = []
+            action_rows = []
+            for data in recipe_data.values():
+                output_node = data["output_node"]
+                nodes = {n for e in data["edges"] for n in e}
+                leaves = sorted(n for n in nodes if n in valid_ingredients)
+                for leaf in leaves:
+                    leaf_occurrence_count[leaf] += 1
+                for leaf, actions in leaf_downstream_actions(
+                    data["edges"], leaves
+                ).items():
+                    action_rows.extend(
+                        (action, output_node, leaf) for action in actions
+                    )
+                ops = recipe_operations.get(output_node)
+                rows.append(
+                    (
+                        output_node,
+                        json.dumps(data["edges"]),
+                        json.dumps(leaves),
+                        None if ops is None else json.dumps(ops),
+                        len(nodes) - len(leaves) - (output_node in nodes),
+                    )
+                )
+            connection.executemany(
+                "INSERT OR REPLACE INTO recipes VALUES (?, ?, ?, ?, ?)", rows
+            )
+            connection.executemany(
+                "INSERT OR IGNORE INTO leaf_actions VALUES (?, ?, ?)", action_rows
+            )
+            connection.executemany(
+                "INSERT INTO leaf_occurrences VALUES (?, ?)",
+                sorted(leaf_occurrence_count.items()),
+            )
+            connection.execute(
+                "INSERT INTO meta VALUES ('sources', ?)",
+                (
+                    _source_signature(
+                        [recipe_tree_file, *operation_files], valid_ingredients
+                    ),
+                ),
+            )
+        connection.close()
+        os.replace(tmp_file, db_file)
+        return cls(db_file)
+
+    def is_current(self, source_files, valid_ingredients):
+        row = self.connection.execute(
+            "SELECT value FROM meta WHERE key = 'sources'"
+        ).fetchone()
+        return row is not None and row[0] == _source_signature(
+            source_files, valid_ingredients
+        )
+
+    def __len__(self):
+        return self.connection.execute("SELECT COUNT(*) FROM recipes").fetchone()[0]
+
+    def __contains__(self, output_node):
+        return (
+            self.connection.execute(
+                "SELECT 1 FROM recipes WHERE output_node = ?", (output_node,)
+            ).fetchone()
+            is not None
+        )
+
+    def get(self, output_node):
+        row = self.connection.execute(
+            "SELECT output_node, edges, leaves, ops, intermediate_node_count "
+            "FROM recipes WHERE output_node = ?",
+            (output_node,),
+        ).fetchone()
+        if row is None:
+            return None
+        leaves = set(json.loads(row[2]))
+        leaf_actions = {leaf: set() for leaf in leaves}
+        for ingredient, action in self.connection.execute(
+            "SELECT ingredient, action FROM leaf_actions WHERE output_node = ?",
+            (output_node,),
+        ):
+            leaf_actions[ingredient].add(action)
+        return StoredRecipe(
+            output_node=row[0],
+            edges=json.loads(row[1]),
+            leaves=leaves,
+            ops=None if row[3] is None else json.loads(row[3]),
+            intermediate_node_count=row[4],
+            leaf_actions=leaf_actions,
+        )
+
+    def output_node_at(self, position):
+        """
+        Output node of the recipe stored at `position` (0 <= position < len(self)), used to
+        pick random recipes without listing them all.
+        """
+        row = self.connection.execute(
+            "SELECT output_node FROM recipes LIMIT 1 OFFSET ?", (position,)
+        ).fetchone()
+        if row is None:
+            raise IndexError(position)
+        return row[0]
+
+    def output_nodes(self):
+        for (output_node,) in self.connection.execute(
+            "SELECT output_node FROM recipes"
+        ):
+            yield output_node
+
+    def leaf_sets(self):
+        for (leaves,) in self.connection.execute("SELECT leaves FROM recipes"):
+            yield set(json.loads(leaves))
+
+    def action_occurrences(self, action):
+        """
+        (output node, ingredient) pairs of every leaf that flows through the action.
+        """
+        return self.connection.execute(
+            "SELECT output_node, ingredient FROM leaf_actions WHERE action = ?",
+            (action,),
+        ).fetchall()
+
+    def leaf_occurrences(self):
+        return dict(
+            self.connection.execute("SELECT ingredient, count FROM leaf_occurrences")
+        )
+
+    def close(self):
+        self.connection.close()
+
+
+def open_recipe_store(main_dir, valid_ingredients):
+    """
+    The recipe store of a data directory, built on first use and rebuilt whenever
+    recipe_tree_data.json, one of the triple_data splits or the ingredient list changes.
+    """
+    main_dir = Path(main_dir)
+    recipe_tree_file = (main_dir / "recipe_tree_data.json").resolve()
+    operation_files = [
+        (main_dir / "triple_data" / f).resolve() for f in OPERATION_FILES
+    ]
+    db_file = main_dir / RECIPE_STORE_FILE
+    if db_file.is_file():
+        store = RecipeStore(db_file)
+        if store.is_current([recipe_tree_file, *operation_files], valid_ingredients):
+            return store
+        store.close()
+    print("building the recipe store...")
+    return RecipeStore.build(
+        db_file,
+        recipe_tree_file=recipe_tree_file,
+        operation_files=operation_files,
+        valid_ingredients=valid_ingredients,
+    )
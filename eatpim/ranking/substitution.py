@@ -0,0 +1,280 @@
+# Copyright (c) 2022 Robert Bosch GmbH
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import numpy as np
+from frozendict import frozendict
+
+
+def _split_op(ops):
+    # we expect only 1 key/val pair in this dict. the key is the relation type, the val is
+    # a list of entities or other operations that are performed
+    for k, v in ops.items():
+        return k, v
+
+
+def _is_op(ops):
+    return isinstance(ops, frozendict) or isinstance(ops, dict)
+
+
+def _row_cosine(numerator, sq_norms, target_norm):
+    denom = np.sqrt(np.maximum(sq_norms, 0)) * target_norm
+    out = np.zeros_like(numerator)
+    np.divide(numerator, denom, out=out, where=denom > 0)
+    return out
+
+
+class TransESubstitution:
+    """
+    Closed form of a TransE flow graph calculation with respect to one replaced leaf.
+
+    Mean aggregation followed by a relation translation is affine in every leaf, so
+    replacing all occurrences of `rem_ing` with a candidate c gives
+        calc(c) = base + coeff * (e_c - e_rem_ing)
+    where base is the unmodified calculated output and coeff is the summed weight of
+    the replaced leaf's occurrences in the tree.
+    """
+
+    def __init__(self, base, coeff, original):
+        self.base = base
+        self.coeff = coeff
+        self.original = original
+
+    @classmethod
+    def compile(cls, *, ops, rem_ing, ent_embs, entity2id, rel_embs, relation2id):
+        def walk(node):
+            if not _is_op(node):
+                vec = ent_embs[entity2id[node]].astype(np.float64)
+                return vec, 1.0 if node == rem_ing else 0.0
+
+            relation_name, entity_list = _split_op(node)
+            children = [walk(ent) for ent in entity_list]
+            vec = np.mean([c[0] for c in children], axis=0)
+            coeff = float(np.mean([c[1] for c in children]))
+            return vec + rel_embs[relation2id[relation_name]], coeff
+
+        base, coeff = walk(ops)
+        original = ent_embs[entity2id[rem_ing]].astype(np.float64)
+        return cls(base=base, coeff=coeff, original=original)
+
+    @classmethod
+    def compile_leaves(cls, *, ops, ent_embs, entity2id, rel_embs, relation2id):
+        """
+        Compiles the tree once for every distinct leaf. The returned substitutions, keyed
+        by leaf name, all share the same base vector.
+        """
+
+        def walk(node):
+            if not _is_op(node):
+                return ent_embs[entity2id[node]].astype(np.float64), {node: 1.0}
+
+            relation_name, entity_list = _split_op(node)
+            children = [walk(ent) for ent in entity_list]
+            vec = np.mean([c[0] for c in children], axis=0)
+            coeffs = dict()
+            for _, child_coeffs in children:
+                for leaf, weight in child_coeffs.items():
+                    coeffs[leaf] = coeffs.get(leaf, 0.0) + weight / len(children)
+            return vec + rel_embs[relation2id[relation_name]], coeffs
+
+        base, coeffs = walk(ops)
+        return {
+            leaf: cls(
+                base=base,
+                coeff=coeff,
+                original=ent_embs[entity2id[leaf]].astype(np.float64),
+            )
+            for leaf, coeff in coeffs.items()
+        }
+
+    @classmethod
+    def for_ingredients(cls, substitutions, ings, ent_embs, entity2id):
+        """
+        The substitution of each of `ings` in a tree compiled by compile_leaves. Replacing an
+        ingredient that is not a leaf of the tree does not change the calculated output.
+        """
+        base = next(iter(substitutions.values())).base
+        return [
+            (
+                substitutions[ing]
+                if ing in substitutions
+                else cls(
+                    base=base,
+                    coeff=0.0,
+                    original=ent_embs[entity2id[ing]].astype(np.float64),
+                )
+            )
+            for ing in ings
+        ]
+
+    def output_vectors(self, candidate_embs):
+        """
+        Explicit calculated outputs, one row per candidate embedding.
+        """
+        candidate_embs = np.asarray(candidate_embs, dtype=np.float64)
+        return self.base + self.coeff * (candidate_embs - self.original)
+
+    def cosine_similarities(self, candidate_embs, targets):
+        """
+        Cosine similarity between every candidate's calculated output and every target vector.
+
+        Expanding the dot products and norms of base + coeff * (e_c - e_rem_ing) lets all
+        candidates be scored with a single (n_candidates, dim) x (dim, n_targets + 1) product,
+        without materialising the calculated outputs. Returns an array of shape
+        (n_targets, n_candidates).
+        """
+        return batch_cosine_similarities([self], candidate_embs, targets)[0]
+
+
+def batch_cosine_similarities(substitutions, candidate_embs, targets):
+    """
+    TransESubstitution.cosine_similarities for several substitutions sharing the same
+    targets (e.g. different leaves of one recipe), computed with a single
+    (n_candidates, dim) x (dim, n_targets + n_substitutions) product. Returns an array of
+    shape (n_substitutions, n_targets, n_candidates).
+    """
+    candidate_embs = np.asarray(candidate_embs, dtype=np.float64)
+    targets = np.atleast_2d(np.asarray(targets, dtype=np.float64))
+    coeffs = np.array([s.coeff for s in substitutions])
+    shifts = np.stack([s.base - s.coeff * s.original for s in substitutions])
+
+    products = candidate_embs @ np.vstack([targets, shifts]).T
+    target_products = products[:, : targets.shape[0]].T
+    shift_products = products[:, targets.shape[0] :].T
+    cand_sq_norms = np.einsum("ij,ij->i", candidate_embs, candidate_embs)
+    out_sq_norms = (
+        np.einsum("ij,ij->i", shifts, shifts)[:, None]
+        + 2 * coeffs[:, None] * shift_products
+        + coeffs[:, None] ** 2 * cand_sq_norms
+    )
+
+    numerators = (shifts @ targets.T)[:, :, None] + (
+        coeffs[:, None, None] * target_products[None]
+    )
+    denom = (
+        np.sqrt(np.maximum(out_sq_norms, 0))[:, None, :]
+        * np.linalg.norm(targets, axis=1)[None, :, None]
+    )
+    sims = np.zeros_like(numerators)
+    np.divide(numerators, denom, out=sims, where=denom > 0)
+    return sims
+
+
+def _transe_operator(head, relation, embedding_range):
+    return head + relation
+
+
+def _distmult_operator(head, relation, embedding_range):
+    return head * relation
+
+
+def _rotate_operator(head, relation, embedding_range):
+    pi = 3.14159265358979323846
+
+    phase_relation = relation / (embedding_range / pi)
+    re_head, im_head = np.split(head, 2, axis=-1)
+    re_relation = np.cos(phase_relation)
+    im_relation = np.sin(phase_relation)
+
+    re_score = re_head * re_relation - im_head * im_relation
+    im_score = re_head * im_relation + im_head * re_relation
+
+    return np.concatenate([re_score, im_score], axis=-1)
+
+
+GRAPH_OPERATORS = {
+    "TransE": _transe_operator,
+    "DistMult": _distmult_operator,
+    "RotatE": _rotate_operator,
+}
+
+
+class CandidateAxisEvaluator:
+    """
+    Evaluates a flow graph for many replacement candidates in one bottom-up pass.
+
+    Leaves equal to the replaced ingredient become an (n_candidates, dim) block of candidate
+    embeddings. Subtrees that do not contain the replaced ingredient stay (dim,) vectors,
+    are evaluated once and broadcast against the candidate axis when aggregated. This works
+    for the non-affine RotatE and DistMult graph operators as well as TransE.
+    """
+
+    def __init__(
+        self,
+        *,
+        ent_embs,
+        entity2id,
+        rel_embs,
+        relation2id,
+        model_name,
+        embedding_range=None
+    ):
+        if model_name not in GRAPH_OPERATORS:
+            raise ValueError("model %s not supported" % model_name)
+        if model_name == "RotatE" and embedding_range is None:
+            raise ValueError("RotatE requires the embedding_range used in training")
+        self.ent_embs = ent_embs
+        self.entity2id = entity2id
+        self.rel_embs = rel_embs
+        self.relation2id = relation2id
+        self.model_name = model_name
+        self.embedding_range = embedding_range
+        self.operator = GRAPH_OPERATORS[model_name]
+
+    def calculate(self, *, ops, rem_ing=None, candidate_embs=None):
+        """
+        Calculated output of `ops`. Without candidates this is the unmodified (dim,) output,
+        otherwise an (n_candidates, dim) array with every occurrence of `rem_ing` replaced.
+        """
+        if candidate_embs is not None:
+            candidate_embs = np.asarray(candidate_embs, dtype=np.float64)
+
+        def walk(node):
+            if not _is_op(node):
+                if node == rem_ing and candidate_embs is not None:
+                    return candidate_embs
+                return self.ent_embs[self.entity2id[node]].astype(np.float64)
+
+            relation_name, entity_list = _split_op(node)
+            head_content = None
+            for ent in entity_list:
+                inner = walk(ent)
+                head_content = inner if head_content is None else head_content + inner
+            head_content = head_content / len(entity_list)
+
+            relation = self.rel_embs[self.relation2id[relation_name]]
+            return self.operator(head_content, relation, self.embedding_range)
+
+        output = walk(ops)
+        if candidate_embs is not None and output.ndim == 1:
+            # the replaced ingredient does not occur in the tree
+            output = np.broadcast_to(output, (candidate_embs.shape[0], output.shape[0]))
+        return output
+
+    def cosine_similarities(self, *, ops, rem_ing, candidate_embs, targets):
+        """
+        Same contract as TransESubstitution.cosine_similarities, returning an array of
+        shape (n_targets, n_candidates).
+        """
+        outputs = self.calculate(
+            ops=ops, rem_ing=rem_ing, candidate_embs=candidate_embs
+        )
+        targets = np.atleast_2d(np.asarray(targets, dtype=np.float64))
+        numerators = targets @ outputs.T
+        out_sq_norms = np.einsum("ij,ij->i", outputs, outputs)
+
+        sims = np.empty_like(numerators)
+        for i, target in enumerate(targets):
+            sims[i] = _row_cosine(numerators[i], out_sq_norms, np.linalg.norm(target))
+        return sims
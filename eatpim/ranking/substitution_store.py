@@ -0,0 +1,129 @@
+# Copyright (c) 2022 Robert Bosch GmbH
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import json
+import sqlite3
+from pathlib import Path
+
+SUBSTITUTION_STORE_FILE = "substitutions.sqlite"
+
+
+class SubstitutionStore:
+    """
+    Precomputed top-k substitutes keyed by (recipe, ingredient, metric).
+
+    Recipes are written in transactions together with their entries in the
+    completed_recipes table, so an interrupted job can resume from the recipes that are
+    not marked as completed without ever serving a partially written recipe.
+    """
+
+    def __init__(self, db_file, readonly=False):
+        self.db_file = Path(db_file)
+        if readonly:
+            self.connection = sqlite3.connect(
+                f"file:{self.db_file}?mode=ro", uri=True, check_same_thread=False
+            )
+            return
+        self.connection = sqlite3.connect(self.db_file)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        with self.connection:
+            self.connection.executescript("""
+                CREATE TABLE IF NOT EXISTS substitutions (
+                    recipe TEXT NOT NULL,
+                    ingredient TEXT NOT NULL,
+                    metric TEXT NOT NULL,
+                    substitutes TEXT NOT NULL,
+                    PRIMARY KEY (recipe, ingredient, metric)
+                ) WITHOUT ROWID;
+                CREATE TABLE IF NOT EXISTS completed_recipes (
+                    recipe TEXT PRIMARY KEY
+                ) WITHOUT ROWID;
+                CREATE TABLE IF NOT EXISTS meta (
+                    key TEXT PRIMARY KEY,
+                    value TEXT NOT NULL
+                );
+                """)
+
+    def check_settings(self, settings):
+        """
+        Records the job settings on first use. Resuming with different settings would mix
+        incompatible results, so it raises a ValueError instead.
+        """
+        settings = json.dumps(settings, sort_keys=True)
+        row = self.connection.execute(
+            "SELECT value FROM meta WHERE key = 'settings'"
+        ).fetchone()
+        if row is None:
+            with self.connection:
+                self.connection.execute(
+                    "INSERT INTO meta VALUES ('settings', ?)", (settings,)
+                )
+        elif row[0] != settings:
+            raise ValueError(
+                "%s was computed with settings %s, not %s"
+                % (self.db_file, row[0], settings)
+            )
+
+    def completed_recipes(self):
+        return {
+            recipe
+            for (recipe,) in self.connection.execute(
+                "SELECT recipe FROM completed_recipes"
+            )
+        }
+
+    def write_recipes(self, recipe_results):
+        """
+        Writes a batch of (recipe, results) pairs in one transaction, where `results` maps
+        (ingredient, metric) to a best-first list of (substitute, score).
+        """
+        with self.connection:
+            for recipe, results in recipe_results:
+                self.connection.executemany(
+                    "INSERT OR REPLACE INTO substitutions VALUES (?, ?, ?, ?)",
+                    [
+                        (recipe, ingredient, metric, json.dumps(substitutes))
+                        for (ingredient, metric), substitutes in results.items()
+                    ],
+                )
+                self.connection.execute(
+                    "INSERT OR REPLACE INTO completed_recipes VALUES (?)", (recipe,)
+                )
+
+    def get(self, recipe, ingredient, metric):
+        row = self.connection.execute(
+            "SELECT substitutes FROM substitutions "
+            "WHERE recipe = ? AND ingredient = ? AND metric = ?",
+            (recipe, ingredient, metric),
+        ).fetchone()
+        if row is None:
+            return None
+        return [tuple(pair) for pair in json.loads(row[0])]
+
+    def get_all(self, recipe, ingredient):
+        """
+        Substitutes for every metric of one (recipe, ingredient) pair, keyed by metric.
+        """
+        return {
+            metric: [tuple(pair) for pair in json.loads(substitutes)]
+            for metric, substitutes in self.connection.execute(
+                "SELECT metric, substitutes FROM substitutions "
+                "WHERE recipe = ? AND ingredient = ?",
+                (recipe, ingredient),
+            )
+        }
+
+    def close(self):
+        self.connection.close()
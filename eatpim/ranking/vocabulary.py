@@ -0,0 +1,231 @@
+# Copyright (c) 2022 Robert Bosch GmbH
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import json
+from collections.abc import Mapping
+from pathlib import Path
+
+import numpy as np
+
+VOCABULARY_SUFFIX = ".vocab.npz"
+
+
+class Vocabulary(Mapping):
+    """
+    Read-only name -> id mapping stored as sorted arrays instead of a dict.
+
+    All names are kept UTF-8 encoded in one byte buffer, in sorted order, with an offsets
+    array marking where each one starts. A lookup is a binary search over that buffer, and
+    the reverse id -> name lookup goes through a position-by-id array. For the entity
+    vocabulary this is a few MB of arrays instead of two dicts of Python strings, and it
+    can be saved and reloaded without parsing the .dict file again.
+
+    Batch lookups go through a fixed-width copy of the sorted names, built on first use,
+    so a whole list of names is resolved with one vectorized searchsorted.
+    """
+
+    def __init__(self, blob, offsets, ids):
+        self.blob = bytes(blob)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.ids = np.asarray(ids, dtype=np.int64)
+        self.positions = np.full(
+            int(self.ids.max()) + 1 if self.ids.size else 0, -1, dtype=np.int64
+        )
+        self.positions[self.ids] = np.arange(self.ids.size)
+        self._fixed_width_names = None
+
+    @classmethod
+    def from_pairs(cls, pairs):
+        encoded = sorted((name.encode("utf-8"), int(i)) for name, i in pairs)
+        lengths = np.array([len(name) for name, _ in encoded], dtype=np.int64)
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        return cls(
+            b"".join(name for name, _ in encoded),
+            offsets,
+            np.array([i for _, i in encoded], dtype=np.int64),
+        )
+
+    @classmethod
+    def from_dict_file(cls, file_path):
+        """
+        Parses an id<TAB>name file such as entities.dict or relations.dict.
+        """
+        pairs = []
+        with open(file_path) as fin:
+            for line in fin:
+                eid, name = line.strip().split("\t")
+                pairs.append((name, int(eid)))
+        return cls.from_pairs(pairs)
+
+    def save(self, file_path):
+        with open(file_path, "wb") as f:
+            np.savez(
+                f,
+                blob=np.frombuffer(self.blob, dtype=np.uint8),
+                offsets=self.offsets,
+                ids=self.ids,
+            )
+
+    @classmethod
+    def load(cls, file_path):
+        with np.load(file_path) as data:
+            return cls(data["blob"].tobytes(), data["offsets"], data["ids"])
+
+    def _encoded(self, position):
+        return self.blob[self.offsets[position] : self.offsets[position + 1]]
+
+    def _position(self, name):
+        key = name.encode("utf-8") if isinstance(name, str) else None
+        if key is None:
+            return -1
+        lo, hi = 0, len(self.ids)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._encoded(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < len(self.ids) and self._encoded(lo) == key:
+            return lo
+        return -1
+
+    def __getitem__(self, name):
+        position = self._position(name)
+        if position < 0:
+            raise KeyError(name)
+        return int(self.ids[position])
+
+    def __contains__(self, name):
+        return self._position(name) >= 0
+
+    def __iter__(self):
+        for position in range(len(self.ids)):
+            yield self._encoded(position).decode("utf-8")
+
+    def __len__(self):
+        return len(self.ids)
+
+    def _sorted_names(self):
+        if self._fixed_width_names is None:
+            lengths = np.diff(self.offsets)
+            width = max(int(lengths.max()) if lengths.size else 0, 1)
+            columns = np.arange(width)
+            filled = columns < lengths[:, None]
+            names = np.zeros((len(self.ids), width), dtype=np.uint8)
+            names[filled] = np.frombuffer(self.blob, dtype=np.uint8)[
+                (self.offsets[:-1, None] + columns)[filled]
+            ]
+            self._fixed_width_names = names.view(f"S{width}").reshape(-1)
+        return self._fixed_width_names
+
+    def lookup(self, names):
+        """
+        Ids of many names at once, as an int64 array.
+        """
+        names = list(names)
+        if not names:
+            return np.zeros(0, dtype=np.int64)
+        if not len(self.ids):
+            raise KeyError(names[0])
+        keys = np.array([name.encode("utf-8") for name in names])
+        sorted_names = self._sorted_names()
+        positions = np.minimum(np.searchsorted(sorted_names, keys), len(self.ids) - 1)
+        found = sorted_names[positions] == keys
+        if not found.all():
+            raise KeyError(names[int(np.argmin(found))])
+        return self.ids[positions]
+
+    def name(self, i):
+        if not 0 <= i < len(self.positions) or self.positions[i] < 0:
+            raise KeyError(i)
+        return self._encoded(self.positions[i]).decode("utf-8")
+
+    def inverse(self):
+        return InverseVocabulary(self)
+
+
+class InverseVocabulary(Mapping):
+    """
+    id -> name view of a Vocabulary, without materialising a dict.
+    """
+
+    def __init__(self, vocabulary):
+        self.vocabulary = vocabulary
+
+    def __getitem__(self, i):
+        return self.vocabulary.name(i)
+
+    def __iter__(self):
+        return iter(np.sort(self.vocabulary.ids).tolist())
+
+    def __len__(self):
+        return len(self.vocabulary)
+
+
+def lookup_ids(name2id, names):
+    """
+    Ids of many names at once, as an int64 array, from a Vocabulary or a plain dict.
+    """
+    if isinstance(name2id, Vocabulary):
+        return name2id.lookup(names)
+    return np.array([name2id[name] for name in names], dtype=np.int64)
+
+
+def load_vocabulary(dict_file):
+    """
+    Vocabulary of an id<TAB>name file. The compiled form is cached next to the file and
+    reused for as long as it is newer than the source.
+    """
+    dict_file = Path(dict_file)
+    cache_file = dict_file.with_name(dict_file.name + VOCABULARY_SUFFIX)
+    if cache_file.is_file() and cache_file.stat().st_mtime >= dict_file.stat().st_mtime:
+        return Vocabulary.load(cache_file)
+
+    vocabulary = Vocabulary.from_dict_file(dict_file)
+    try:
+        vocabulary.save(cache_file)
+    except OSError:
+        # read-only data directories just skip the cache
+        pass
+    return vocabulary
+
+
+def load_embeddings(model_dir, mmap_mode="r"):
+    """
+    Entity and relation embeddings of a trained model. By default the .npy files are
+    memory-mapped, so only the pages of the rows a query touches are ever read.
+    """
+    model_dir = Path(model_dir)
+    ent_embs = np.load(
+        (model_dir / "entity_embedding.npy").resolve(), mmap_mode=mmap_mode
+    )
+    rel_embs = np.load(
+        (model_dir / "relation_embedding.npy").resolve(), mmap_mode=mmap_mode
+    )
+    return ent_embs, rel_embs
+
+
+def load_model_config(model_dir):
+    """
+    Graph operator name and RotatE embedding range of a model saved by run.py, which keeps
+    its training arguments next to the embeddings. Models without a config are TransE.
+    """
+    config_file = (Path(model_dir) / "config.json").resolve()
+    if not config_file.is_file():
+        return "TransE", None
+    with open(config_file) as f:
+        config = json.load(f)
+    return config["model"], (config["gamma"] + 2.0) / config["hidden_dim"]
@@ -0,0 +1,237 @@
+import collections
+import hashlib
+import json
+import os
+import pathlib
+import shutil
+import tempfile
+from typing import Iterator, Mapping
+
+import numpy as np
+import pandas as pd
+
+from scipy import sparse
+
+from report_utils.constraints import AttributeMasks
+from report_utils.graph import RecipeGraphStore
+
+ARTIFACTS_VERSION = 2
+MANIFEST_FILE = "manifest.json"
+
+
+class OperationStore(Mapping):
+    """
+    Read-only mapping of recipe output node to its operation tree. The trees are stored as
+    JSON documents back to back in one byte array, tree i in the range offsets[i] to
+    offsets[i + 1], and a tree is only parsed when it is looked up. The arrays may be
+    memory-mapped.
+    """
+
+    def __init__(self, keys: list[str], offsets: np.ndarray, documents: np.ndarray):
+        self.output_nodes = keys
+        self.positions = {key: i for i, key in enumerate(keys)}
+        self.offsets = offsets
+        self.documents = documents
+
+    @classmethod
+    def from_operations(cls, operations: Mapping[str, dict]) -> "OperationStore":
+        encoded = [json.dumps(tree).encode() for tree in operations.values()]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(document) for document in encoded], out=offsets[1:])
+        return cls(
+            keys=list(operations.keys()),
+            offsets=offsets,
+            documents=np.frombuffer(b"".join(encoded), dtype=np.uint8),
+        )
+
+    def __getitem__(self, key: str) -> dict:
+        i = self.positions[key]
+        return json.loads(
+            self.documents[self.offsets[i] : self.offsets[i + 1]].tobytes()
+        )
+
+    def __contains__(self, key: object) -> bool:
+        return key in self.positions
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.output_nodes)
+
+    def __len__(self) -> int:
+        return len(self.output_nodes)
+
+
+def file_digest(file_path: pathlib.Path) -> str:
+    digest = hashlib.blake2b(digest_size=16)
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def artifacts_key(input_files: dict[str, pathlib.Path], parameters: dict) -> str:
+    """
+    Hash of the artifact format version, the contents of every input file and any
+    parameters the artifacts depend on. A change to any of them gives a new bundle.
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(str(ARTIFACTS_VERSION).encode())
+    for name in sorted(input_files):
+        digest.update(name.encode())
+        digest.update(file_digest(input_files[name]).encode())
+    digest.update(json.dumps(parameters, sort_keys=True).encode())
+    return digest.hexdigest()
+
+
+def save_artifacts(
+    artifacts_dir: pathlib.Path,
+    *,
+    key: str,
+    recipe_data: RecipeGraphStore,
+    usage_counts: collections.Counter,
+    cooc_matrix: sparse.csr_matrix,
+    ingredient_counts_vector: np.ndarray,
+    id_to_entities: dict[int, str],
+    id_to_relations: dict[int, str],
+    operations: Mapping[str, dict],
+    metadata_matrix: pd.DataFrame,
+    attribute_masks: AttributeMasks,
+) -> None:
+    """
+    Writes the bundle into a temporary directory first and renames it into place, so a
+    concurrent or interrupted build never leaves a partial bundle behind.
+    """
+    ingredients = list(usage_counts.keys())
+    ingredient_index = {ingredient: i for i, ingredient in enumerate(ingredients)}
+    # recipe ingredient ids are stored in the order of usage_counts, the ingredient axis
+    # of every other artifact
+    store_to_usage = np.array(
+        [ingredient_index[ingredient] for ingredient in recipe_data.ingredients],
+        dtype=np.int32,
+    )
+    if not isinstance(operations, OperationStore):
+        operations = OperationStore.from_operations(operations)
+
+    artifacts_dir.parent.mkdir(parents=True, exist_ok=True)
+    tmp_dir = pathlib.Path(tempfile.mkdtemp(dir=artifacts_dir.parent))
+    try:
+        arrays = {
+            "usage_counts": np.array(list(usage_counts.values()), dtype=np.int64),
+            "cooc_data": cooc_matrix.data,
+            "cooc_indices": cooc_matrix.indices,
+            "cooc_indptr": cooc_matrix.indptr,
+            "ingredient_counts": np.asarray(ingredient_counts_vector),
+            "recipe_ingredient_offsets": np.asarray(recipe_data.ingredient_offsets),
+            "recipe_ingredient_ids": store_to_usage[recipe_data.ingredient_ids],
+            "recipe_edge_offsets": np.asarray(recipe_data.edge_offsets),
+            "recipe_edges": np.asarray(recipe_data.edges),
+            "metadata_matrix": metadata_matrix.to_numpy(dtype=np.float64),
+            "operation_offsets": np.asarray(operations.offsets),
+            "operation_documents": np.asarray(operations.documents),
+            "attribute_bits": np.asarray(attribute_masks.bits),
+        }
+        for name, array in arrays.items():
+            np.save(tmp_dir / f"{name}.npy", array)
+
+        documents = {
+            "nodes.json": list(recipe_data.nodes),
+            "entities.json": id_to_entities,
+            "relations.json": id_to_relations,
+        }
+        for name, document in documents.items():
+            with open(tmp_dir / name, "w") as f:
+                json.dump(document, f)
+
+        manifest = {
+            "version": ARTIFACTS_VERSION,
+            "key": key,
+            "ingredients": ingredients,
+            "recipe_ids": list(recipe_data.keys()),
+            "cooc_shape": list(cooc_matrix.shape),
+            "metadata_index": list(metadata_matrix.index),
+            "metadata_columns": list(metadata_matrix.columns),
+            "operation_keys": list(operations.keys()),
+            # attribute keys in the order of the rows of attribute_bits
+            "attribute_keys": [
+                list(key)
+                for key in sorted(attribute_masks.keys, key=attribute_masks.keys.get)
+            ],
+        }
+        with open(tmp_dir / MANIFEST_FILE, "w") as f:
+            json.dump(manifest, f)
+
+        try:
+            os.replace(tmp_dir, artifacts_dir)
+        except OSError:
+            # another process published the same bundle first
+            shutil.rmtree(tmp_dir)
+    except BaseException:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+
+
+def load_artifacts(artifacts_dir: pathlib.Path, key: str) -> dict | None:
+    """
+    Memory-maps the arrays of a bundle built for `key`, or returns None if there is no
+    such bundle. The returned dict holds the same attributes Recommender._load_data
+    computes from the raw inputs.
+    """
+    manifest_path = artifacts_dir / MANIFEST_FILE
+    if not manifest_path.is_file():
+        return None
+    with open(manifest_path, "r") as f:
+        manifest = json.load(f)
+    if manifest.get("version") != ARTIFACTS_VERSION or manifest.get("key") != key:
+        return None
+
+    def array(name: str) -> np.ndarray:
+        return np.load(artifacts_dir / f"{name}.npy", mmap_mode="r")
+
+    def document(name: str):
+        with open(artifacts_dir / name, "r") as f:
+            return json.load(f)
+
+    ingredients = tuple(manifest["ingredients"])
+    recipe_data = RecipeGraphStore(
+        recipe_ids=manifest["recipe_ids"],
+        nodes=document("nodes.json"),
+        edge_offsets=array("recipe_edge_offsets"),
+        edges=array("recipe_edges"),
+        ingredients=ingredients,
+        ingredient_offsets=array("recipe_ingredient_offsets"),
+        ingredient_ids=array("recipe_ingredient_ids"),
+    )
+    cooc_matrix = sparse.csr_matrix(
+        (array("cooc_data"), array("cooc_indices"), array("cooc_indptr")),
+        shape=tuple(manifest["cooc_shape"]),
+        copy=False,
+    )
+    metadata_matrix = pd.DataFrame(
+        array("metadata_matrix"),
+        index=manifest["metadata_index"],
+        columns=manifest["metadata_columns"],
+        copy=False,
+    )
+    return {
+        "recipe_data": recipe_data,
+        "usage_counts": collections.Counter(
+            dict(zip(ingredients, array("usage_counts").tolist()))
+        ),
+        "cooc_matrix": cooc_matrix,
+        "ingredient_counts_vector": array("ingredient_counts"),
+        "id_to_entities": {int(k): v for k, v in document("entities.json").items()},
+        "id_to_relations": {int(k): v for k, v in document("relations.json").items()},
+        "operations": OperationStore(
+            keys=manifest["operation_keys"],
+            offsets=array("operation_offsets"),
+            documents=array("operation_documents"),
+        ),
+        "metadata_matrix": metadata_matrix,
+        "attribute_masks": AttributeMasks(
+            array("attribute_bits"),
+            {
+                (attribute, value): i
+                for i, (attribute, value) in enumerate(manifest["attribute_keys"])
+            },
+            len(ingredients),
+        ),
+    }
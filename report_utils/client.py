@@ -0,0 +1,167 @@
+import argparse
+import asyncio
+import json
+import random
+import time
+
+import numpy as np
+
+from report_utils.server import DEFAULT_HOST, DEFAULT_PORT
+
+
+class SubstitutionClient:
+    """
+    Minimal keep-alive HTTP/1.1 client for the substitution server, with no dependencies
+    beyond asyncio.
+    """
+
+    def __init__(self, host: str = DEFAULT_HOST, port: int = DEFAULT_PORT):
+        self.host = host
+        self.port = port
+        self._reader: asyncio.StreamReader | None = None
+        self._writer: asyncio.StreamWriter | None = None
+
+    async def _request(
+        self, method: str, target: str, payload: dict | None = None
+    ) -> tuple[int, dict]:
+        if self._writer is None:
+            self._reader, self._writer = await asyncio.open_connection(
+                self.host, self.port
+            )
+        body = b"" if payload is None else json.dumps(payload).encode()
+        self._writer.write(
+            (
+                f"{method} {target} HTTP/1.1\r\n"
+                f"Host: {self.host}\r\n"
+                "Content-Type: application/json\r\n"
+                f"Content-Length: {len(body)}\r\n"
+                "\r\n"
+            ).encode()
+            + body
+        )
+        await self._writer.drain()
+
+        status = int((await self._reader.readline()).split()[1])
+        headers = {}
+        while (line := await self._reader.readline()) not in (b"\r\n", b""):
+            name, value = line.decode().split(":", 1)
+            headers[name.strip().lower()] = value.strip()
+        data = await self._reader.readexactly(int(headers["content-length"]))
+        if headers.get("connection") == "close":
+            await self.close()
+        return status, json.loads(data)
+
+    async def substitutes(
+        self,
+        ingredient: str,
+        recipe_id: str,
+        metrics: list[str] | None = None,
+        k: int = 10,
+    ) -> dict:
+        payload = {"ingredient": ingredient, "recipe_id": recipe_id, "k": k}
+        if metrics is not None:
+            payload["metrics"] = metrics
+        status, response = await self._request("POST", "/substitutes", payload)
+        if status != 200:
+            raise ValueError(response.get("error", f"status {status}"))
+        return response
+
+    async def stats(self) -> dict:
+        return (await self._request("GET", "/stats"))[1]
+
+    async def close(self) -> None:
+        if self._writer is not None:
+            self._writer.close()
+            self._reader = self._writer = None
+
+
+async def load_test(
+    queries: list[tuple[str, str]],
+    *,
+    host: str = DEFAULT_HOST,
+    port: int = DEFAULT_PORT,
+    concurrency: int = 16,
+    n_requests: int = 1000,
+    metrics: list[str] | None = None,
+    seed: int = 0,
+) -> dict:
+    """
+    Sends `n_requests` randomly chosen queries from `concurrency` keep-alive connections
+    and reports client-side throughput and latency percentiles.
+    """
+    rng = random.Random(seed)
+    planned = [rng.choice(queries) for _ in range(n_requests)]
+    latencies = []
+    errors = 0
+
+    async def worker(worker_queries):
+        nonlocal errors
+        client = SubstitutionClient(host, port)
+        try:
+            for ingredient, recipe_id in worker_queries:
+                start = time.perf_counter()
+                try:
+                    await client.substitutes(ingredient, recipe_id, metrics)
+                except ValueError:
+                    errors += 1
+                latencies.append(time.perf_counter() - start)
+        finally:
+            await client.close()
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker(planned[i::concurrency]) for i in range(concurrency)))
+    elapsed = time.perf_counter() - start
+    latencies_ms = np.array(latencies) * 1000
+    return {
+        "requests": n_requests,
+        "errors": errors,
+        "concurrency": concurrency,
+        "throughput_rps": n_requests / elapsed,
+        "p50_ms": float(np.percentile(latencies_ms, 50)),
+        "p99_ms": float(np.percentile(latencies_ms, 99)),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Query or load test a running substitution server"
+    )
+    parser.add_argument("--host", type=str, default=DEFAULT_HOST)
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument(
+        "--queries",
+        type=str,
+        required=True,
+        help="JSON file with a list of [ingredient, recipe_id] pairs",
+    )
+    parser.add_argument("--metrics", type=str, nargs="*", default=None)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 16, 64])
+    parser.add_argument("--n_requests", type=int, default=1000)
+    args = parser.parse_args()
+
+    with open(args.queries, "r") as f:
+        queries = [tuple(query) for query in json.load(f)]
+
+    print("concurrency\trps\tp50_ms\tp99_ms\terrors")
+    for concurrency in args.concurrency:
+        result = asyncio.run(
+            load_test(
+                queries,
+                host=args.host,
+                port=args.port,
+                concurrency=concurrency,
+                n_requests=args.n_requests,
+                metrics=args.metrics,
+            )
+        )
+        print(
+            f"{concurrency}\t{result['throughput_rps']:.1f}\t{result['p50_ms']:.2f}"
+            f"\t{result['p99_ms']:.2f}\t{result['errors']}"
+        )
+
+    async def print_stats():
+        client = SubstitutionClient(args.host, args.port)
+        print(json.dumps(await client.stats(), indent=2))
+        await client.close()
+
+    asyncio.run(print_stats())
@@ -0,0 +1,95 @@
+from typing import Iterable, Mapping
+
+import numpy as np
+import pandas as pd
+
+CATEGORY_ATTRIBUTE = "category"
+
+Constraints = Mapping[str, str | Iterable[str]]
+
+
+class AttributeMasks:
+    """
+    Packed bitsets aligned with the ingredient index, one per ingredient category and per
+    value of every metadata attribute (origin, state, taste, ...). An ingredient has the
+    attribute values of its category.
+
+    Include constraints keep ingredients that match any of the listed values of every
+    constrained attribute. Exclude constraints drop ingredients that match any listed
+    value.
+    """
+
+    def __init__(
+        self,
+        bits: np.ndarray,
+        keys: dict[tuple[str, str], int],
+        n_ingredients: int,
+    ):
+        self.bits = bits
+        self.keys = keys
+        self.n_ingredients = n_ingredients
+        self.attributes = {attribute for attribute, _ in keys}
+
+    @classmethod
+    def build(
+        cls,
+        ingredients: Iterable[str],
+        categorisation: Mapping[str, str],
+        metadata: pd.DataFrame,
+    ) -> "AttributeMasks":
+        ingredients = list(ingredients)
+        keys = {}
+        for category in sorted(set(categorisation.values()) | set(metadata.index)):
+            keys[(CATEGORY_ATTRIBUTE, category)] = len(keys)
+        for attribute in metadata.columns:
+            for value in sorted(metadata[attribute].dropna().astype(str).unique()):
+                keys[(attribute, value)] = len(keys)
+
+        category_keys = {
+            category: [keys[(CATEGORY_ATTRIBUTE, category)]]
+            + [
+                keys[(attribute, str(value))]
+                for attribute, value in row.items()
+                if not pd.isna(value)
+            ]
+            for category, row in metadata.iterrows()
+        }
+        flags = np.zeros((len(keys), len(ingredients)), dtype=bool)
+        for i, ingredient in enumerate(ingredients):
+            category = categorisation.get(ingredient)
+            if category is None:
+                continue
+            flags[
+                category_keys.get(category, [keys[(CATEGORY_ATTRIBUTE, category)]]), i
+            ] = True
+        return cls(np.packbits(flags, axis=1), keys, len(ingredients))
+
+    def _any_of(self, attribute: str, values: str | Iterable[str]) -> np.ndarray:
+        if attribute not in self.attributes:
+            raise ValueError(
+                f"Unknown attribute {attribute!r}, expected one of {sorted(self.attributes)}"
+            )
+        if isinstance(values, str):
+            values = [values]
+        rows = []
+        for value in values:
+            if (attribute, value) not in self.keys:
+                raise ValueError(f"Unknown value {value!r} of attribute {attribute!r}")
+            rows.append(self.keys[(attribute, value)])
+        return np.bitwise_or.reduce(self.bits[rows], axis=0)
+
+    def mask(
+        self,
+        include: Constraints | None = None,
+        exclude: Constraints | None = None,
+    ) -> np.ndarray:
+        """
+        Boolean mask over the ingredient index of the ingredients satisfying the
+        constraints, e.g. `include={"taste": ["sweet", "sour"]}, exclude={"origin": "dairy"}`.
+        """
+        bits = np.full(self.bits.shape[1], 0xFF, dtype=np.uint8)
+        for attribute, values in (include or {}).items():
+            bits &= self._any_of(attribute, values)
+        for attribute, values in (exclude or {}).items():
+            bits &= ~self._any_of(attribute, values)
+        return np.unpackbits(bits, count=self.n_ingredients).astype(bool)
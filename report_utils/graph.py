@@ -1,7 +1,16 @@
 import dataclasses
 import collections
+import functools
 import itertools
+import time
+import tracemalloc
+from collections.abc import Mapping
+from typing import Iterator
+
 import networkx as nx
+import numpy as np
+
+from eatpim.ranking.actions import leaf_downstream_actions
 
 PREDICATE_PREFIX = "pred_"
 
@@ -14,14 +23,246 @@ class RecipeData:
     def ingredient_actions(self, ingredient: str) -> set[str]:
         if ingredient not in self.ingredients:
             raise ValueError(f"Ingredient {ingredient} not in recipe")
+        return leaf_downstream_actions(self.graph.edges(), [ingredient])[ingredient]
+
+
+class RecipeGraphView:
+    """
+    RecipeData interface over one recipe of a RecipeGraphStore. The ingredient set and
+    the networkx graph are only built when they are first accessed.
+    """
+
+    def __init__(self, store: "RecipeGraphStore", position: int):
+        self.store = store
+        self.position = position
+
+    @functools.cached_property
+    def ingredients(self) -> set[str]:
+        return set(self.store.ingredient_names(self.position))
+
+    @functools.cached_property
+    def graph(self) -> nx.DiGraph:
+        graph = nx.DiGraph()
+        graph.add_edges_from(self.store.edge_names(self.position))
+        return graph
+
+    def ingredient_actions(self, ingredient: str) -> set[str]:
+        return self.store.ingredient_actions(self.position, ingredient)
+
+
+@dataclasses.dataclass
+class ActionIndex:
+    """
+    Downstream actions of every (recipe, ingredient) entry of a RecipeGraphStore, and
+    the inverted index from action to entries. Entries are numbered like the store's
+    ingredient_ids, so entry e is ingredient ingredient_ids[e] of the recipe whose
+    ingredient_offsets range contains e.
+    """
+
+    actions: tuple[str, ...]
+    action_ids: dict[str, int]
+    # sorted action ids of entry e, delimited by entry_offsets[e:e + 2]
+    entry_offsets: np.ndarray
+    entry_actions: np.ndarray
+    # entries that flow through action a, delimited by action_offsets[a:a + 2]
+    action_offsets: np.ndarray
+    action_entries: np.ndarray
+
+    @classmethod
+    def build(cls, store: "RecipeGraphStore") -> "ActionIndex":
+        action_ids = {}
+        entry_offsets = [0]
+        entry_actions = []
+        for position in range(len(store)):
+            ingredients = store.ingredient_names(position)
+            downstream = leaf_downstream_actions(
+                store.edge_names(position), ingredients
+            )
+            for ingredient in ingredients:
+                entry_actions.extend(
+                    sorted(
+                        action_ids.setdefault(action, len(action_ids))
+                        for action in downstream[ingredient]
+                    )
+                )
+                entry_offsets.append(len(entry_actions))
+
+        entry_offsets = np.array(entry_offsets, dtype=np.int64)
+        entry_actions = np.array(entry_actions, dtype=np.int32)
+        pair_entries = np.repeat(
+            np.arange(len(entry_offsets) - 1, dtype=np.int64), np.diff(entry_offsets)
+        )
+        action_offsets = np.zeros(len(action_ids) + 1, dtype=np.int64)
+        np.cumsum(
+            np.bincount(entry_actions, minlength=len(action_ids)),
+            out=action_offsets[1:],
+        )
+        return cls(
+            actions=tuple(action_ids),
+            action_ids=action_ids,
+            entry_offsets=entry_offsets,
+            entry_actions=entry_actions,
+            action_offsets=action_offsets,
+            action_entries=pair_entries[np.argsort(entry_actions, kind="stable")],
+        )
+
+    def entry_action_names(self, entry: int) -> set[str]:
         return {
-            node.split("_")[1]
-            for node in nx.dfs_successors(self.graph, ingredient).keys()
-            if node != ingredient
+            self.actions[a]
+            for a in self.entry_actions[
+                self.entry_offsets[entry] : self.entry_offsets[entry + 1]
+            ]
         }
 
+    def entries_with_action(self, action: str) -> np.ndarray:
+        a = self.action_ids.get(action)
+        if a is None:
+            return np.empty(0, dtype=np.int64)
+        return self.action_entries[self.action_offsets[a] : self.action_offsets[a + 1]]
+
+
+class RecipeGraphStore(Mapping):
+    """
+    Read-only mapping of recipe id to the recipe's flow graph and ingredients, stored as
+    flat arrays instead of one networkx graph per recipe.
+
+    Node names are interned once for the whole corpus. The edges of recipe i are the
+    rows edge_offsets[i] to edge_offsets[i + 1] of an (n_edges, 2) array of node ids, and
+    its ingredients the same range of ingredient_ids delimited by ingredient_offsets,
+    indexing into `ingredients`. The arrays may be memory-mapped.
+    """
+
+    def __init__(
+        self,
+        recipe_ids: list[str],
+        nodes: list[str],
+        edge_offsets: np.ndarray,
+        edges: np.ndarray,
+        ingredients: tuple[str, ...],
+        ingredient_offsets: np.ndarray,
+        ingredient_ids: np.ndarray,
+    ):
+        self.recipe_ids = recipe_ids
+        self.positions = {recipe_id: i for i, recipe_id in enumerate(recipe_ids)}
+        self.nodes = nodes
+        self.edge_offsets = edge_offsets
+        self.edges = edges
+        self.ingredients = ingredients
+        self.ingredient_offsets = ingredient_offsets
+        self.ingredient_ids = ingredient_ids
 
-def parse_graph_tree(
+    @classmethod
+    def from_graph_tree(
+        cls, graph_tree: dict, valid_ingredients: set[str]
+    ) -> "RecipeGraphStore":
+        node_index = {}
+        ingredient_index = {}
+        edge_offsets = [0]
+        edges = []
+        ingredient_offsets = [0]
+        ingredient_ids = []
+        for graph_data in graph_tree.values():
+            recipe_nodes = {}
+            for u, v in graph_data["edges"]:
+                for node in (u, v):
+                    if node not in recipe_nodes:
+                        recipe_nodes[node] = node_index.setdefault(
+                            node, len(node_index)
+                        )
+                edges.append((recipe_nodes[u], recipe_nodes[v]))
+            edge_offsets.append(len(edges))
+            ingredient_ids.extend(
+                ingredient_index.setdefault(node, len(ingredient_index))
+                for node in recipe_nodes
+                if not node.startswith(PREDICATE_PREFIX) and node in valid_ingredients
+            )
+            ingredient_offsets.append(len(ingredient_ids))
+        return cls(
+            recipe_ids=list(graph_tree.keys()),
+            nodes=list(node_index),
+            edge_offsets=np.array(edge_offsets, dtype=np.int64),
+            edges=np.array(edges, dtype=np.int32).reshape(-1, 2),
+            ingredients=tuple(ingredient_index),
+            ingredient_offsets=np.array(ingredient_offsets, dtype=np.int64),
+            ingredient_ids=np.array(ingredient_ids, dtype=np.int32),
+        )
+
+    def __getitem__(self, recipe_id: str) -> RecipeGraphView:
+        return RecipeGraphView(self, self.positions[recipe_id])
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.recipe_ids)
+
+    def __len__(self) -> int:
+        return len(self.recipe_ids)
+
+    def recipe_ingredient_ids(self, position: int) -> np.ndarray:
+        return self.ingredient_ids[
+            self.ingredient_offsets[position] : self.ingredient_offsets[position + 1]
+        ]
+
+    def ingredient_names(self, position: int) -> list[str]:
+        return [self.ingredients[i] for i in self.recipe_ingredient_ids(position)]
+
+    def edge_names(self, position: int) -> list[tuple[str, str]]:
+        return [
+            (self.nodes[u], self.nodes[v])
+            for u, v in self.edges[
+                self.edge_offsets[position] : self.edge_offsets[position + 1]
+            ].tolist()
+        ]
+
+    def recipe_ingredients(self, recipe_id: str) -> set[str]:
+        return set(self.ingredient_names(self.positions[recipe_id]))
+
+    @functools.cached_property
+    def ingredient_index(self) -> dict[str, int]:
+        return {ingredient: i for i, ingredient in enumerate(self.ingredients)}
+
+    @functools.cached_property
+    def action_index(self) -> ActionIndex:
+        return ActionIndex.build(self)
+
+    def ingredient_actions(self, position: int, ingredient: str) -> set[str]:
+        """
+        Actions the ingredient flows through in the recipe at `position`.
+        """
+        ingredient_id = self.ingredient_index.get(ingredient)
+        matches = np.flatnonzero(self.recipe_ingredient_ids(position) == ingredient_id)
+        if ingredient_id is None or not len(matches):
+            raise ValueError(f"Ingredient {ingredient} not in recipe")
+        entry = self.ingredient_offsets[position] + matches[0]
+        return self.action_index.entry_action_names(entry)
+
+    def action_occurrences(self, action: str) -> list[tuple[str, str]]:
+        """
+        (recipe id, ingredient) pairs of every ingredient that flows through the action.
+        """
+        entries = self.action_index.entries_with_action(action)
+        positions = np.searchsorted(self.ingredient_offsets, entries, side="right") - 1
+        return [
+            (self.recipe_ids[position], self.ingredients[self.ingredient_ids[entry]])
+            for position, entry in zip(positions.tolist(), entries.tolist())
+        ]
+
+    def usage_counts(self) -> collections.Counter[str, int]:
+        """
+        Number of recipes each ingredient occurs in, keyed in order of first occurrence.
+        """
+        counts = np.bincount(self.ingredient_ids, minlength=len(self.ingredients))
+        return collections.Counter(
+            {
+                ingredient: int(count)
+                for ingredient, count in zip(self.ingredients, counts)
+            }
+        )
+
+
+def parse_graph_tree(graph_tree: dict, valid_ingredients: set[str]) -> RecipeGraphStore:
+    return RecipeGraphStore.from_graph_tree(graph_tree, valid_ingredients)
+
+
+def parse_graph_tree_eager(
     graph_tree: dict, valid_ingredients: set[str]
 ) -> dict[str, RecipeData]:
     recipes = {}
@@ -37,9 +278,36 @@ def parse_graph_tree(
     return recipes
 
 
+def memory_benchmark(graph_tree: dict, valid_ingredients: set[str]) -> dict:
+    """
+    Peak traced memory and build time of the eager networkx recipes against the compact
+    store, for the same parsed recipe tree data.
+    """
+    results = {}
+    for name, parse in [
+        ("networkx", parse_graph_tree_eager),
+        ("compact", parse_graph_tree),
+    ]:
+        tracemalloc.start()
+        start = time.perf_counter()
+        recipes = parse(graph_tree, valid_ingredients)
+        elapsed = time.perf_counter() - start
+        retained, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        results[name] = {
+            "seconds": elapsed,
+            "retained_mib": retained / 2**20,
+            "peak_mib": peak / 2**20,
+        }
+        del recipes
+    return results
+
+
 def get_ingredient_usage_counts_from_recipies(
-    all_recipes: dict[str, RecipeData]
+    all_recipes: Mapping[str, RecipeData]
 ) -> collections.Counter[str, int]:
+    if isinstance(all_recipes, RecipeGraphStore):
+        return all_recipes.usage_counts()
     counts = collections.Counter(
         itertools.chain.from_iterable(
             recipe.ingredients for recipe in all_recipes.values()
@@ -62,3 +330,9 @@ if __name__ == "__main__":
         itertools.chain.from_iterable(recipe.ingredients for recipe in recipes.values())
     )
     print("Usage count:", sum(counts.values()))
+
+    for name, result in memory_benchmark(graph_tree, ingredients).items():
+        print(
+            f"{name}: {result['retained_mib']:.1f} MiB retained, "
+            f"{result['peak_mib']:.1f} MiB peak, {result['seconds']:.2f}s"
+        )
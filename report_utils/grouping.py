@@ -1,3 +1,5 @@
+import collections
+import functools
 import re
 import typing
 
@@ -33,6 +35,136 @@ def is_part_of_group(group: str, ingredient: str) -> bool:
     return False
 
 
+class _AhoCorasick:
+    """
+    Automaton reporting every pattern that occurs in a text in a single pass over it.
+    """
+
+    def __init__(self, patterns: list[str]):
+        self.goto: list[dict[str, int]] = [{}]
+        self.fail = [0]
+        self.outputs: list[list[int]] = [[]]
+        for pattern_id, pattern in enumerate(patterns):
+            state = 0
+            for char in pattern:
+                if char not in self.goto[state]:
+                    self.goto[state][char] = len(self.goto)
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.outputs.append([])
+                state = self.goto[state][char]
+            self.outputs[state].append(pattern_id)
+
+        queue = collections.deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, child in self.goto[state].items():
+                queue.append(child)
+                fallback = self.fail[state]
+                while fallback and char not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                self.fail[child] = self.goto[fallback].get(char, 0)
+                self.outputs[child] = (
+                    self.outputs[child] + self.outputs[self.fail[child]]
+                )
+
+    def search(self, text: str) -> typing.Iterator[int]:
+        state = 0
+        for char in text:
+            while state and char not in self.goto[state]:
+                state = self.fail[state]
+            state = self.goto[state].get(char, 0)
+            yield from self.outputs[state]
+
+
+class GroupMatcher:
+    """
+    Compiled form of a groups dict, giving the same result as testing every sub-group
+    with `is_part_of_group` in order and taking the first match.
+
+    Single-word sub-groups match when they occur in a token that starts with the same
+    character, so all of them are found with one Aho-Corasick pass over the tokens. A
+    multi-word sub-group matches when every one of its characters occurs in the
+    ingredient (which includes it occurring as a substring), checked as a set inclusion.
+    """
+
+    def __init__(self, groups: dict[str, typing.Iterable[str]]):
+        # (group, sub_group) in priority order
+        self.entries = [
+            (group, sub_group)
+            for group, sub_groups in groups.items()
+            for sub_group in sub_groups
+        ]
+        patterns = {}
+        self.multiword = []
+        for priority, (_, sub_group) in enumerate(self.entries):
+            if not sub_group:
+                raise ValueError("Sub-groups must not be empty")
+            if " " in sub_group:
+                self.multiword.append((priority, frozenset(sub_group)))
+            else:
+                # a sub-group listed twice only matters at its first position
+                patterns.setdefault(sub_group, priority)
+        self.patterns = list(patterns)
+        self.pattern_priorities = list(patterns.values())
+        self.automaton = _AhoCorasick(self.patterns)
+
+    def match(self, ingredient: str) -> tuple[str, str] | None:
+        best = len(self.entries)
+        for token in ingredient.split(" "):
+            if not token:
+                continue
+            for pattern_id in self.automaton.search(token):
+                if (
+                    self.pattern_priorities[pattern_id] < best
+                    and self.patterns[pattern_id][0] == token[0]
+                ):
+                    best = self.pattern_priorities[pattern_id]
+
+        characters = set(ingredient)
+        for priority, sub_group_characters in self.multiword:
+            if priority >= best:
+                break
+            if sub_group_characters <= characters:
+                best = priority
+                break
+        return self.entries[best] if best < len(self.entries) else None
+
+    def find_group(self, ingredient: str) -> str:
+        match = self.match(ingredient)
+        return "uncategorized" if match is None else match[1]
+
+    def group_ingredients(
+        self, ingredients: typing.Iterable[str]
+    ) -> IngredientGrouping:
+        map_groups = {}
+        for group, sub_group in self.entries:
+            map_groups.setdefault(group, {})[sub_group] = []
+        for ingredient in ingredients:
+            match = self.match(ingredient)
+            if match is None:
+                map_groups["uncategorized"]["uncategorized"].append(ingredient)
+            else:
+                map_groups[match[0]][match[1]].append(ingredient)
+        return map_groups
+
+
+@functools.lru_cache(maxsize=8)
+def _cached_matcher(
+    frozen_groups: tuple[tuple[str, tuple[str, ...]], ...],
+) -> GroupMatcher:
+    return GroupMatcher(dict(frozen_groups))
+
+
+def compile_groups(groups: dict[str, typing.Iterable[str]]) -> GroupMatcher:
+    """
+    GroupMatcher for `groups`, reused across calls with the same groups.
+    """
+    return _cached_matcher(
+        tuple((group, tuple(sub_groups)) for group, sub_groups in groups.items())
+    )
+
+
 def initialize_grouping(groups: dict[str, list[str]]) -> IngredientGrouping:
     ingredient_map = {}
     for group, sub_groups in groups.items():
@@ -44,6 +176,16 @@ def initialize_grouping(groups: dict[str, list[str]]) -> IngredientGrouping:
 
 def group_ingredients(
     ingredients: typing.Iterable[str], groups: dict[str, typing.Iterable[str]]
+) -> IngredientGrouping:
+    return compile_groups(groups).group_ingredients(ingredients)
+
+
+def find_group(ingredient: str, groups: dict[str, typing.Iterable[str]]):
+    return compile_groups(groups).find_group(ingredient)
+
+
+def group_ingredients_reference(
+    ingredients: typing.Iterable[str], groups: dict[str, typing.Iterable[str]]
 ) -> IngredientGrouping:
     map_groups = initialize_grouping(groups)
     for ingredient in ingredients:
@@ -61,7 +203,7 @@ def group_ingredients(
     return map_groups
 
 
-def find_group(ingredient: str, groups: dict[str, typing.Iterable[str]]):
+def find_group_reference(ingredient: str, groups: dict[str, typing.Iterable[str]]):
     for group, sub_groups in groups.items():
         for sub_group in sub_groups:
             if is_part_of_group(sub_group, ingredient):
@@ -76,3 +218,38 @@ def invert_grouping(grouping: IngredientGrouping) -> dict[str, list[str]]:
         for key, lst in grouping[group].items()
         for val in lst
     }
+
+
+if __name__ == "__main__":
+    # equivalence check of the compiled matcher against the reference implementation
+    import json
+    import time
+
+    with open("./processed/grouping.json") as f:
+        groups = json.load(f)
+    with open("./data/recipe_parsed_sm/ingredient_list.json") as f:
+        ingredients = json.load(f)
+    # words and multi-word phrases from the ingredients, to cover more tokens
+    ingredients += sorted({word for ing in ingredients for word in ing.split(" ")})
+    ingredients += [" ".join(reversed(ing.split(" "))) for ing in ingredients]
+
+    start = time.perf_counter()
+    reference = group_ingredients_reference(ingredients, groups)
+    reference_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    compiled = group_ingredients(ingredients, groups)
+    compiled_seconds = time.perf_counter() - start
+    assert compiled == reference, "compiled grouping differs from the reference"
+
+    nested_groups = compiled
+    for ingredient in ingredients[:2000]:
+        assert find_group(ingredient, groups) == find_group_reference(
+            ingredient, groups
+        )
+        assert find_group(ingredient, nested_groups) == find_group_reference(
+            ingredient, nested_groups
+        )
+    print(
+        f"{len(ingredients)} ingredients grouped identically: "
+        f"reference {reference_seconds:.2f}s, compiled {compiled_seconds:.2f}s"
+    )
@@ -1,13 +1,84 @@
+import json
+from collections import OrderedDict
+from typing import Any, Hashable, Iterable, Sequence
+
 import numpy as np
 
-from typing import Iterable
+from eatpim.ranking import (
+    EmbeddingIndex,
+    IVFIndex,
+    TransESubstitution,
+    batch_cosine_similarities,
+)
+
+DEFAULT_RECIPE_CACHE_SIZE = 256
+DEFAULT_SCORE_CACHE_SIZE = 4096
+DEFAULT_CANDIDATE_CACHE_SIZE = 16
+
+
+class LRUCache:
+    """
+    Bounded least-recently-used mapping with hit, miss and eviction counters.
+    """
+
+    def __init__(self, maxsize: int):
+        if maxsize < 0:
+            raise ValueError(f"maxsize must be non-negative, got {maxsize}")
+        self.maxsize = maxsize
+        self._entries: OrderedDict[Hashable, Any] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: Hashable) -> Any | None:
+        try:
+            value = self._entries[key]
+        except KeyError:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key: Hashable, value: Any) -> None:
+        if self.maxsize == 0:
+            return
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self) -> None:
+        self._entries.clear()
 
-from sklearn.metrics.pairwise import cosine_similarity
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "size": len(self._entries),
+            "maxsize": self.maxsize,
+        }
+
+
+def _recipe_key(recipe_ops: dict | str) -> str:
+    # operation trees are plain nested dicts and lists loaded from JSON
+    return json.dumps(recipe_ops, sort_keys=True)
 
 
 class KnowledgeGraphCalculator:
     """
     Calculator for performing operations and similarity calculations on knowledge graph embeddings.
+
+    Compiled recipe trees and the output similarities of every (recipe, ingredient) pair are
+    kept in bounded LRU caches keyed by `model_id`, so repeated queries for the same recipe
+    skip the tree walk and the matrix product. The embeddings and indexes of the candidate
+    lists in use are kept in LRU caches as well, since constrained queries each bring their
+    own candidate subset. All caches are dropped by `reload_embeddings`.
     """
 
     def __init__(
@@ -16,50 +87,171 @@ class KnowledgeGraphCalculator:
         entity_id_mapping: dict[str, int],
         relation_embeddings: np.ndarray,
         relation_id_mapping: dict[str, int],
+        ann_index: IVFIndex | None = None,
+        model_id: str | None = None,
+        recipe_cache_size: int = DEFAULT_RECIPE_CACHE_SIZE,
+        score_cache_size: int = DEFAULT_SCORE_CACHE_SIZE,
+        candidate_cache_size: int = DEFAULT_CANDIDATE_CACHE_SIZE,
     ):
-        self.entity_embeddings = entity_embeddings
         self.entity_id_mapping = entity_id_mapping
         self.id_to_entity = {v: k for k, v in entity_id_mapping.items()}
-        self.relation_embeddings = relation_embeddings
         self.relation_id_mapping = relation_id_mapping
         self.id_to_relation = {v: k for k, v in relation_id_mapping.items()}
+        self._recipe_cache = LRUCache(recipe_cache_size)
+        self._score_cache = LRUCache(score_cache_size)
+        # candidate lists are interned so score cache keys do not hash thousands of names.
+        # ids are never reused, so scores of an evicted list can not be served for another
+        self._candidate_list_ids = LRUCache(candidate_cache_size)
+        self._next_candidate_list_id = 0
+        self._candidate_embeddings_cache = LRUCache(candidate_cache_size)
+        self._ingredient_indexes = LRUCache(candidate_cache_size)
+        self.reload_embeddings(
+            entity_embeddings,
+            relation_embeddings,
+            model_id=model_id,
+            ann_index=ann_index,
+        )
 
-    def _transE_calculation(
-        self, ops: dict | np.ndarray, rem_ing: str, rep_ing: str | None = None
-    ) -> np.ndarray:
-        if not isinstance(ops, dict):
-            if ops == rem_ing and rep_ing is not None:
-                ops = rep_ing
-            head = self.entity_embeddings[self.entity_id_mapping[ops]]
-            return head
+    def reload_embeddings(
+        self,
+        entity_embeddings: np.ndarray,
+        relation_embeddings: np.ndarray,
+        model_id: str | None = None,
+        ann_index: IVFIndex | None = None,
+    ) -> None:
+        """
+        Swaps in new embeddings for the same entities and relations, discarding everything
+        computed from the previous ones.
 
-        relation_name, entity_list = next(iter(ops.items()))
+        The approximate nearest neighbour index is replaced by `ann_index` as well, since an
+        index of the previous embeddings would return their neighbours. Without one,
+        `find_similar_entities` is unavailable until an index of the new embeddings is
+        passed in again.
+        """
+        if ann_index is not None and ann_index.signature is not None:
+            index_shape = tuple(ann_index.signature[:2].tolist())
+            if index_shape != entity_embeddings.shape:
+                raise ValueError(
+                    f"ANN index was built for embeddings of shape {index_shape}, "
+                    f"not {entity_embeddings.shape}"
+                )
+        self.entity_embeddings = entity_embeddings
+        self.relation_embeddings = relation_embeddings
+        self.model_id = model_id
+        self.ann_index = ann_index
+        self._recipe_cache.clear()
+        self._score_cache.clear()
+        self._candidate_list_ids.clear()
+        self._candidate_embeddings_cache.clear()
+        self._ingredient_indexes.clear()
 
-        relation = self.relation_embeddings[self.relation_id_mapping[relation_name]]
+    def cache_stats(self) -> dict[str, dict[str, int]]:
+        return {
+            "recipes": self._recipe_cache.stats(),
+            "scores": self._score_cache.stats(),
+            "candidate_embeddings": self._candidate_embeddings_cache.stats(),
+            "ingredient_indexes": self._ingredient_indexes.stats(),
+        }
 
-        entity_list_mod = [
-            self._transE_calculation(ent, rem_ing, rep_ing) for ent in entity_list
-        ]
-        head_content = np.mean(np.array(entity_list_mod), axis=0)
-        stacked_score = head_content + relation
+    def compile_recipe(
+        self, recipe_ops: dict, recipe_key: str | None = None
+    ) -> dict[str, TransESubstitution]:
+        key = (self.model_id, recipe_key or _recipe_key(recipe_ops))
+        substitutions = self._recipe_cache.get(key)
+        if substitutions is None:
+            substitutions = TransESubstitution.compile_leaves(
+                ops=recipe_ops,
+                ent_embs=self.entity_embeddings,
+                entity2id=self.entity_id_mapping,
+                rel_embs=self.relation_embeddings,
+                relation2id=self.relation_id_mapping,
+            )
+            self._recipe_cache.put(key, substitutions)
+        return substitutions
+
+    def _candidate_list_id(self, candidates: tuple[str, ...]) -> int:
+        candidates_id = self._candidate_list_ids.get(candidates)
+        if candidates_id is None:
+            candidates_id = self._next_candidate_list_id
+            self._next_candidate_list_id += 1
+            self._candidate_list_ids.put(candidates, candidates_id)
+        return candidates_id
+
+    def _candidate_embeddings(self, all_ingredients: Iterable[str]) -> np.ndarray:
+        key = tuple(all_ingredients)
+        embeddings = self._candidate_embeddings_cache.get(key)
+        if embeddings is None:
+            embeddings = self.entity_embeddings[
+                [self.entity_id_mapping[ing] for ing in key]
+            ].astype(np.float64)
+            self._candidate_embeddings_cache.put(key, embeddings)
+        return embeddings
 
-        return stacked_score
+    def calculate_output_similarities(
+        self,
+        target_recipe: str | None,
+        recipe_ops: dict,
+        replace_ings: Sequence[str],
+        all_ingredients: Iterable[str],
+    ) -> np.ndarray:
+        """
+        Ingredient output and recipe output similarities for replacing each of
+        `replace_ings` in the recipe, shaped (len(replace_ings), 2, n_ingredients). Without
+        a `target_recipe` only the ingredient output similarities are computed, shaped
+        (len(replace_ings), 1, n_ingredients).
+
+        The recipe tree is compiled once and every candidate of every replaced ingredient
+        that is not cached yet is scored in a single matrix product.
+        """
+        recipe_key = _recipe_key(recipe_ops)
+        candidates = tuple(all_ingredients)
+        candidates_id = self._candidate_list_id(candidates)
+        keys = [
+            (self.model_id, target_recipe, recipe_key, ing, candidates_id)
+            for ing in replace_ings
+        ]
+        scores = [self._score_cache.get(key) for key in keys]
+        missing = [i for i, score in enumerate(scores) if score is None]
+        if missing:
+            substitutions = self.compile_recipe(recipe_ops, recipe_key)
+            base = next(iter(substitutions.values())).base
+            targets = [base]
+            if target_recipe is not None:
+                targets.append(
+                    self.entity_embeddings[self.entity_id_mapping[target_recipe]]
+                )
+            selected = TransESubstitution.for_ingredients(
+                substitutions,
+                [replace_ings[i] for i in missing],
+                self.entity_embeddings,
+                self.entity_id_mapping,
+            )
+            computed = batch_cosine_similarities(
+                selected,
+                self._candidate_embeddings(candidates),
+                targets,
+            )
+            for i, score in zip(missing, computed):
+                # cached arrays are shared between calls
+                score.flags.writeable = False
+                scores[i] = score
+                self._score_cache.put(keys[i], score)
+        return np.stack(scores)
 
     def calculate_ingredient_output_similarity(
         self,
         recipe_ops: dict | np.ndarray,
         replace_ing: str,
         all_ingredients: Iterable[str],
-    ) -> tuple[np.ndarray, np.ndarray]:
-        original_calc_vec = self._transE_calculation(recipe_ops, replace_ing)
-        calculated_sim_vec = np.zeros(len(all_ingredients))
-        for i, ing in enumerate(all_ingredients):
-            calc_recipe_vec = self._transE_calculation(recipe_ops, replace_ing, ing)
-
-            calculated_sim_vec[i] = cosine_similarity(
-                original_calc_vec.reshape(1, -1), calc_recipe_vec.reshape(1, -1)
-            )[0][0]
-        return calculated_sim_vec
+        target_recipe: str | None = None,
+    ) -> np.ndarray:
+        """
+        With `target_recipe` the scores are shared with
+        `calculate_recipe_output_similarity` through the score cache.
+        """
+        return self.calculate_output_similarities(
+            target_recipe, recipe_ops, [replace_ing], all_ingredients
+        )[0, 0]
 
     def calculate_recipe_output_similarity(
         self,
@@ -67,27 +259,60 @@ class KnowledgeGraphCalculator:
         recipe_ops: dict | np.ndarray,
         replace_ing: str,
         all_ingredients: Iterable[str],
-    ) -> tuple[np.ndarray, np.ndarray]:
-        original_recipe_vec = self.entity_embeddings[
-            self.entity_id_mapping[target_recipe]
-        ]
-        recipe_output_vec = np.zeros(len(all_ingredients))
-        for i, ing in enumerate(all_ingredients):
-            calc_recipe_vec = self._transE_calculation(recipe_ops, replace_ing, ing)
-            recipe_output_vec[i] = cosine_similarity(
-                original_recipe_vec.reshape(1, -1), calc_recipe_vec.reshape(1, -1)
-            )[0][0]
+    ) -> np.ndarray:
+        return self.calculate_output_similarities(
+            target_recipe, recipe_ops, [replace_ing], all_ingredients
+        )[0, 1]
 
-        return recipe_output_vec
+    def ingredient_index(self, all_ingredients: Iterable[str]) -> EmbeddingIndex:
+        key = tuple(all_ingredients)
+        index = self._ingredient_indexes.get(key)
+        if index is None:
+            index = EmbeddingIndex.from_entities(
+                self.entity_embeddings, self.entity_id_mapping, key
+            )
+            self._ingredient_indexes.put(key, index)
+        return index
 
     def calculate_individual_ingredient_similarity(
         self, target_ing: str, all_ingredients: Iterable[str]
     ) -> np.ndarray:
         target_ing_emb = self.entity_embeddings[self.entity_id_mapping[target_ing]]
-        sims = cosine_similarity(target_ing_emb.reshape(1, -1), self.entity_embeddings)[
-            0
+        return self.ingredient_index(all_ingredients).similarities(target_ing_emb)
+
+    def calculate_individual_ingredient_similarities(
+        self,
+        target_ings: Sequence[str],
+        all_ingredients: Iterable[str],
+        rows: np.ndarray | None = None,
+    ) -> np.ndarray:
+        """
+        Embedding similarities of every target to `all_ingredients`, or with `rows` only to
+        those positions of `all_ingredients`.
+        """
+        target_ing_embs = self.entity_embeddings[
+            [self.entity_id_mapping[ing] for ing in target_ings]
+        ]
+        return np.atleast_2d(
+            self.ingredient_index(all_ingredients).similarities(
+                target_ing_embs, rows=rows
+            )
+        )
+
+    def find_similar_entities(
+        self, target: str, k: int = 10, n_probe: int = 8
+    ) -> list[tuple[str, float]]:
+        """
+        Approximate top-k entities (ingredients, FoodOn classes or recipe outputs) whose
+        embedding is most similar to the target's. Requires an ANN index built with
+        `eatpim/ranking/ann.py`.
+        """
+        if self.ann_index is None:
+            raise ValueError("No approximate nearest neighbour index was loaded")
+        target_emb = self.entity_embeddings[self.entity_id_mapping[target]]
+        ids, scores = self.ann_index.search(target_emb, k=k, n_probe=n_probe)
+        return [
+            (self.id_to_entity[i], float(score))
+            for i, score in zip(ids[0], scores[0])
+            if i >= 0
         ]
-        result = np.zeros(len(all_ingredients))
-        for i, ing in enumerate(all_ingredients):
-            result[i] = sims[self.entity_id_mapping[ing]]
-        return result
@@ -7,8 +7,13 @@ import numpy as np
 def load_embedding_data(
     embedding_path: pathlib.Path,
 ) -> tuple[np.ndarray, np.ndarray]:
-    ent_embs = np.load((embedding_path / "entity_embedding.npy").resolve())
-    rel_embs = np.load((embedding_path / "relation_embedding.npy").resolve())
+    # memory-mapped, so only the rows that are looked up get read from disk
+    ent_embs = np.load(
+        (embedding_path / "entity_embedding.npy").resolve(), mmap_mode="r"
+    )
+    rel_embs = np.load(
+        (embedding_path / "relation_embedding.npy").resolve(), mmap_mode="r"
+    )
     return ent_embs, rel_embs
 
 
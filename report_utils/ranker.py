@@ -0,0 +1,261 @@
+import contextlib
+import dataclasses
+import time
+import tracemalloc
+
+import numpy as np
+
+from eatpim.ranking import cooccurrence
+from eatpim.ranking.embedding_index import top_k_rows
+from report_utils.constraints import Constraints
+from report_utils.recommender import Recommender, SimilarityMetric
+
+DEFAULT_RANKING_WEIGHTS = {
+    SimilarityMetric.SIMPLE_COSINE: 0.5,
+    SimilarityMetric.TARGET_COSINE: 0.5,
+    SimilarityMetric.RECIPE_OUTPUT: 1,
+    SimilarityMetric.INGREDIENT_OUTPUT: 1,
+    SimilarityMetric.INDIVIDUAL_INGREDIENT: 0.5,
+    SimilarityMetric.METADATA_WEIGHTED: 1,
+}
+
+
+@dataclasses.dataclass
+class PartProfile:
+    seconds: float
+    peak_bytes: int | None = None
+
+
+@dataclasses.dataclass
+class RankedSubstitute:
+    ingredient: str
+    score: float
+    breakdown: dict[SimilarityMetric, float]
+
+
+@dataclasses.dataclass
+class RankingResult:
+    substitutes: list[RankedSubstitute]
+    profile: dict[str, PartProfile]
+
+
+class FusedRanker:
+    """
+    Ranks substitutes by a weighted blend of all similarity metrics in a single pass.
+
+    The parts shared between metrics are computed once per query: the target's
+    co-occurrence row feeds both co-occurrence metrics, and the compiled recipe tree gives
+    both the ingredient output and the recipe output similarities. Co-occurrence row norms
+    are prepared once at construction, and metadata similarities are gathered from the
+    recommender's precomputed category similarity matrix.
+    """
+
+    def __init__(
+        self,
+        recommender: Recommender,
+        weights: dict[SimilarityMetric, float] = DEFAULT_RANKING_WEIGHTS,
+    ):
+        if sum(weights.values()) <= 0:
+            raise ValueError("At least one metric needs a positive weight")
+        self.recommender = recommender
+        self.weights = {metric: w for metric, w in weights.items() if w}
+        self.total_weight = sum(self.weights.values())
+
+        cooc_matrix = recommender.cooc_matrix.astype(np.float64).tocsr()
+        self._cooc_matrix = cooc_matrix
+        self._cooc_row_norms = np.sqrt(
+            np.asarray(cooc_matrix.multiply(cooc_matrix).sum(axis=1)).reshape(-1)
+        )
+
+    def rank(
+        self,
+        ingredient: str,
+        recipe_id: str,
+        k: int = 10,
+        exclude_target: bool = True,
+        trace_memory: bool = False,
+        include: Constraints | None = None,
+        exclude: Constraints | None = None,
+    ) -> RankingResult:
+        """
+        Top k substitutes for `ingredient` in the recipe, with the unweighted score of every
+        metric next to the blended score. The profile holds the latency of each part and,
+        with `trace_memory`, its peak traced allocation in bytes.
+
+        `include` and `exclude` constrain the candidates by category and metadata attribute
+        values (see `AttributeMasks.mask`). Candidates ruled out by them are never scored.
+        """
+        recommender = self.recommender
+        target_idx = recommender.ingredient_index_maping[ingredient]
+        scores = {}
+        profile = {}
+
+        # None scores every ingredient, otherwise only these rows of the ingredient index
+        candidates = None
+        if include or exclude:
+            with _profiled(profile, "constraints", trace_memory):
+                mask = recommender.attribute_masks.mask(include, exclude)
+                if exclude_target:
+                    mask[target_idx] = False
+                candidates = np.flatnonzero(mask)
+            if not len(candidates):
+                return RankingResult(substitutes=[], profile=profile)
+
+        needs_cooc = self.weights.keys() & {
+            SimilarityMetric.SIMPLE_COSINE,
+            SimilarityMetric.TARGET_COSINE,
+        }
+        if needs_cooc:
+            with _profiled(profile, "cooccurrence", trace_memory):
+                target_row = self._cooc_matrix[target_idx].toarray().reshape(-1)
+                if SimilarityMetric.SIMPLE_COSINE in self.weights:
+                    cooc_matrix, row_norms = self._cooc_matrix, self._cooc_row_norms
+                    if candidates is not None:
+                        cooc_matrix = cooc_matrix[candidates]
+                        row_norms = row_norms[candidates]
+                    denom = row_norms * self._cooc_row_norms[target_idx]
+                    sims = np.zeros(len(denom))
+                    np.divide(
+                        cooc_matrix @ target_row, denom, out=sims, where=denom > 0
+                    )
+                    scores[SimilarityMetric.SIMPLE_COSINE] = sims
+                if SimilarityMetric.TARGET_COSINE in self.weights:
+                    scores[SimilarityMetric.TARGET_COSINE] = (
+                        cooccurrence.masked_cosine_similarities(
+                            self._cooc_matrix,
+                            recommender.ingredient_counts_vector,
+                            [
+                                recommender.ingredient_index_maping[ing]
+                                for ing in recommender.recipe_data[
+                                    recipe_id
+                                ].ingredients
+                            ],
+                            target_idx,
+                            row_indices=candidates,
+                        )
+                    )
+
+        needs_outputs = self.weights.keys() & {
+            SimilarityMetric.INGREDIENT_OUTPUT,
+            SimilarityMetric.RECIPE_OUTPUT,
+        }
+        if needs_outputs:
+            with _profiled(profile, "recipe_outputs", trace_memory):
+                operation_recipe_key = f"RECIPE_OUTPUT_{recipe_id}"
+                outputs = recommender.kg_calculator.calculate_output_similarities(
+                    target_recipe=operation_recipe_key,
+                    recipe_ops=recommender.operations[operation_recipe_key],
+                    replace_ings=[ingredient],
+                    all_ingredients=(
+                        recommender.ingredients
+                        if candidates is None
+                        else [recommender.ingredients[i] for i in candidates]
+                    ),
+                )[0]
+                scores[SimilarityMetric.INGREDIENT_OUTPUT] = outputs[0]
+                scores[SimilarityMetric.RECIPE_OUTPUT] = outputs[1]
+
+        if SimilarityMetric.INDIVIDUAL_INGREDIENT in self.weights:
+            with _profiled(profile, "individual_ingredient", trace_memory):
+                kg_calculator = recommender.kg_calculator
+                scores[
+                    SimilarityMetric.INDIVIDUAL_INGREDIENT
+                ] = kg_calculator.ingredient_index(
+                    recommender.ingredients
+                ).similarities(
+                    kg_calculator.entity_embeddings[
+                        kg_calculator.entity_id_mapping[ingredient]
+                    ],
+                    rows=candidates,
+                )
+
+        if SimilarityMetric.METADATA_WEIGHTED in self.weights:
+            with _profiled(profile, "metadata", trace_memory):
+                scores[SimilarityMetric.METADATA_WEIGHTED] = self._metadata_similarity(
+                    target_idx, candidates
+                )
+
+        with _profiled(profile, "blend", trace_memory):
+            n_candidates = (
+                len(recommender.ingredients) if candidates is None else len(candidates)
+            )
+            blended = np.zeros(n_candidates)
+            for metric, weight in self.weights.items():
+                blended += weight * scores[metric]
+            blended /= self.total_weight
+            if exclude_target and candidates is None:
+                blended[target_idx] = -np.inf
+            best = top_k_rows(blended, k)[0]
+            if exclude_target and candidates is None:
+                best = best[best != target_idx]
+
+        substitutes = [
+            RankedSubstitute(
+                ingredient=recommender.ingredients[
+                    i if candidates is None else candidates[i]
+                ],
+                score=float(blended[i]),
+                breakdown={metric: float(scores[metric][i]) for metric in self.weights},
+            )
+            for i in best
+        ]
+        return RankingResult(substitutes=substitutes, profile=profile)
+
+    def _metadata_similarity(
+        self, target_idx: int, candidates: np.ndarray | None = None
+    ) -> np.ndarray:
+        categories = self.recommender.ingredient_categories
+        category_sims = self.recommender.category_similarities[categories[target_idx]]
+        if candidates is not None:
+            categories = categories[candidates]
+        return category_sims[categories]
+
+
+@contextlib.contextmanager
+def _profiled(profile: dict[str, PartProfile], part: str, trace_memory: bool):
+    started_tracing = trace_memory and not tracemalloc.is_tracing()
+    if started_tracing:
+        tracemalloc.start()
+    if trace_memory:
+        tracemalloc.reset_peak()
+        baseline = tracemalloc.get_traced_memory()[0]
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        peak_bytes = None
+        if trace_memory:
+            peak_bytes = tracemalloc.get_traced_memory()[1] - baseline
+        if started_tracing:
+            tracemalloc.stop()
+        profile[part] = PartProfile(seconds=elapsed, peak_bytes=peak_bytes)
+
+
+if __name__ == "__main__":
+    weights = {
+        "origin": 3,
+        "type": 2,
+        "state": 3,
+        "smell": 1,
+        "smell-intensity": 1,
+        "taste": 10,
+        "taste-intensity": 5,
+        "texture": 2,
+    }
+    recommender = Recommender(
+        "data/recipe_parsed_sm/",
+        "GraphOps_recipe_parsed_sm_graph_TransE",
+        "processed/categorized.json",
+        "processed/characterized.json",
+        metadata_weights=weights,
+    )
+    ranker = FusedRanker(recommender)
+    result = ranker.rank("pepper", "44061", k=10, trace_memory=True)
+    for substitute in result.substitutes:
+        print(f"{substitute.ingredient}\t{substitute.score:.3f}")
+    for part, part_profile in result.profile.items():
+        print(
+            f"{part}\t{part_profile.seconds * 1000:.2f} ms"
+            f"\t{part_profile.peak_bytes / 1024:.1f} KiB"
+        )
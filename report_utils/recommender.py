@@ -1,19 +1,27 @@
 import json
 import pathlib
 import enum
+import collections
+import concurrent.futures
+import multiprocessing
+
+from typing import Iterable, Sequence
 
 import numpy as np
 import pandas as pd
 
 from sklearn.metrics.pairwise import cosine_similarity
 
-from report_utils import load, graph, similarity, kgcalc
+from eatpim.ranking import ann, cooccurrence
+from report_utils import load, graph, similarity, kgcalc, artifacts, constraints
 
 INGREDIENTS_FILE = "ingredient_list.json"
 RECIPES_FILE = "recipe_tree_data.json"
 ENTITIES_FILE = "entities.dict"
 RELATIONS_FILE = "relations.dict"
 EXTRA_MODEL_DATA_FOLDER = "triple_data"
+ARTIFACTS_FOLDER = "artifacts"
+OPERATION_DATASETS = ["train", "valid", "test"]
 
 
 class SimilarityMetric(enum.Enum):
@@ -33,12 +41,14 @@ class Recommender:
         path_to_categorisation: str,
         path_to_metadata: str,
         metadata_weights: dict[str, float],
+        cache_artifacts: bool = True,
     ) -> None:
         self.path_to_recommender_data = pathlib.Path(path_to_recommender_data).resolve()
         self.model = model
         self.path_to_categorisation = pathlib.Path(path_to_categorisation).resolve()
         self.path_to_metadata = pathlib.Path(path_to_metadata).resolve()
         self.metadata_weights = metadata_weights
+        self.cache_artifacts = cache_artifacts
         self._load_data()
 
     def evaluate_substitutes(
@@ -66,6 +76,7 @@ class Recommender:
                 )
             case SimilarityMetric.INGREDIENT_OUTPUT:
                 return self.kg_calculator.calculate_ingredient_output_similarity(
+                    target_recipe=operation_recipe_key,
                     recipe_ops=self.operations[operation_recipe_key],
                     replace_ing=ingredient,
                     all_ingredients=self.ingredients,
@@ -83,72 +94,282 @@ class Recommender:
                     all_ingredients=self.ingredients,
                 )
             case SimilarityMetric.METADATA_WEIGHTED:
-                result = np.zeros(len(self.usage_counts))
-                mapped_target_ingredient = self.categorisation.get(ingredient)
-                if not mapped_target_ingredient:
-                    return result
-
-                ing_metadata_vector = self.metadata_matrix.loc[
-                    mapped_target_ingredient
-                ].to_numpy()
-                metadata_similarities = cosine_similarity(
-                    ing_metadata_vector.reshape(1, -1), self.metadata_matrix.to_numpy()
-                ).flatten()
-                metadata_sim_dict = {
-                    self.metadata_matrix.index[i]: metadata_similarities[i]
-                    for i in range(len(metadata_similarities))
-                }
-                for i, ingredient in enumerate(self.usage_counts.keys()):
-                    mapped_ingredient = self.categorisation.get(ingredient)
-                    result[i] = metadata_sim_dict.get(mapped_ingredient, 0)
-                return result
+                return self._metadata_similarity(ingredient)
+
+    def evaluate_substitutes_batch(
+        self,
+        queries: Sequence[tuple[str, int]],
+        similarity_metrics: Iterable[SimilarityMetric],
+        n_workers: int = 0,
+        candidates: np.ndarray | None = None,
+    ) -> np.ndarray:
+        """
+        Evaluates substitutes for many (ingredient, recipe_id) queries and metrics at once.
+
+        Queries are grouped by recipe so every recipe tree is compiled only once, and each
+        metric is computed as a batched matrix operation over the queries that share it.
+        With `n_workers > 1` recipe groups are spread over a forked process pool whose
+        workers share this recommender's read-only data.
+
+        Returns an array of shape (n_queries, n_metrics, n_ingredients), where
+        `result[i, j]` equals `evaluate_substitutes(*queries[i], similarity_metrics[j])`.
+        With `candidates`, only those rows of the ingredient index are scored by any metric
+        and the last axis follows their order.
+        """
+        queries = list(queries)
+        similarity_metrics = tuple(similarity_metrics)
+        if n_workers > 1:
+            return self._evaluate_substitutes_in_pool(
+                queries, similarity_metrics, n_workers, candidates
+            )
+
+        if candidates is None:
+            candidate_ingredients = self.ingredients
+            candidate_categories = self.ingredient_categories
+            candidate_cooc_matrix = self.cooc_matrix
+        else:
+            candidates = np.asarray(candidates, dtype=np.int64)
+            candidate_ingredients = tuple(self.ingredients[i] for i in candidates)
+            candidate_categories = self.ingredient_categories[candidates]
+            candidate_cooc_matrix = self.cooc_matrix[candidates]
+        result = np.zeros(
+            (len(queries), len(similarity_metrics), len(candidate_ingredients))
+        )
+        if not queries or not len(candidate_ingredients):
+            return result
+        ingredients = [ingredient for ingredient, _ in queries]
+        target_indices = [self.ingredient_index_maping[ing] for ing in ingredients]
+        recipe_groups = collections.defaultdict(list)
+        for position, (_, recipe_id) in enumerate(queries):
+            recipe_groups[recipe_id].append(position)
+
+        output_similarities = {}
+        for j, metric in enumerate(similarity_metrics):
+            match metric:
+                case SimilarityMetric.SIMPLE_COSINE:
+                    result[:, j] = cosine_similarity(
+                        self.cooc_matrix[target_indices], candidate_cooc_matrix
+                    )
+                case SimilarityMetric.TARGET_COSINE:
+                    for recipe_id, positions in recipe_groups.items():
+                        result[positions, j] = cooccurrence.masked_cosine_similarities(
+                            self.cooc_matrix,
+                            self.ingredient_counts_vector,
+                            [
+                                self.ingredient_index_maping[ing]
+                                for ing in self.recipe_data[recipe_id].ingredients
+                            ],
+                            [target_indices[p] for p in positions],
+                            row_indices=candidates,
+                        )
+                case (
+                    SimilarityMetric.INGREDIENT_OUTPUT | SimilarityMetric.RECIPE_OUTPUT
+                ):
+                    # both output metrics come from the same compiled recipe trees
+                    column = 0 if metric == SimilarityMetric.INGREDIENT_OUTPUT else 1
+                    for recipe_id, positions in recipe_groups.items():
+                        if recipe_id not in output_similarities:
+                            operation_recipe_key = f"RECIPE_OUTPUT_{recipe_id}"
+                            output_similarities[recipe_id] = (
+                                self.kg_calculator.calculate_output_similarities(
+                                    target_recipe=operation_recipe_key,
+                                    recipe_ops=self.operations[operation_recipe_key],
+                                    replace_ings=[ingredients[p] for p in positions],
+                                    all_ingredients=candidate_ingredients,
+                                )
+                            )
+                        result[positions, j] = output_similarities[recipe_id][:, column]
+                case SimilarityMetric.INDIVIDUAL_INGREDIENT:
+                    result[:, j] = (
+                        self.kg_calculator.calculate_individual_ingredient_similarities(
+                            target_ings=ingredients,
+                            all_ingredients=self.ingredients,
+                            rows=candidates,
+                        )
+                    )
+                case SimilarityMetric.METADATA_WEIGHTED:
+                    result[:, j] = self.category_similarities[
+                        self.ingredient_categories[target_indices]
+                    ][:, candidate_categories]
+        return result
+
+    def _evaluate_substitutes_in_pool(
+        self,
+        queries: list[tuple[str, int]],
+        similarity_metrics: tuple[SimilarityMetric, ...],
+        n_workers: int,
+        candidates: np.ndarray | None = None,
+    ) -> np.ndarray:
+        recipe_groups = collections.defaultdict(list)
+        for position, (_, recipe_id) in enumerate(queries):
+            recipe_groups[recipe_id].append(position)
+        chunks = [[] for _ in range(n_workers)]
+        for i, positions in enumerate(recipe_groups.values()):
+            chunks[i % n_workers].extend(positions)
+        chunks = [chunk for chunk in chunks if chunk]
+
+        result = np.zeros(
+            (
+                len(queries),
+                len(similarity_metrics),
+                len(self.ingredients) if candidates is None else len(candidates),
+            )
+        )
+        # forked workers inherit the recommender, so embeddings and matrices are shared
+        # copy-on-write instead of being pickled to every process
+        context = multiprocessing.get_context("fork")
+        with concurrent.futures.ProcessPoolExecutor(
+            max_workers=len(chunks),
+            mp_context=context,
+            initializer=_init_batch_worker,
+            initargs=(self,),
+        ) as executor:
+            futures = {
+                executor.submit(
+                    _evaluate_batch_in_worker,
+                    [queries[p] for p in chunk],
+                    similarity_metrics,
+                    candidates,
+                ): chunk
+                for chunk in chunks
+            }
+            for future in concurrent.futures.as_completed(futures):
+                result[futures[future]] = future.result()
+        return result
+
+    def _metadata_similarity(self, ingredient: str) -> np.ndarray:
+        target_category = self.ingredient_categories[
+            self.ingredient_index_maping[ingredient]
+        ]
+        return self.category_similarities[target_category][self.ingredient_categories]
+
+    def _build_metadata_index(self) -> None:
+        """
+        Cosine similarities between the weighted metadata vectors of all category pairs,
+        and the category row of every ingredient. Ingredients without a category, or whose
+        category has no metadata, map to an extra all-zero row.
+        """
+        metadata = self.metadata_matrix.to_numpy(dtype=np.float64)
+        norms = np.linalg.norm(metadata, axis=1, keepdims=True)
+        normalized = np.zeros_like(metadata)
+        np.divide(metadata, norms, out=normalized, where=norms > 0)
+        n_categories = len(metadata)
+        self.category_similarities = np.zeros((n_categories + 1, n_categories + 1))
+        self.category_similarities[:n_categories, :n_categories] = (
+            normalized @ normalized.T
+        )
+
+        category_rows = {
+            category: i for i, category in enumerate(self.metadata_matrix.index)
+        }
+        self.ingredient_categories = np.array(
+            [
+                category_rows.get(self.categorisation.get(ingredient), n_categories)
+                for ingredient in self.ingredients
+            ],
+            dtype=np.int64,
+        )
+
+    def _input_files(self) -> dict[str, pathlib.Path]:
+        input_files = {
+            INGREDIENTS_FILE: self.path_to_recommender_data / INGREDIENTS_FILE,
+            RECIPES_FILE: self.path_to_recommender_data / RECIPES_FILE,
+            "metadata": self.path_to_metadata,
+            "categorisation": self.path_to_categorisation,
+        }
+        for file_name in [ENTITIES_FILE, RELATIONS_FILE] + [
+            f"{dataset}.txt" for dataset in OPERATION_DATASETS
+        ]:
+            input_files[file_name] = (
+                self.path_to_recommender_data / EXTRA_MODEL_DATA_FOLDER / file_name
+            )
+        return input_files
 
     def _load_data(self) -> None:
+        with open(self.path_to_categorisation, "r") as f:
+            self.categorisation = json.load(f)
+
+        cached = None
+        if self.cache_artifacts:
+            key = artifacts.artifacts_key(
+                self._input_files(), {"metadata_weights": self.metadata_weights}
+            )
+            artifacts_dir = self.path_to_recommender_data / ARTIFACTS_FOLDER / key
+            cached = artifacts.load_artifacts(artifacts_dir, key)
+
+        if cached is None:
+            self._build_data()
+            if self.cache_artifacts:
+                artifacts.save_artifacts(
+                    artifacts_dir,
+                    key=key,
+                    recipe_data=self.recipe_data,
+                    usage_counts=self.usage_counts,
+                    cooc_matrix=self.cooc_matrix,
+                    ingredient_counts_vector=self.ingredient_counts_vector,
+                    id_to_entities=self.id_to_entities,
+                    id_to_relations=self.id_to_relations,
+                    operations=self.operations,
+                    metadata_matrix=self.metadata_matrix,
+                    attribute_masks=self.attribute_masks,
+                )
+        else:
+            for name, value in cached.items():
+                setattr(self, name, value)
+
+        self.ingredients = tuple(self.usage_counts.keys())
+        self.ingredient_index_maping = {
+            ingredient: i for i, ingredient in enumerate(self.usage_counts)
+        }
+        self.entities = {v: k for k, v in self.id_to_entities.items()}
+        self.relations = {v: k for k, v in self.id_to_relations.items()}
+        self._build_metadata_index()
+
+        self.entity_embeddings, self.relation_embeddings = load.load_embedding_data(
+            self.path_to_recommender_data / "models" / self.model
+        )
+        self.kg_calculator = kgcalc.KnowledgeGraphCalculator(
+            entity_embeddings=self.entity_embeddings,
+            entity_id_mapping=self.entities,
+            relation_embeddings=self.relation_embeddings,
+            relation_id_mapping=self.relations,
+            ann_index=ann.load_model_ann_index(
+                self.path_to_recommender_data / "models" / self.model
+            ),
+            model_id=self.model,
+        )
+
+    def _build_data(self) -> None:
         with open(self.path_to_recommender_data / INGREDIENTS_FILE, "r") as f:
             ingredients = set(json.load(f))
 
         with open(self.path_to_recommender_data / RECIPES_FILE, "r") as f:
-            self.graph_data = json.load(f)
+            graph_data = json.load(f)
 
-        self.recipe_data = graph.parse_graph_tree(self.graph_data, ingredients)
+        self.recipe_data = graph.parse_graph_tree(graph_data, ingredients)
         self.usage_counts = graph.get_ingredient_usage_counts_from_recipies(
             self.recipe_data
         )
-        self.ingredients = tuple(self.usage_counts.keys())
-        self.ingredient_counts_vector = np.array(
-            [self.usage_counts[ingredient] for ingredient in self.usage_counts.keys()]
-        )
-        self.ingredient_index_maping = {
+        ingredient_index_maping = {
             ingredient: i for i, ingredient in enumerate(self.usage_counts)
         }
-        self.cooc_matrix = similarity.calculate_cooccurence_matrix(
+        (
+            self.cooc_matrix,
+            self.ingredient_counts_vector,
+        ) = similarity.calculate_cooccurence_matrix(
             (recipe.ingredients for recipe in self.recipe_data.values()),
-            self.ingredient_index_maping,
-        )
-
-        self.entity_embeddings, self.relation_embeddings = load.load_embedding_data(
-            self.path_to_recommender_data / "models" / self.model
+            ingredient_index_maping,
         )
 
         self.id_to_entities = load.load_graph_data(
             self.path_to_recommender_data / EXTRA_MODEL_DATA_FOLDER / ENTITIES_FILE
         )
-        self.entities = {v: k for k, v in self.id_to_entities.items()}
-
         self.id_to_relations = load.load_graph_data(
             self.path_to_recommender_data / EXTRA_MODEL_DATA_FOLDER / RELATIONS_FILE
         )
-        self.relations = {v: k for k, v in self.id_to_relations.items()}
-
-        self.kg_calculator = kgcalc.KnowledgeGraphCalculator(
-            entity_embeddings=self.entity_embeddings,
-            entity_id_mapping=self.entities,
-            relation_embeddings=self.relation_embeddings,
-            relation_id_mapping=self.relations,
-        )
 
         self.operations = {}
-        for dataset in ["train", "valid", "test"]:
+        for dataset in OPERATION_DATASETS:
             self.operations.update(
                 load.load_json_list(
                     self.path_to_recommender_data
@@ -157,16 +378,35 @@ class Recommender:
                 )
             )
 
-        with open(self.path_to_categorisation, "r") as f:
-            self.categorisation = json.load(f)
-
         with open(self.path_to_metadata, "r") as f:
-            self.ingredients_metadata = pd.read_json(f).T
+            ingredients_metadata = pd.read_json(f).T
 
-        metadata_one_hot = pd.get_dummies(self.ingredients_metadata)
+        metadata_one_hot = pd.get_dummies(ingredients_metadata)
         for column in metadata_one_hot.columns:
             col_group = column.split("_")[0]
             metadata_one_hot[column] *= self.metadata_weights[col_group]
 
         other_columns = [col for col in metadata_one_hot.columns if "other" in col]
         self.metadata_matrix = metadata_one_hot.drop(columns=other_columns)
+
+        self.attribute_masks = constraints.AttributeMasks.build(
+            self.usage_counts.keys(), self.categorisation, ingredients_metadata
+        )
+
+
+_batch_worker_recommender: Recommender | None = None
+
+
+def _init_batch_worker(recommender: Recommender) -> None:
+    global _batch_worker_recommender
+    _batch_worker_recommender = recommender
+
+
+def _evaluate_batch_in_worker(
+    queries: list[tuple[str, int]],
+    similarity_metrics: tuple[SimilarityMetric, ...],
+    candidates: np.ndarray | None,
+) -> np.ndarray:
+    return _batch_worker_recommender.evaluate_substitutes_batch(
+        queries, similarity_metrics, candidates=candidates
+    )
@@ -0,0 +1,348 @@
+import argparse
+import asyncio
+import collections
+import concurrent.futures
+import dataclasses
+import functools
+import json
+import time
+
+import numpy as np
+
+from eatpim.ranking.embedding_index import top_k_rows
+from report_utils.recommender import Recommender, SimilarityMetric
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8765
+DEFAULT_METADATA_WEIGHTS = {
+    "origin": 3,
+    "type": 2,
+    "state": 3,
+    "smell": 1,
+    "smell-intensity": 1,
+    "taste": 10,
+    "taste-intensity": 5,
+    "texture": 2,
+}
+LATENCY_WINDOW = 10000
+# metrics that look up the ingredient's embedding, and those that need the recipe's tree
+EMBEDDING_METRICS = {
+    SimilarityMetric.INGREDIENT_OUTPUT,
+    SimilarityMetric.RECIPE_OUTPUT,
+    SimilarityMetric.INDIVIDUAL_INGREDIENT,
+}
+OPERATION_METRICS = {SimilarityMetric.INGREDIENT_OUTPUT, SimilarityMetric.RECIPE_OUTPUT}
+
+HTTP_REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 500: "Server Error"}
+
+
+class RequestError(Exception):
+    pass
+
+
+@dataclasses.dataclass
+class LatencyCounter:
+    count: int = 0
+    errors: int = 0
+    total_seconds: float = 0.0
+    recent: collections.deque = dataclasses.field(
+        default_factory=lambda: collections.deque(maxlen=LATENCY_WINDOW)
+    )
+
+    def record(self, seconds: float, error: bool = False) -> None:
+        self.count += 1
+        self.errors += error
+        self.total_seconds += seconds
+        self.recent.append(seconds)
+
+    def summary(self) -> dict:
+        recent = np.array(self.recent) * 1000
+        return {
+            "count": self.count,
+            "errors": self.errors,
+            "mean_ms": self.total_seconds * 1000 / self.count if self.count else 0.0,
+            "p50_ms": float(np.percentile(recent, 50)) if recent.size else 0.0,
+            "p99_ms": float(np.percentile(recent, 99)) if recent.size else 0.0,
+        }
+
+
+class SubstitutionServer:
+    """
+    HTTP/1.1 JSON server on localhost that keeps a Recommender warm between queries.
+
+    POST /substitutes with {"ingredient", "recipe_id", "metrics"?, "k"?, "include"?,
+    "exclude"?} returns the top k substitutes for each metric, restricted to the candidates
+    allowed by the category and attribute constraints. GET /stats returns latency counters.
+
+    Requests are queued per recipe and a single batch task drains the queue one recipe at a
+    time, so all requests for a recipe that arrive while earlier batches are running are
+    coalesced into one `evaluate_substitutes_batch` call, which compiles the recipe tree
+    once for all of them. Constrained requests only score their allowed candidates: a batch
+    is scored on the union of its requests' candidates, or on every ingredient if any of
+    them is unconstrained. If a coalesced batch fails, its requests are retried one by one,
+    so only the request that caused the failure gets the error. Model calls run on a
+    worker thread, so the event loop keeps accepting connections meanwhile.
+    """
+
+    def __init__(self, recommender: Recommender, coalesce_window: float = 0.002):
+        self.recommender = recommender
+        self.coalesce_window = coalesce_window
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self._pending: dict[str, list] = {}
+        self._has_pending = asyncio.Event()
+        self._batch_task: asyncio.Task | None = None
+        self.latency: dict[str, LatencyCounter] = collections.defaultdict(
+            LatencyCounter
+        )
+        self.batches = 0
+        self.coalesced_requests = 0
+        self.started = time.time()
+
+    async def substitutes(self, payload: dict) -> dict:
+        try:
+            ingredient = payload["ingredient"]
+            recipe_id = str(payload["recipe_id"])
+            metrics = tuple(
+                SimilarityMetric[name]
+                for name in payload.get("metrics", [m.name for m in SimilarityMetric])
+            )
+            k = int(payload.get("k", 10))
+            candidates = None
+            if payload.get("include") or payload.get("exclude"):
+                candidates = np.flatnonzero(
+                    self.recommender.attribute_masks.mask(
+                        payload.get("include"), payload.get("exclude")
+                    )
+                )
+        except (KeyError, TypeError, ValueError) as e:
+            raise RequestError(f"invalid request: {e!r}")
+        if ingredient not in self.recommender.ingredient_index_maping:
+            raise RequestError(f"unknown ingredient {ingredient!r}")
+        if recipe_id not in self.recommender.recipe_data:
+            raise RequestError(f"unknown recipe {recipe_id!r}")
+        if (
+            EMBEDDING_METRICS.intersection(metrics)
+            and ingredient not in self.recommender.kg_calculator.entity_id_mapping
+        ):
+            raise RequestError(f"ingredient {ingredient!r} has no embedding")
+        if (
+            OPERATION_METRICS.intersection(metrics)
+            and f"RECIPE_OUTPUT_{recipe_id}" not in self.recommender.operations
+        ):
+            raise RequestError(f"recipe {recipe_id!r} has no operation tree")
+
+        if candidates is not None and not len(candidates):
+            return {
+                "ingredient": ingredient,
+                "recipe_id": recipe_id,
+                "substitutes": {metric.name: [] for metric in metrics},
+            }
+
+        if self._batch_task is None:
+            self._batch_task = asyncio.create_task(self._run_batches())
+        future = asyncio.get_running_loop().create_future()
+        self._pending.setdefault(recipe_id, []).append(
+            (ingredient, metrics, candidates, future)
+        )
+        self._has_pending.set()
+        # one score per candidate, or per ingredient if unconstrained
+        scores = await future
+
+        substitutes = {}
+        for metric, metric_scores in zip(metrics, scores):
+            best = top_k_rows(metric_scores, k)[0]
+            rows = best if candidates is None else candidates[best]
+            substitutes[metric.name] = [
+                [self.recommender.ingredients[i], float(metric_scores[j])]
+                for i, j in zip(rows, best)
+            ]
+        return {
+            "ingredient": ingredient,
+            "recipe_id": recipe_id,
+            "substitutes": substitutes,
+        }
+
+    async def _run_batches(self) -> None:
+        while True:
+            await self._has_pending.wait()
+            # give concurrent requests for the same recipe a moment to arrive
+            await asyncio.sleep(self.coalesce_window)
+            # oldest recipe first
+            recipe_id = next(iter(self._pending))
+            pending = self._pending.pop(recipe_id)
+            if not self._pending:
+                self._has_pending.clear()
+            self.batches += 1
+            self.coalesced_requests += len(pending)
+            try:
+                await self._run_batch(recipe_id, pending)
+            except Exception as e:
+                # the batch task has to survive, or every later request would wait forever
+                for _, _, _, future in pending:
+                    if not future.done():
+                        future.set_exception(e)
+
+    async def _run_batch(self, recipe_id: str, pending: list) -> None:
+        ingredients = sorted({ingredient for ingredient, _, _, _ in pending})
+        metrics = sorted(
+            {
+                metric
+                for _, request_metrics, _, _ in pending
+                for metric in request_metrics
+            },
+            key=lambda metric: metric.value,
+        )
+        if any(candidates is None for _, _, candidates, _ in pending):
+            batch_candidates = None
+        else:
+            batch_candidates = np.unique(
+                np.concatenate([candidates for _, _, candidates, _ in pending])
+            )
+        try:
+            scores = await asyncio.get_running_loop().run_in_executor(
+                self.executor,
+                functools.partial(
+                    self.recommender.evaluate_substitutes_batch,
+                    candidates=batch_candidates,
+                ),
+                [(ingredient, recipe_id) for ingredient in ingredients],
+                metrics,
+            )
+        except Exception as e:
+            if len(pending) == 1:
+                future = pending[0][3]
+                if not future.done():
+                    future.set_exception(e)
+                return
+            # one bad request must not fail the requests it was coalesced with
+            for request in pending:
+                await self._run_batch(recipe_id, [request])
+            return
+        for ingredient, request_metrics, candidates, future in pending:
+            if future.done():
+                # the client went away while the batch was running
+                continue
+            i = ingredients.index(ingredient)
+            if candidates is None:
+                columns = slice(None)
+            elif batch_candidates is None:
+                columns = candidates
+            else:
+                columns = np.searchsorted(batch_candidates, candidates)
+            future.set_result(
+                [
+                    scores[i, metrics.index(metric), columns]
+                    for metric in request_metrics
+                ]
+            )
+
+    def stats(self) -> dict:
+        return {
+            "uptime_s": time.time() - self.started,
+            "batches": self.batches,
+            "coalesced_requests": self.coalesced_requests,
+            "kg_cache": self.recommender.kg_calculator.cache_stats(),
+            "endpoints": {
+                name: counter.summary() for name, counter in self.latency.items()
+            },
+        }
+
+    async def handle_connection(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, target, version = request_line.decode().split()
+                headers = {}
+                while (line := await reader.readline()) not in (b"\r\n", b"\n", b""):
+                    name, value = line.decode().split(":", 1)
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+
+                start = time.perf_counter()
+                status, response = await self._route(method, target, body)
+                route = f"{method} {target}" if status != 404 else "unmatched"
+                self.latency[route].record(
+                    time.perf_counter() - start, error=status != 200
+                )
+
+                keep_alive = (
+                    version == "HTTP/1.1"
+                    and headers.get("connection", "").lower() != "close"
+                )
+                data = json.dumps(response).encode()
+                writer.write(
+                    (
+                        f"HTTP/1.1 {status} {HTTP_REASONS[status]}\r\n"
+                        "Content-Type: application/json\r\n"
+                        f"Content-Length: {len(data)}\r\n"
+                        f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n"
+                        "\r\n"
+                    ).encode()
+                    + data
+                )
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def _route(self, method: str, target: str, body: bytes) -> tuple[int, dict]:
+        match method, target:
+            case "POST", "/substitutes":
+                try:
+                    return 200, await self.substitutes(json.loads(body or b"{}"))
+                except (RequestError, json.JSONDecodeError) as e:
+                    return 400, {"error": str(e)}
+                except Exception as e:
+                    return 500, {"error": repr(e)}
+            case "GET", "/stats":
+                return 200, self.stats()
+            case "GET", "/health":
+                return 200, {"status": "ok"}
+        return 404, {"error": f"no route for {method} {target}"}
+
+    async def serve(self, host: str = DEFAULT_HOST, port: int = DEFAULT_PORT) -> None:
+        server = await asyncio.start_server(self.handle_connection, host, port)
+        print(f"serving substitutions on http://{host}:{port}")
+        async with server:
+            await server.serve_forever()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Serve substitution requests from a warm Recommender"
+    )
+    parser.add_argument("--data_dir", type=str, required=True)
+    parser.add_argument("--model", type=str, required=True)
+    parser.add_argument("--categorisation", type=str, required=True)
+    parser.add_argument("--metadata", type=str, required=True)
+    parser.add_argument(
+        "--metadata_weights",
+        type=json.loads,
+        default=DEFAULT_METADATA_WEIGHTS,
+        help="JSON object of metadata column group weights",
+    )
+    parser.add_argument("--host", type=str, default=DEFAULT_HOST)
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--coalesce_window_ms", type=float, default=2.0)
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    recommender = Recommender(
+        args.data_dir,
+        args.model,
+        args.categorisation,
+        args.metadata,
+        metadata_weights=args.metadata_weights,
+    )
+    print(f"model loaded in {time.perf_counter() - start:.1f}s")
+    server = SubstitutionServer(
+        recommender, coalesce_window=args.coalesce_window_ms / 1000
+    )
+    asyncio.run(server.serve(args.host, args.port))